@@ -0,0 +1,293 @@
+import bisect
+import heapq
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable
+
+from utils import source_prefix
+
+if TYPE_CHECKING:
+    from database import Database
+
+# Prefixes matching more keys than this get their completions precomputed
+HEAVY_PREFIX_KEYS = 256
+# Number of recent texts whose completions are kept by the CompletionWorker
+COMPLETION_CACHE_SIZE = 256
+
+
+def normalize_name(name: str) -> str:
+    """
+    Normalize a stop name for the autocomplete: lower case, without accents and punctuation,
+    words separated by single spaces.
+    """
+    name = name.lower()
+    if not name.isascii():
+        name = unicodedata.normalize("NFKD", name)
+        name = "".join(char for char in name if not unicodedata.combining(char))
+    return " ".join(re.findall(r"\w+", name))
+
+
+class AutocompleteIndex:
+    def __init__(self, db: "Database", limit: int = 10):
+        """
+        This class is an in-memory prefix index of the station names, serving the stop autocomplete
+        without querying the database.
+        Stops are grouped by parent station, under the name of the station, and stations with the same
+        normalized name (from different sources) are merged. Each station is ranked by its importance,
+        its number of stop times (see Database.get_stop_importance).
+        Every word suffix of the names and aliases is a key of a sorted array, so "dieu" completes
+        "Lyon Part-Dieu". The best limit completions of the prefixes matching many keys are precomputed,
+        the other prefixes only match a few keys, which are ranked on the fly.
+        The index is loaded in a background thread, and reloaded when the database file is swapped.
+        """
+        self.db = db
+        self.limit = limit
+        self.loaded = threading.Event()
+        self.loading = threading.Lock()
+        self.file_identity = None
+        # (entries, keys, key_entries, heavy_prefixes): the (stop_id, stop_name) of each station by decreasing importance,
+        # the sorted keys and the index of their entry, and the completions of the heavy prefixes
+        self.index = ([], [], [], {})
+
+    def load_async(self):
+        """
+        Load the index in a daemon thread, unless it is already being loaded.
+        """
+        threading.Thread(target=self.load, daemon=True).start()
+
+    def load(self):
+        """
+        Build the index from the stop_search table if it exists (names, aliases and importance computed at import),
+        from the stops and stop times otherwise.
+        """
+        if not self.loading.acquire(blocking=False):
+            return
+        try:
+            file_identity = self.db.get_file_identity()
+            stations = {}
+            with self.db.read_connection() as cursor:
+                aliases = {}
+                if self.db.get_table_columns(cursor, "stop_search"):
+                    cursor.execute(
+                        "SELECT stop_id, aliases, importance FROM stop_search"
+                    )
+                    importance = {}
+                    for stop_id, stop_aliases, stop_importance in cursor.fetchall():
+                        importance[stop_id] = stop_importance
+                        if stop_aliases:
+                            aliases[stop_id] = stop_aliases
+                else:
+                    importance = self.db.get_stop_importance(cursor)
+                cursor.execute("SELECT stop_id, stop_name, parent_station FROM stops")
+                stops = cursor.fetchall()
+            names = {stop_id: stop_name for stop_id, stop_name, _ in stops}
+            normalized = {}
+            # normalized name -> [station_id, station_name, stop_ids, aliases]
+            for stop_id, stop_name, parent_station in stops:
+                station_id = (
+                    source_prefix(stop_id) + parent_station if parent_station else stop_id
+                )
+                if station_id not in names:
+                    station_id = stop_id
+                station_name = names[station_id]
+                if not station_name:
+                    continue
+                key = normalized.get(station_name)
+                if key is None:
+                    key = normalized[station_name] = normalize_name(station_name)
+                station = stations.setdefault(
+                    key, [station_id, station_name, set(), set()]
+                )
+                if importance.get(station_id, 0) > importance.get(station[0], 0):
+                    station[0], station[1] = station_id, station_name
+                station[2].add(station_id)
+                if stop_id in aliases:
+                    station[3].add(normalize_name(aliases[stop_id]))
+
+            # Entries are sorted by decreasing importance, so that the best entries have the lowest indexes
+            stations = sorted(
+                (
+                    (
+                        -sum(importance.get(member, 0) for member in station[2]),
+                        len(station[1]),
+                        key,
+                        station,
+                    )
+                    for key, station in stations.items()
+                ),
+                key=lambda station: station[:2],
+            )
+            entries = []
+            keyed = []
+            for index, (_, _, key, station) in enumerate(stations):
+                station_id, station_name, _, station_aliases = station
+                entries.append((station_id, station_name))
+                for text in {key} | station_aliases:
+                    words = text.split()
+                    for i in range(len(words)):
+                        keyed.append((" ".join(words[i:]), index))
+            keyed.sort()
+            keys = [key for key, _ in keyed]
+            key_entries = [index for _, index in keyed]
+
+            heavy_prefixes = {}
+            self.find_heavy_prefixes(
+                keys, key_entries, entries, 0, len(keys), 1, heavy_prefixes
+            )
+
+            # Replaced at once, so that a running completion never mixes two versions of the index
+            self.index = (entries, keys, key_entries, heavy_prefixes)
+            self.file_identity = file_identity
+            self.loaded.set()
+        finally:
+            self.loading.release()
+
+    def find_heavy_prefixes(
+        self,
+        keys: list,
+        key_entries: list,
+        entries: list,
+        lo: int,
+        hi: int,
+        length: int,
+        heavy_prefixes: dict,
+    ):
+        """
+        Precompute the completions of the prefixes of the given length (and longer) of keys[lo:hi]
+        that match more than HEAVY_PREFIX_KEYS keys.
+        """
+        start = lo
+        while start < hi:
+            if len(keys[start]) < length:
+                start += 1
+                continue
+            prefix = keys[start][:length]
+            end = bisect.bisect_left(keys, prefix + "\uffff", start, hi)
+            if end - start > HEAVY_PREFIX_KEYS:
+                heavy_prefixes[prefix] = self.rank(key_entries[start:end], entries)
+                self.find_heavy_prefixes(
+                    keys, key_entries, entries, start, end, length + 1, heavy_prefixes
+                )
+            start = end
+
+    def rank(self, indexes: list, entries: list) -> list:
+        """
+        Get the limit most important distinct entries among the given entry indexes, as (stop_id, stop_name) tuples.
+        """
+        return [entries[index] for index in heapq.nsmallest(self.limit, set(indexes))]
+
+    def complete(self, text: str) -> list | None:
+        """
+        Get the best completions of a text, as (stop_id, stop_name) tuples like JourneyPlanner.search_stop,
+        or None if the index is not loaded yet.
+        """
+        if not self.loaded.is_set():
+            return None
+        if self.db.get_file_identity() != self.file_identity:
+            # The database has been swapped, the previous index is used until the new one is loaded
+            self.load_async()
+        prefix = normalize_name(text)
+        if not prefix:
+            return []
+        entries, keys, key_entries, heavy_prefixes = self.index
+        completions = heavy_prefixes.get(prefix)
+        if completions is not None:
+            return completions
+        lo = bisect.bisect_left(keys, prefix)
+        hi = bisect.bisect_left(keys, prefix + "\uffff", lo)
+        return self.rank(key_entries[lo:hi], entries)
+
+
+class CompletionWorker:
+    def __init__(
+        self,
+        index: AutocompleteIndex,
+        fallback: Callable[[str], list],
+        cache_size: int = COMPLETION_CACHE_SIZE,
+    ):
+        """
+        This class computes the completions in a background thread, so that the interface never waits for them.
+        Only the latest text is looked up: a request made while a lookup runs replaces the pending one,
+        and the results of a superseded request are dropped instead of being returned.
+        The completions come from the index, or from fallback (the stop search) until the index is loaded.
+        The completions of the index are cached by normalized text, so that a text typed again
+        (after a backspace) is completed at once, and the cache is emptied when the index is reloaded.
+        """
+        self.index = index
+        self.fallback = fallback
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        # The index version the cache was filled from
+        self.cache_index = None
+        self.condition = threading.Condition()
+        # (generation, text, callback) of the latest request not started yet
+        self.pending = None
+        self.generation = 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def cached(self, text: str) -> list | None:
+        """
+        Get the cached completions of a text, or None if they have to be looked up.
+        """
+        key = normalize_name(text)
+        with self.condition:
+            if self.cache_index is not self.index.index:
+                return None
+            completions = self.cache.get(key)
+            if completions is not None:
+                self.cache.move_to_end(key)
+            return completions
+
+    def submit(self, text: str, callback: Callable[[str, list], None]):
+        """
+        Request the completions of a text, replacing the previous request.
+        callback(text, completions) is called from the worker thread, unless the request is superseded.
+        """
+        with self.condition:
+            self.generation += 1
+            self.pending = (self.generation, text, callback)
+            self.condition.notify()
+
+    def cancel(self):
+        """
+        Drop the pending request and the result of the running one.
+        """
+        with self.condition:
+            self.generation += 1
+            self.pending = None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                generation, text, callback = self.pending
+                self.pending = None
+            # A failed lookup (e.g. the database being swapped) only loses its own completions
+            try:
+                self.lookup(generation, text, callback)
+            except Exception as e:
+                print(f"Error completing {text!r}: {e}")
+
+    def lookup(self, generation: int, text: str, callback: Callable[[str, list], None]):
+        """
+        Look up the completions of a request, cache them and give them to its callback, unless it is superseded.
+        """
+        index = self.index.index
+        completions = self.index.complete(text)
+        cacheable = completions is not None
+        if not cacheable:
+            completions = self.fallback(text)
+        with self.condition:
+            if cacheable:
+                if self.cache_index is not index:
+                    self.cache.clear()
+                    self.cache_index = index
+                self.cache[normalize_name(text)] = completions
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            if generation != self.generation:
+                return
+        callback(text, completions)
@@ -1,32 +1,202 @@
 import datetime
 import io
 import sqlite3
-import requests
 import zipfile
 import csv
 import os
-from models import Agency, Route, Shape, StopTime, Stop, Transfer, Trip
-from typing import Optional
+import time
+from models import (
+    Agency,
+    Route,
+    RouteRecord,
+    Shape,
+    StopTime,
+    Stop,
+    StopRecord,
+    StopTimeRecord,
+    Transfer,
+    Trip,
+    TripRecord,
+)
+from typing import Callable, Iterator, Optional, Sequence
 import json
-from transfer_generator import TransferGenerator
-from tqdm import tqdm
+from import_region import ImportRegion
+from import_report import ImportReport
+from utils import source_prefix
+import concurrent.futures
+import contextlib
+import hashlib
+import queue
+import threading
+import uuid
+import dataclasses
+# The modules only used by the import (requests, tqdm, transfer_generator) are imported where they are used,
+# so that opening a database for the interface or the command line stays fast
+
+GTFS_CACHE_DIR = "gtfs_cache"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+IMPORT_BATCH_SIZE = 10000
+GTFS_SHARD_DIR = "gtfs_shards"
+SCHEMA_VERSION = 2
+# Integer keys of stops and trips are (source index << FEED_KEY_BITS) + row number, so they are unique across sources
+FEED_KEY_BITS = 32
+SURROGATE_KEYS = {"stops": ("stop_id", "stop_idx"), "trips": ("trip_id", "trip_idx")}
+
+# Import profiles: "full" keeps every column in the tables, the other ones keep only the HOT_COLUMNS in the tables,
+# and store the other non-empty values of the "attributes" tables in key/value side tables, or drop them.
+# The attributes of stop_times are mostly dense (shape_dist_traveled, timepoint...), they are dropped by "compact"
+IMPORT_PROFILES = {
+    "full": {"prune": False, "attributes": ()},
+    "compact": {"prune": True, "attributes": ("stops", "trips")},
+    "routing": {"prune": True, "attributes": ()},
+}
+DEFAULT_IMPORT_PROFILE = "compact"
+# Longest walk, in seconds, of the footpaths built by chaining walking edges (see TransferGenerator.close_footpaths)
+DEFAULT_MAX_FOOTPATH_SEC = 900
+# Pooled read-only connections, see Database.read_connection
+READ_POOL_SIZE = 8
+READ_CACHED_STATEMENTS = 256
+READ_PRAGMAS = {
+    "query_only": "ON",
+    "cache_size": "-65536",  # 64 MB
+    "mmap_size": str(256 * 1024 * 1024),
+    "temp_store": "MEMORY",
+    # Readers wait for the commit of a refresh instead of failing (see Database.transaction)
+    "busy_timeout": "60000",
+}
+# Tables read into the page cache by Database.warm_up, the stop times are too large to be read at startup
+WARM_UP_TABLES = (
+    "stops",
+    "trips",
+    "routes",
+    "calendar",
+    "calendar_dates",
+    "transfers",
+    "footpaths",
+    "stop_index",
+    "stop_search",
+)
+HOT_COLUMNS = {
+    "stops": {
+        "stop_id",
+        "stop_code",
+        "stop_name",
+        "stop_lat",
+        "stop_lon",
+        "location_type",
+        "parent_station",
+        "stop_timezone",
+        "platform_code",
+        "stop_idx",
+    },
+    "trips": {
+        "trip_id",
+        "route_id",
+        "service_id",
+        "trip_headsign",
+        "trip_short_name",
+        "direction_id",
+        "shape_id",
+        "route_short_name",
+        "trip_idx",
+    },
+    "stop_times_v2": {
+        "trip_idx",
+        "arrival_time",
+        "departure_time",
+        "stop_idx",
+        "stop_sequence",
+        "pickup_type",
+        "drop_off_type",
+    },
+}
+# Side table and key columns of the attributes of the HOT_COLUMNS tables
+ATTRIBUTE_TABLES = {
+    "stops": ("stops_attributes", ("stop_id",)),
+    "trips": ("trips_attributes", ("trip_id",)),
+    "stop_times_v2": ("stop_times_attributes", ("trip_idx", "stop_sequence")),
+}
+
+# Other names of a stop, indexed by the stop search with its name (see build_stop_search_index)
+STOP_ALIAS_COLUMNS = (
+    "alias",
+    "tts_stop_name",
+    "ch_station_long_name",
+    "ch_station_synonym1",
+    "ch_station_synonym2",
+    "ch_station_synonym3",
+    "ch_station_synonym4",
+)
+
+# Column holding the prefixed ID of each table, used to find the rows of a source
+FEED_KEY_COLUMNS = {
+    "agency": "agency_id",
+    "stops": "stop_id",
+    "routes": "route_id",
+    "trips": "trip_id",
+    "calendar": "service_id",
+    "calendar_dates": "service_id",
+    "shapes": "shape_id",
+    "feed_info": "feed_id",
+}
+
+
+class Connection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        """
+        SQLite connection with a state dict, in which its users keep what they know about it
+        (e.g. the temporary tables they created on it). The state lives and dies with the connection,
+        so it always matches the database file the connection reads.
+        """
+        super().__init__(*args, **kwargs)
+        self.state = {}
+
+
+class TransactionConnection:
+    def __init__(self, conn: Connection):
+        """
+        Connection given by Database.get_connection during Database.transaction.
+        Everything is forwarded to the connection of the transaction, except commit and close,
+        which are left to the end of the transaction.
+        """
+        self.conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
 
 
 class Database:
     def __init__(self, db_name="railfinder.db"):
         self.db_name = db_name
+        # Idle read-only connections, with the identity of the file they were opened on
+        self.read_pool = queue.LifoQueue(maxsize=READ_POOL_SIZE)
+        self.read_pool_file = None
+        self.read_pool_lock = threading.Lock()
+        self.read_connections_opened = 0
+        # Columns of each table of the file the pooled connections read, see get_table_columns
+        self.table_columns = {}
+        # Connection of the running transaction, see transaction
+        self.write_connection = None
 
     def reset_database(self):
         """
         Reset the database by deleting the existing file and creating a new one.
         """
+        self.close_read_connections()
         if os.path.exists(self.db_name):
             os.remove(self.db_name)
 
     def create_metadata_table(self):
         """
         Create a metadata table to store information about the database,
-        such as the last update time.
+        such as the last update time, a feed_metadata table to track the import of each source,
+        and an import_runs table storing the report of each import (see ImportReport).
         """
         conn = sqlite3.connect(self.db_name)
         cursor = conn.cursor()
@@ -38,6 +208,31 @@ class Database:
             )
             """
         )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS feed_metadata (
+                id INTEGER PRIMARY KEY,
+                name TEXT,
+                url TEXT,
+                content_hash TEXT,
+                etag TEXT,
+                imported_at TEXT
+            )
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS import_runs (
+                id INTEGER PRIMARY KEY,
+                started_at TEXT,
+                kind TEXT,
+                seconds REAL,
+                feeds INTEGER,
+                failed_feeds INTEGER,
+                report TEXT
+            )
+            """
+        )
         conn.commit()
         conn.close()
 
@@ -56,8 +251,7 @@ class Database:
     value : str
         The value to associate with the given key.
     """
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
+        conn, cursor = self.get_connection()
         cursor.execute(
             "INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)", (key, value)
         )
@@ -78,28 +272,30 @@ class Database:
             The value associated with the given key, or None if the key does not exist.
 
         """
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        # has the metadata table been created?
-        cursor.execute(
-            "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='metadata'"
-        )
-        row = cursor.fetchone()
-        if row[0] == 0:
-            conn.close()
+        if not os.path.exists(self.db_name):
             return None
-        cursor.execute("SELECT value FROM metadata WHERE key = ?", (key,))
-        row = cursor.fetchone()
-        conn.close()
+        with self.read_connection() as cursor:
+            try:
+                cursor.execute("SELECT value FROM metadata WHERE key = ?", (key,))
+            except sqlite3.OperationalError:
+                # the metadata table has not been created yet
+                return None
+            row = cursor.fetchone()
         return row[0] if row else None
 
-    def create_gtfs_tables(self):
+    def create_gtfs_tables(self, profile: str = DEFAULT_IMPORT_PROFILE):
         """
         Create the necessary GTFS tables in the SQLite database.
         This method creates tables for agency, stops, routes, trips, stop_times, calendar,
         calendar_dates, shapes, transfers, and feed_info.
         Each table is created with the appropriate schema based on the GTFS specification.
+        Depending on the import profile, the stops, trips and stop_times tables only have their HOT_COLUMNS,
+        and the key/value side tables of their other columns are created (see IMPORT_PROFILES).
         """
+        if profile not in IMPORT_PROFILES:
+            raise ValueError(
+                f"Unknown import profile {profile}, expected one of {list(IMPORT_PROFILES)}"
+            )
         conn = sqlite3.connect(self.db_name)
         cursor = conn.cursor()
 
@@ -200,15 +396,17 @@ class Database:
                     mta_trip_id TEXT,
                     boarding_type INTEGER,
                     attributes_ch TEXT,
-                    realtime_trip_id TEXT
+                    realtime_trip_id TEXT,
+                    trip_idx INTEGER
                 )
             """,
-            "stop_times": """
-                CREATE TABLE IF NOT EXISTS stop_times (
-                    trip_id TEXT NOT NULL,
+            # stop_times is stored with the integer keys of its trip and stop, and exposed with the GTFS IDs by a view
+            "stop_times_v2": """
+                CREATE TABLE IF NOT EXISTS stop_times_v2 (
+                    trip_idx INTEGER NOT NULL,
                     arrival_time TEXT NOT NULL,
                     departure_time TEXT NOT NULL,
-                    stop_id TEXT NOT NULL,
+                    stop_idx INTEGER NOT NULL,
                     stop_sequence INTEGER NOT NULL,
                     stop_headsign TEXT,
                     pickup_type INTEGER,
@@ -229,8 +427,8 @@ class Database:
                     continuous_drop_off INTEGER,
                     attributes_ch TEXT,
                     fare_units_traveled INTEGER,
-                    PRIMARY KEY (trip_id, stop_id, stop_sequence)
-                )
+                    PRIMARY KEY (trip_idx, stop_sequence, stop_idx)
+                ) WITHOUT ROWID
             """,
             "calendar": """
                 CREATE TABLE IF NOT EXISTS calendar (
@@ -297,72 +495,348 @@ class Database:
         }
 
         for table_name, create_statement in gtfs_tables.items():
+            if IMPORT_PROFILES[profile]["prune"] and table_name in HOT_COLUMNS:
+                create_statement = self.prune_columns(
+                    create_statement, HOT_COLUMNS[table_name]
+                )
             cursor.execute(create_statement)
 
+        for table_name in IMPORT_PROFILES[profile]["attributes"]:
+            attributes_table, key_columns = ATTRIBUTE_TABLES[table_name]
+            cursor.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {attributes_table} (
+                    {", ".join(key_columns)},
+                    name TEXT NOT NULL,
+                    value TEXT,
+                    PRIMARY KEY ({", ".join(key_columns)}, name)
+                ) WITHOUT ROWID
+                """
+            )
+
+        # stop_times exposes the columns of stop_times_v2 with the GTFS IDs of the trips and stops
+        cursor.execute("PRAGMA table_info(stop_times_v2)")
+        view_columns = {"trip_idx": "trips.trip_id", "stop_idx": "stops.stop_id"}
+        columns = [
+            view_columns.get(row[1], f"st.{row[1]}") for row in cursor.fetchall()
+        ]
+        cursor.execute(
+            f"""
+            CREATE VIEW IF NOT EXISTS stop_times AS
+            SELECT {", ".join(columns)}
+            FROM stop_times_v2 AS st
+            JOIN trips ON trips.trip_idx = st.trip_idx
+            JOIN stops ON stops.stop_idx = st.stop_idx
+            """
+        )
+
         conn.commit()
         conn.close()
 
-    def download_gtfs(self, url):
+    def prune_columns(self, create_statement: str, columns: set[str]) -> str:
+        """
+        Remove the definitions of the columns that are not in columns from a CREATE TABLE statement,
+        written with one column definition per line.
+        """
+        lines = create_statement.strip().split("\n")
+        definitions = [
+            line.strip().rstrip(",")
+            for line in lines[1:-1]
+            if line.split()[0] in columns or line.split()[0] == "PRIMARY"
+        ]
+        return "\n".join([lines[0], ",\n".join(definitions), lines[-1]])
+
+    def download_gtfs(
+        self, url: str, cache_dir: str = GTFS_CACHE_DIR, stats: Optional[dict] = None
+    ) -> str:
         """
-        Download GTFS data from the given URL and return a BytesIO object containing the ZIP file.
+        Download GTFS data from the given URL to the local cache directory and return the path of the ZIP file.
+        The file is streamed to disk in chunks, so large feeds are never held in memory.
+        Conditional requests (ETag / Last-Modified) are used to skip unchanged feeds,
+        and an interrupted download is resumed from its partial file with a Range request.
         Parameters
         ----------
         url : str
             The URL to download the GTFS ZIP file from.
+        cache_dir : str
+            The directory where downloaded feeds are kept between updates.
+        stats : dict, optional
+            If given, filled with the HTTP status, the number of bytes downloaded and the download time in seconds.
         Returns
         -------
-        io.BytesIO
-            A BytesIO object containing the downloaded GTFS ZIP file.
+        str
+            The path of the downloaded (or still up-to-date cached) GTFS ZIP file.
         Raises
         ------
         Exception
-            If the download fails or the response status code is not 200.
+            If the download fails or the response status code is not 200, 206 or 304.
         """
-        # Download the GTFS ZIP file
-        response = requests.get(url)
-        if response.status_code == 200:
-            # Use BytesIO to handle the ZIP file in memory
-            return io.BytesIO(response.content)
-        else:
-            raise Exception(
-                f"Failed to download GTFS data. HTTP status code: {response.status_code}"
+        start_time = time.perf_counter()
+        if stats is None:
+            stats = {}
+        stats.update({"status": None, "bytes": 0, "seconds": 0.0})
+        os.makedirs(cache_dir, exist_ok=True)
+        zip_path, part_path, headers_path = self.get_cache_paths(url, cache_dir)
+
+        cached_headers = {}
+        if os.path.exists(headers_path):
+            with open(headers_path, "r") as file:
+                cached_headers = json.load(file)
+
+        request_headers = {}
+        resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if resume_from and cached_headers.get("etag"):
+            # Only resume if the partial file is from the same version of the feed
+            request_headers["Range"] = f"bytes={resume_from}-"
+            request_headers["If-Range"] = cached_headers["etag"]
+        elif os.path.exists(zip_path):
+            if cached_headers.get("etag"):
+                request_headers["If-None-Match"] = cached_headers["etag"]
+            if cached_headers.get("last_modified"):
+                request_headers["If-Modified-Since"] = cached_headers["last_modified"]
+
+        import requests
+
+        with requests.get(
+            url, headers=request_headers, stream=True, timeout=60
+        ) as response:
+            stats["status"] = response.status_code
+            if response.status_code == 304:
+                stats["seconds"] = time.perf_counter() - start_time
+                return zip_path
+            if response.status_code not in (200, 206):
+                raise Exception(
+                    f"Failed to download GTFS data. HTTP status code: {response.status_code}"
+                )
+            cached_headers = {
+                "url": url,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+            with open(headers_path, "w") as file:
+                json.dump(cached_headers, file)
+            mode = "ab" if response.status_code == 206 else "wb"
+            with open(part_path, mode) as file:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    file.write(chunk)
+                    stats["bytes"] += len(chunk)
+        os.replace(part_path, zip_path)
+        stats["seconds"] = time.perf_counter() - start_time
+        return zip_path
+
+    def get_cache_paths(self, url: str, cache_dir: str = GTFS_CACHE_DIR):
+        """
+        Get the paths of the cached ZIP file, of its partial download and of its saved HTTP headers for a source URL.
+        """
+        name = hashlib.sha1(url.encode()).hexdigest()[:16]
+        zip_path = os.path.join(cache_dir, f"{name}.zip")
+        return zip_path, zip_path + ".part", os.path.join(cache_dir, f"{name}.json")
+
+    def get_file_hash(self, path: str) -> str:
+        """
+        Compute the SHA-256 hash of a file, reading it in chunks.
+        """
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b""):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def get_feed_metadata(self, id: int) -> Optional[tuple]:
+        """
+        Get the tracking information of an imported source: (name, url, content_hash, etag, imported_at), or None.
+        """
+        conn, cursor = self.get_connection()
+        cursor.execute(
+            "SELECT name, url, content_hash, etag, imported_at FROM feed_metadata WHERE id = ?",
+            (id,),
+        )
+        row = cursor.fetchone()
+        conn.close()
+        return row
+
+    def get_source_ids(self, data_sources: dict) -> dict[str, int]:
+        """
+        Get the index of each source of data_sources (name -> url), used to prefix its IDs.
+        A source keeps the index it was imported with, matched by its name in feed_metadata, or by its URL
+        if it has been renamed, so that removing or reordering sources does not change the index of the others.
+        New sources get the lowest indexes not used by a source of feed_metadata.
+        """
+        conn, cursor = self.get_connection()
+        cursor.execute("SELECT id, name, url FROM feed_metadata")
+        imported = cursor.fetchall()
+        conn.close()
+        by_name = {name: id for id, name, _ in imported}
+        by_url = {url: id for id, _, url in imported}
+        ids = {}
+        used = set()
+        for name, url in data_sources.items():
+            id = by_name.get(name)
+            if id is None or id in used:
+                id = by_url.get(url)
+            if id is not None and id not in used:
+                ids[name] = id
+                used.add(id)
+        reserved = used | {id for id, _, _ in imported}
+        next_id = 0
+        for name in data_sources:
+            if name in ids:
+                continue
+            while next_id in reserved:
+                next_id += 1
+            ids[name] = next_id
+            reserved.add(next_id)
+        return ids
+
+    def set_feed_metadata(
+        self, id: int, name: str, url: str, content_hash: str, zip_path: str
+    ):
+        """
+        Record the import of a source, with the content hash and the ETag of the imported file.
+        """
+        etag = None
+        headers_path = self.get_cache_paths(url, os.path.dirname(zip_path))[2]
+        if os.path.exists(headers_path):
+            with open(headers_path, "r") as file:
+                etag = json.load(file).get("etag")
+        conn, cursor = self.get_connection()
+        cursor.execute(
+            "INSERT OR REPLACE INTO feed_metadata (id, name, url, content_hash, etag, imported_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                id,
+                name,
+                url,
+                content_hash,
+                etag,
+                datetime.datetime.now().isoformat(),
+            ),
+        )
+        conn.commit()
+        conn.close()
+
+    def delete_feed(self, id: int):
+        """
+        Delete all the rows imported from a source, using the prefix of its IDs,
+        including the generated transfers touching its stops and the footpaths of the stops walking to them.
+        """
+        # "/" is followed by "0" in ASCII, so the prefixed IDs are exactly the ones in [prefix, upper)
+        prefix = f"{id:02}/"
+        upper = f"{id:02}0"
+        conn, cursor = self.get_connection()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        tables = {row[0] for row in cursor.fetchall()}
+        feed_stop_idx = "SELECT stop_idx FROM stops WHERE stop_id >= ? AND stop_id < ?"
+        if "footpaths" in tables:
+            # The closed footpaths of a stop walking to the source can go through its stops, so they are all deleted,
+            # TransferGenerator.update_footpaths then computes again the footpaths of the stops left without any
+            cursor.execute(
+                f"""
+                DELETE FROM footpaths
+                WHERE from_stop_idx IN ({feed_stop_idx})
+                OR from_stop_idx IN (
+                    SELECT from_stop_idx FROM footpaths WHERE to_stop_idx IN ({feed_stop_idx})
+                )
+                """,
+                (prefix, upper, prefix, upper),
+            )
+        if "stop_index" in tables:
+            cursor.execute(
+                f"DELETE FROM stop_index WHERE id IN ({feed_stop_idx})", (prefix, upper)
+            )
+        cursor.execute(
+            """
+            DELETE FROM transfers
+            WHERE (from_stop_id >= ? AND from_stop_id < ?) OR (to_stop_id >= ? AND to_stop_id < ?)
+            """,
+            (prefix, upper, prefix, upper),
+        )
+        cursor.execute(
+            "DELETE FROM stop_times_v2 WHERE trip_idx >= ? AND trip_idx < ?",
+            (id << FEED_KEY_BITS, (id + 1) << FEED_KEY_BITS),
+        )
+        if "stop_times_attributes" in tables:
+            cursor.execute(
+                "DELETE FROM stop_times_attributes WHERE trip_idx >= ? AND trip_idx < ?",
+                (id << FEED_KEY_BITS, (id + 1) << FEED_KEY_BITS),
             )
+        for table_name in ("stops_attributes", "trips_attributes"):
+            if table_name in tables:
+                column = ATTRIBUTE_TABLES[table_name.removesuffix("_attributes")][1][0]
+                cursor.execute(
+                    f"DELETE FROM {table_name} WHERE {column} >= ? AND {column} < ?",
+                    (prefix, upper),
+                )
+        for table_name, column in FEED_KEY_COLUMNS.items():
+            cursor.execute(
+                f"DELETE FROM {table_name} WHERE {column} >= ? AND {column} < ?",
+                (prefix, upper),
+            )
+        cursor.execute("DELETE FROM feed_metadata WHERE id = ?", (id,))
+        conn.commit()
+        conn.close()
 
-    def populate_database(self, zip_buffer, id: int):
+    def populate_database(
+        self,
+        zip_buffer,
+        id: int,
+        window_days: Optional[int] = None,
+        region: Optional[ImportRegion] = None,
+    ) -> dict:
         """
         Populate the SQLite database with GTFS data from the given ZIP file.
         This method reads the GTFS files from the ZIP, creates tables if they do not exist,
         and inserts the data into the corresponding tables.
+        Rows are read with a plain csv.reader and inserted in batches with executemany, one transaction per file,
+        with journaling and synchronous writes disabled during the import.
         Parameters
         ----------
-        zip_buffer : io.BytesIO
-            A BytesIO object containing the GTFS ZIP file.
+        zip_buffer : str or io.BytesIO
+            The path of the GTFS ZIP file, or a BytesIO object containing it.
         id : int
             An identifier used to prefix IDs in the GTFS data, useful for distinguishing between different data sources.
+        window_days : int, optional
+            If given, only the trips running in the next window_days days (and their shapes) are imported,
+            and the stops that none of them serves are removed.
+        region : ImportRegion, optional
+            If given, only the trips stopping inside the region are imported (clipped to it depending on the region),
+            and the stops that none of them serves are removed.
+        Returns
+        -------
+        dict
+            The import statistics of each table: {table_name: {"rows": int, "seconds": float}}
         Raises
         ------
             ValueError
             If a CSV file in the GTFS data has no header or is improperly formatted.
         """
-        # Connect to the database
-        conn = sqlite3.connect(self.db_name)
+        # Connect to the database, transactions are handled explicitly
+        conn = sqlite3.connect(self.db_name, isolation_level=None)
         cursor = conn.cursor()
+        # Import-time settings: the database is rebuilt from scratch if the import fails anyway
+        cursor.execute("PRAGMA journal_mode = OFF")
+        cursor.execute("PRAGMA synchronous = OFF")
+        cursor.execute("PRAGMA cache_size = -262144")  # 256 MB
+        cursor.execute("PRAGMA temp_store = MEMORY")
 
         # Map GTFS files to their corresponding tables
         gtfs_files = {
             "agency.txt": "agency",
             "stops.txt": "stops",
             "routes.txt": "routes",
-            "trips.txt": "trips",
-            "stop_times.txt": "stop_times",
+            # calendars are imported before the trips, to filter them with the service window
             "calendar.txt": "calendar",
             "calendar_dates.txt": "calendar_dates",
+            "trips.txt": "trips",
+            "stop_times.txt": "stop_times",
             "shapes.txt": "shapes",
             "transfers.txt": "transfers",
             "feed_info.txt": "feed_info",
         }
+        prefix = f"{id:02}/"
+        stats = {}
+        region_stops = set()
 
-        # Open the ZIP file in memory
+        # Open the ZIP file
         with zipfile.ZipFile(zip_buffer, "r") as zip_ref:
             # Iterate over GTFS files and insert data into tables
             for file_name, table_name in gtfs_files.items():
@@ -370,132 +844,1212 @@ class Database:
                     with zip_ref.open(file_name) as file:
                         # Use TextIOWrapper to read the file as text
                         with io.TextIOWrapper(file, encoding="utf-8-sig") as f:
-                            reader = csv.DictReader(f)
-                            columns = reader.fieldnames
-                            if columns is None:
+                            reader = csv.reader(f)
+                            columns = next(reader, None)
+                            if not columns:
                                 raise ValueError(
                                     f"CSV file {file_name} has no header or is improperly formatted."
                                 )
-                            placeholders = ", ".join(["?"] * len(columns))
-                            insert_query = f"INSERT OR IGNORE INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})"
-                            should_prefix_columns = [
-                                True if col.endswith("_id") else False
-                                for col in columns
-                            ]
-
-                            for row in reader:
-                                values = [row[col] for col in columns]
-                                if should_prefix_columns:
-                                    values = [
-                                        f"{id:02}/{val}" if prefix else val
-                                        for val, prefix in zip(
-                                            values, should_prefix_columns
-                                        )
-                                    ]
-                                cursor.execute(insert_query, values)
-
-        # Commit and close the connection
-        conn.commit()
+                            start_time = time.perf_counter()
+                            if table_name == "trips" and window_days is not None:
+                                active_services = self.get_active_services(
+                                    cursor, prefix, window_days
+                                )
+                                reader = self.filter_rows(
+                                    reader, columns, "service_id", prefix, active_services
+                                )
+                            if table_name == "trips" and region is not None:
+                                region_trips = self.get_region_trips(
+                                    zip_ref, prefix, region_stops
+                                )
+                                reader = self.filter_rows(
+                                    reader, columns, "trip_id", prefix, region_trips
+                                )
+                            if (
+                                table_name == "stop_times"
+                                and region is not None
+                                and region.trips == "clip"
+                            ):
+                                reader = self.filter_rows(
+                                    reader, columns, "stop_id", prefix, region_stops
+                                )
+                            if table_name == "shapes" and (
+                                window_days is not None or region is not None
+                            ):
+                                reader = self.filter_rows(
+                                    reader,
+                                    columns,
+                                    "shape_id",
+                                    prefix,
+                                    self.get_trip_shapes(cursor, prefix),
+                                )
+                            if table_name == "stop_times":
+                                rows = self.insert_stop_times(
+                                    cursor, columns, reader, prefix
+                                )
+                            else:
+                                rows = self.insert_rows(
+                                    cursor, table_name, columns, reader, prefix
+                                )
+                            if table_name in SURROGATE_KEYS:
+                                self.assign_surrogate_keys(cursor, table_name, id)
+                            if table_name == "stops" and region is not None:
+                                region_stops = self.get_region_stops(
+                                    cursor, prefix, region
+                                )
+                            seconds = time.perf_counter() - start_time
+                            stats[table_name] = {"rows": rows, "seconds": seconds}
+                            print(
+                                f"  {table_name}: {rows} rows in {seconds:.1f}s "
+                                f"({rows / seconds if seconds else 0:.0f} rows/s)"
+                            )
+
+        if window_days is not None or region is not None:
+            removed = self.prune_unused_rows(cursor, id)
+            print(
+                f"  removed {removed['stops']} unused stops and {removed['services']} unused services"
+            )
         conn.close()
+        return stats
+
+    def get_active_services(
+        self, cursor: sqlite3.Cursor, prefix: str, window_days: int
+    ) -> set[str]:
+        """
+        Get the service IDs of a source that run at least once in the service window,
+        from yesterday (for the trips running after midnight) to window_days days from today.
+        """
+        today = datetime.date.today()
+        dates = [
+            (today + datetime.timedelta(days=day)).strftime("%Y%m%d")
+            for day in range(-1, window_days)
+        ]
+        weekdays = [
+            (today + datetime.timedelta(days=day)).weekday()
+            for day in range(-1, window_days)
+        ]
+        upper = prefix[:-1] + "0"
+        cursor.execute(
+            """
+            SELECT service_id, date, exception_type FROM calendar_dates
+            WHERE service_id >= ? AND service_id < ? AND date BETWEEN ? AND ?
+            """,
+            (prefix, upper, dates[0], dates[-1]),
+        )
+        active = set()
+        removed = set()
+        for service_id, date, exception_type in cursor.fetchall():
+            if int(exception_type) == 1:
+                active.add(service_id)
+            else:
+                removed.add((service_id, str(date)))
+        cursor.execute(
+            """
+            SELECT service_id, monday, tuesday, wednesday, thursday, friday, saturday, sunday, start_date, end_date
+            FROM calendar WHERE service_id >= ? AND service_id < ?
+            """,
+            (prefix, upper),
+        )
+        for service_id, *days, start_date, end_date in cursor.fetchall():
+            for date, weekday in zip(dates, weekdays):
+                if (
+                    str(start_date) <= date <= str(end_date)
+                    and int(days[weekday]) == 1
+                    and (service_id, date) not in removed
+                ):
+                    active.add(service_id)
+                    break
+        return active
+
+    def filter_rows(self, reader, columns: list[str], column: str, prefix: str, kept: set):
+        """
+        Filter the rows of a GTFS file to the ones whose (prefixed) value of column is in kept.
+        """
+        i = columns.index(column)
+        return (row for row in reader if len(row) > i and prefix + row[i] in kept)
+
+    def get_trip_shapes(self, cursor: sqlite3.Cursor, prefix: str) -> set[str]:
+        """
+        Get the shape IDs used by the imported trips of a source.
+        """
+        cursor.execute(
+            "SELECT DISTINCT shape_id FROM trips WHERE trip_id >= ? AND trip_id < ?",
+            (prefix, prefix[:-1] + "0"),
+        )
+        return {row[0] for row in cursor.fetchall()}
+
+    def get_region_stops(
+        self, cursor: sqlite3.Cursor, prefix: str, region: ImportRegion
+    ) -> set[str]:
+        """
+        Get the IDs of the imported stops of a source located inside the region.
+        """
+        cursor.execute(
+            "SELECT stop_id, stop_lat, stop_lon FROM stops WHERE stop_id >= ? AND stop_id < ?",
+            (prefix, prefix[:-1] + "0"),
+        )
+        return {
+            stop_id
+            for stop_id, stop_lat, stop_lon in cursor.fetchall()
+            if region.contains(stop_lat, stop_lon)
+        }
+
+    def get_region_trips(
+        self, zip_ref: zipfile.ZipFile, prefix: str, region_stops: set[str]
+    ) -> set[str]:
+        """
+        Get the IDs of the trips of a source stopping at least once at one of region_stops,
+        with a first pass on its stop_times.txt file.
+        """
+        if "stop_times.txt" not in zip_ref.namelist():
+            return set()
+        region_trips = set()
+        with zip_ref.open("stop_times.txt") as file:
+            with io.TextIOWrapper(file, encoding="utf-8-sig") as f:
+                reader = csv.reader(f)
+                columns = next(reader, None) or []
+                trip_i = columns.index("trip_id")
+                stop_i = columns.index("stop_id")
+                for row in reader:
+                    if len(row) > max(trip_i, stop_i) and prefix + row[stop_i] in region_stops:
+                        region_trips.add(prefix + row[trip_i])
+        return region_trips
+
+    def prune_unused_rows(self, cursor: sqlite3.Cursor, id: int) -> dict:
+        """
+        Remove the stops of a source that none of its trips serves (keeping the parent stations of the served ones),
+        with their transfers and attributes, and its services that no trip uses.
+        Returns the number of removed stops and services.
+        """
+        prefix = f"{id:02}/"
+        upper = f"{id:02}0"
+        cursor.execute("BEGIN")
+        cursor.execute("DROP TABLE IF EXISTS temp.used_stops")
+        cursor.execute(
+            """
+            CREATE TEMP TABLE used_stops AS
+            SELECT DISTINCT stop_idx FROM stop_times_v2 WHERE trip_idx >= ? AND trip_idx < ?
+            """,
+            (id << FEED_KEY_BITS, (id + 1) << FEED_KEY_BITS),
+        )
+        # parent_station is not prefixed
+        cursor.execute(
+            """
+            INSERT INTO used_stops
+            SELECT stop_idx FROM stops WHERE stop_id IN (
+                SELECT ? || parent_station FROM stops
+                WHERE stop_idx IN used_stops AND parent_station != ''
+            )
+            """,
+            (prefix,),
+        )
+        cursor.execute(
+            "DELETE FROM stops WHERE stop_id >= ? AND stop_id < ? AND stop_idx NOT IN used_stops",
+            (prefix, upper),
+        )
+        removed = {"stops": cursor.rowcount}
+        cursor.execute("DROP TABLE temp.used_stops")
+        feed_stops = "SELECT stop_id FROM stops WHERE stop_id >= ? AND stop_id < ?"
+        cursor.execute(
+            f"""
+            DELETE FROM transfers WHERE from_stop_id >= ? AND from_stop_id < ?
+            AND (from_stop_id NOT IN ({feed_stops}) OR to_stop_id NOT IN ({feed_stops}))
+            """,
+            (prefix, upper, prefix, upper, prefix, upper),
+        )
+        cursor.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='stops_attributes'"
+        )
+        if cursor.fetchone()[0] > 0:
+            cursor.execute(
+                f"DELETE FROM stops_attributes WHERE stop_id >= ? AND stop_id < ? AND stop_id NOT IN ({feed_stops})",
+                (prefix, upper, prefix, upper),
+            )
+        feed_services = "SELECT service_id FROM trips WHERE trip_id >= ? AND trip_id < ?"
+        cursor.execute(
+            f"DELETE FROM calendar WHERE service_id >= ? AND service_id < ? AND service_id NOT IN ({feed_services})",
+            (prefix, upper, prefix, upper),
+        )
+        removed["services"] = cursor.rowcount
+        cursor.execute(
+            f"DELETE FROM calendar_dates WHERE service_id >= ? AND service_id < ? AND service_id NOT IN ({feed_services})",
+            (prefix, upper, prefix, upper),
+        )
+        cursor.execute("COMMIT")
+        return removed
+
+    def insert_rows(
+        self,
+        cursor: sqlite3.Cursor,
+        table_name: str,
+        columns: list[str],
+        reader,
+        prefix: str,
+    ) -> int:
+        """
+        Insert the rows of a GTFS file into its table, in batches of IMPORT_BATCH_SIZE rows inside a single transaction.
+        The values of the columns ending with _id are prefixed with the source prefix.
+        The non-empty values of the columns that are not in the table are stored in its side table of ATTRIBUTE_TABLES
+        if it exists, the other ones are dropped.
+        Returns the number of rows read.
+        """
+        n_columns = len(columns)
+        prefixed_columns = [i for i, col in enumerate(columns) if col.endswith("_id")]
+        cursor.execute(f"PRAGMA table_info({table_name})")
+        table_columns = {row[1] for row in cursor.fetchall()}
+        kept_columns = [i for i, col in enumerate(columns) if col in table_columns]
+        other_columns = [i for i, col in enumerate(columns) if col not in table_columns]
+        placeholders = ", ".join(["?"] * len(kept_columns))
+        insert_query = f"INSERT OR IGNORE INTO {table_name} ({', '.join(columns[i] for i in kept_columns)}) VALUES ({placeholders})"
+
+        attributes_query = None
+        if other_columns and table_name in ATTRIBUTE_TABLES:
+            attributes_table, key_columns = ATTRIBUTE_TABLES[table_name]
+            cursor.execute(
+                "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name=?",
+                (attributes_table,),
+            )
+            if cursor.fetchone()[0] > 0 and all(
+                column in columns for column in key_columns
+            ):
+                key_indexes = [columns.index(column) for column in key_columns]
+                placeholders = ", ".join(["?"] * (len(key_columns) + 2))
+                attributes_query = f"INSERT OR IGNORE INTO {attributes_table} VALUES ({placeholders})"
+
+        rows = 0
+        batch = []
+        attributes = []
+        cursor.execute("BEGIN")
+        for row in reader:
+            if not row:
+                continue
+            if len(row) != n_columns:
+                # Missing values are NULL, extra values are ignored
+                row = (row + [None] * n_columns)[:n_columns]
+            for i in prefixed_columns:
+                if row[i] is not None:
+                    row[i] = prefix + row[i]
+            if other_columns:
+                if attributes_query:
+                    key = [row[i] for i in key_indexes]
+                    for i in other_columns:
+                        if row[i]:
+                            attributes.append((*key, columns[i], row[i]))
+                row = [row[i] for i in kept_columns]
+            batch.append(row)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                cursor.executemany(insert_query, batch)
+                rows += len(batch)
+                batch = []
+                if attributes:
+                    cursor.executemany(attributes_query, attributes)
+                    attributes = []
+        if batch:
+            cursor.executemany(insert_query, batch)
+            rows += len(batch)
+        if attributes:
+            cursor.executemany(attributes_query, attributes)
+        cursor.execute("COMMIT")
+        return rows
+
+    def assign_surrogate_keys(self, cursor: sqlite3.Cursor, table_name: str, id: int):
+        """
+        Give an integer key to the rows of a source that do not have one yet in a table of SURROGATE_KEYS.
+        """
+        id_column, key_column = SURROGATE_KEYS[table_name]
+        cursor.execute(
+            f"""
+            UPDATE {table_name} SET {key_column} = ? + rowid
+            WHERE {id_column} >= ? AND {id_column} < ? AND {key_column} IS NULL
+            """,
+            (id << FEED_KEY_BITS, f"{id:02}/", f"{id:02}0"),
+        )
+
+    def insert_stop_times(
+        self, cursor: sqlite3.Cursor, columns: list[str], reader, prefix: str
+    ) -> int:
+        """
+        Insert the rows of stop_times.txt into stop_times_v2, replacing the trip and stop IDs by their integer keys.
+        The trips and stops of the source must already be imported, rows referencing unknown ones are ignored.
+        Returns the number of rows read.
+        """
+        key_maps = {}
+        for table_name, (id_column, key_column) in SURROGATE_KEYS.items():
+            cursor.execute(
+                f"SELECT {id_column}, {key_column} FROM {table_name} WHERE {id_column} >= ? AND {id_column} < ?",
+                (prefix, prefix[:-1] + "0"),
+            )
+            key_maps[columns.index(id_column)] = dict(cursor.fetchall())
+
+        def keyed_rows():
+            for row in reader:
+                try:
+                    keys = [
+                        (i, key_map[prefix + row[i]]) for i, key_map in key_maps.items()
+                    ]
+                except (IndexError, KeyError):
+                    continue
+                for i, key in keys:
+                    row[i] = key
+                yield row
+
+        key_columns = {
+            id_column: key_column for id_column, key_column in SURROGATE_KEYS.values()
+        }
+        columns = [key_columns.get(column, column) for column in columns]
+        return self.insert_rows(cursor, "stop_times_v2", columns, keyed_rows(), prefix)
+
+    def get_stop_idx(self, stop_id: str) -> Optional[int]:
+        """
+        Get the integer key of a stop from its prefixed GTFS ID.
+        """
+        return self.get_surrogate_key("stops", stop_id)
+
+    def get_stop_id(self, stop_idx: int) -> Optional[str]:
+        """
+        Get the prefixed GTFS ID of a stop from its integer key.
+        """
+        return self.get_surrogate_id("stops", stop_idx)
+
+    def get_trip_idx(self, trip_id: str) -> Optional[int]:
+        """
+        Get the integer key of a trip from its prefixed GTFS ID.
+        """
+        return self.get_surrogate_key("trips", trip_id)
+
+    def get_trip_id(self, trip_idx: int) -> Optional[str]:
+        """
+        Get the prefixed GTFS ID of a trip from its integer key.
+        """
+        return self.get_surrogate_id("trips", trip_idx)
+
+    def get_feed_id(self, key: int) -> int:
+        """
+        Get the index of the source of a stop or trip from its integer key.
+        """
+        return key >> FEED_KEY_BITS
+
+    def get_surrogate_key(self, table_name: str, id: str) -> Optional[int]:
+        id_column, key_column = SURROGATE_KEYS[table_name]
+        with self.read_connection() as cursor:
+            cursor.execute(
+                f"SELECT {key_column} FROM {table_name} WHERE {id_column} = ?", (id,)
+            )
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def get_surrogate_id(self, table_name: str, key: int) -> Optional[str]:
+        id_column, key_column = SURROGATE_KEYS[table_name]
+        with self.read_connection() as cursor:
+            cursor.execute(
+                f"SELECT {id_column} FROM {table_name} WHERE {key_column} = ?", (key,)
+            )
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def get_shard_path(self, id: int, shard_dir: str = GTFS_SHARD_DIR) -> str:
+        """
+        Get the path of the shard database in which a source is imported.
+        """
+        return os.path.join(shard_dir, f"{id:02}.db")
+
+    def merge_shard(self, shard_path: str) -> dict:
+        """
+        Copy all the GTFS tables of a shard database into this database, in a single INSERT ... SELECT pass per table.
+        The columns are listed by name, so the merge does not depend on the order of the columns of the two databases.
+        Returns the number of rows merged per table.
+        """
+        if self.write_connection is not None:
+            return self.copy_shard(shard_path)
+        conn = sqlite3.connect(self.db_name, isolation_level=None)
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA synchronous = OFF")
+        cursor.execute("PRAGMA cache_size = -262144")  # 256 MB
+        cursor.execute("ATTACH DATABASE ? AS shard", (shard_path,))
+        cursor.execute("SELECT name FROM shard.sqlite_master WHERE type = 'table'")
+        shard_tables = [row[0] for row in cursor.fetchall()]
+        merged = {}
+        cursor.execute("BEGIN")
+        for table_name in shard_tables:
+            cursor.execute(f'PRAGMA shard.table_info("{table_name}")')
+            columns = ", ".join(f'"{row[1]}"' for row in cursor.fetchall())
+            cursor.execute(
+                f"INSERT INTO main.{table_name} ({columns}) SELECT {columns} FROM shard.{table_name}"
+            )
+            merged[table_name] = cursor.rowcount
+        cursor.execute("COMMIT")
+        cursor.execute("DETACH DATABASE shard")
+        conn.close()
+        return merged
+
+    def copy_shard(self, shard_path: str) -> dict:
+        """
+        Copy all the GTFS tables of a shard database into this database during a transaction, like merge_shard.
+        An attached database cannot be detached before the end of the transaction, so the rows are read
+        from the shard by another connection and streamed into this database instead.
+        Returns the number of rows merged per table.
+        """
+        conn, cursor = self.get_connection()
+        shard = sqlite3.connect(shard_path)
+        shard_tables = [
+            row[0]
+            for row in shard.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            )
+        ]
+        merged = {}
+        for table_name in shard_tables:
+            names = [
+                row[1] for row in shard.execute(f'PRAGMA table_info("{table_name}")')
+            ]
+            columns = ", ".join(f'"{name}"' for name in names)
+            cursor.executemany(
+                f"INSERT INTO main.{table_name} ({columns}) VALUES ({', '.join('?' * len(names))})",
+                shard.execute(f"SELECT {columns} FROM {table_name}"),
+            )
+            merged[table_name] = cursor.rowcount
+        shard.close()
+        conn.close()
+        return merged
 
     def download_and_populate_gtfs(self, url: str, id: int):
         """
         Download GTFS data from the given URL and populate the database.
         """
-        zip_buffer = self.download_gtfs(url)
-        self.populate_database(zip_buffer, id)
+        zip_path = self.download_gtfs(url)
+        self.populate_database(zip_path, id)
 
     def get_connection(self):
         """
         Get a connection to the database.
+        During a transaction, this is the connection of the transaction, for all threads (see transaction).
         """
-        conn = sqlite3.connect(self.db_name)
+        if self.write_connection is not None:
+            conn = TransactionConnection(self.write_connection)
+            return conn, conn.cursor()
+        conn = sqlite3.connect(self.db_name, factory=Connection)
         return conn, conn.cursor()
 
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Make all the writes of the block through get_connection in a single transaction, committed when the block exits,
+        or rolled back if it fails.
+        The changed pages are kept in memory until the commit (no cache spill), so the readers keep reading
+        the unchanged file during the whole block, and only wait for the commit itself.
+        This Database must not be used for other requests meanwhile, as they would read the uncommitted data.
+        """
+        # The commit waits for the statements being read to finish, like the readers wait for it
+        conn = sqlite3.connect(
+            self.db_name,
+            timeout=60,
+            factory=Connection,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        conn.execute("PRAGMA cache_spill = OFF")
+        conn.execute("BEGIN")
+        self.write_connection = conn
+        try:
+            yield
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            self.write_connection = None
+            conn.close()
+
+    def get_file_identity(self) -> Optional[tuple]:
+        """
+        Get the identity of the database file, which changes when it is swapped, rebuilt or written to.
+        """
+        try:
+            stat = os.stat(self.db_name)
+        except FileNotFoundError:
+            return None
+        return (stat.st_dev, stat.st_ino, stat.st_ctime_ns)
+
+    def open_read_connection(self) -> sqlite3.Connection:
+        """
+        Open a read-only connection to the database, with the READ_PRAGMAS settings.
+        It can be used by any thread, but only by one at a time.
+        """
+        conn = sqlite3.connect(
+            f"file:{self.db_name}?mode=ro",
+            uri=True,
+            check_same_thread=False,
+            cached_statements=READ_CACHED_STATEMENTS,
+            factory=Connection,
+        )
+        for pragma, value in READ_PRAGMAS.items():
+            conn.execute(f"PRAGMA {pragma} = {value}")
+        self.read_connections_opened += 1
+        return conn
+
+    @contextlib.contextmanager
+    def read_connection(self, row_factory=None):
+        """
+        Borrow a read-only connection from the pool of this database and yield a cursor on it,
+        the connection is returned to the pool when the block exits.
+        Pooled connections keep their prepared statements between uses, so short queries do not pay
+        for opening a connection and preparing their SQL again.
+        When the database file has been swapped or modified, the idle connections are closed,
+        so that a borrowed connection always reads the current file.
+        row_factory is set on the cursor, e.g. sqlite3.Row.
+        """
+        identity = self.get_file_identity()
+        with self.read_pool_lock:
+            if identity != self.read_pool_file:
+                self.close_read_connections()
+                self.read_pool_file = identity
+                self.table_columns = {}
+        try:
+            conn, conn_identity = self.read_pool.get_nowait()
+            if conn_identity != identity:
+                conn.close()
+                raise queue.Empty
+        except queue.Empty:
+            conn, conn_identity = self.open_read_connection(), identity
+        cursor = conn.cursor()
+        cursor.row_factory = row_factory
+        try:
+            yield cursor
+        finally:
+            # Closing the cursor resets its statement, so that an idle connection holds no lock
+            cursor.close()
+            try:
+                if conn_identity != self.read_pool_file:
+                    raise queue.Full
+                self.read_pool.put_nowait((conn, conn_identity))
+            except queue.Full:
+                conn.close()
+
+    def close_read_connections(self):
+        """
+        Close the idle connections of the read pool.
+        """
+        while True:
+            try:
+                conn, _ = self.read_pool.get_nowait()
+            except queue.Empty:
+                return
+            conn.close()
+
+    def warm_up(self, tables: Sequence[str] = WARM_UP_TABLES):
+        """
+        Read the given tables and their indexes once, so that their pages are in the cache of the system
+        (and of a pooled connection) before the first searches. Missing tables are skipped.
+        Returns the time in seconds spent on each table.
+        """
+        timings = {}
+        with self.read_connection() as cursor:
+            cursor.execute("SELECT name, tbl_name FROM sqlite_master WHERE type = 'index'")
+            indexes = {}
+            for name, table_name in cursor.fetchall():
+                # Automatic indexes cannot be named in INDEXED BY
+                if not name.startswith("sqlite_autoindex"):
+                    indexes.setdefault(table_name, []).append(name)
+            for table_name in tables:
+                if not self.get_table_columns(cursor, table_name):
+                    continue
+                start_time = time.perf_counter()
+                queries = [f"SELECT * FROM {table_name}"] + [
+                    f"SELECT COUNT(*) FROM {table_name} INDEXED BY {name}"
+                    for name in indexes.get(table_name, [])
+                ]
+                for query in queries:
+                    cursor.execute(query)
+                    while cursor.fetchmany(IMPORT_BATCH_SIZE):
+                        pass
+                timings[table_name] = time.perf_counter() - start_time
+        return timings
+
     def create_gtfs_indexes(self):
         """
         Create indexes for the GTFS tables to improve query performance.
         This method creates indexes on frequently queried columns in the GTFS tables,
         such as stop_id, trip_id, service_id, and others.
+        Returns the build time in seconds of each index, by index name.
         """
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
+        from tqdm import tqdm
+
+        conn, cursor = self.get_connection()
 
         indexes = [
-            "CREATE INDEX IF NOT EXISTS idx_stop_times_stop_id_arrival ON stop_times (stop_id, arrival_time)",
-            "CREATE INDEX IF NOT EXISTS idx_stop_times_trip_id ON stop_times (trip_id)",
+            # stop_times_v2 is clustered by (trip_idx, stop_sequence), so it only needs an index by stop
+            "CREATE INDEX IF NOT EXISTS idx_stop_times_stop_idx_departure ON stop_times_v2 (stop_idx, departure_time)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_trips_trip_idx ON trips (trip_idx)",
+            "CREATE INDEX IF NOT EXISTS idx_stops_stop_idx ON stops (stop_idx)",
             "CREATE INDEX IF NOT EXISTS idx_trips_service_id ON trips (service_id)",
             "CREATE INDEX IF NOT EXISTS idx_trips_route_id ON trips (route_id)",
             "CREATE INDEX IF NOT EXISTS idx_routes_agency_id ON routes (agency_id)",
             "CREATE INDEX IF NOT EXISTS idx_calendar_service_id ON calendar (service_id)",
             "CREATE INDEX IF NOT EXISTS idx_calendar_dates_service_id_date ON calendar_dates (service_id, date)",
             "CREATE INDEX IF NOT EXISTS idx_stops_stop_name ON stops (stop_name)",
+            # Station names are looked up case-insensitively (see JourneyPlanner.find_station_stops)
+            "CREATE INDEX IF NOT EXISTS idx_stops_stop_name_nocase ON stops (stop_name COLLATE NOCASE)",
+            "CREATE INDEX IF NOT EXISTS idx_stops_parent_station ON stops (parent_station)",
             "CREATE INDEX IF NOT EXISTS idx_transfers_from_stop_id ON transfers (from_stop_id)",
             "CREATE INDEX IF NOT EXISTS idx_transfers_to_stop_id ON transfers (to_stop_id)",
             "CREATE INDEX IF NOT EXISTS idx_shapes_shape_id ON shapes (shape_id)",
-            "CREATE INDEX IF NOT EXISTS idx_stop_times_stop_sequence ON stop_times (stop_sequence)",  # Adding this index and the 4 following ones sped up journey searches by 1128% !!!
-            "CREATE INDEX IF NOT EXISTS idx_stop_times_trip_id_stop_sequence ON stop_times (trip_id, stop_sequence)",
             "CREATE INDEX IF NOT EXISTS idx_calendar_start_end_date ON calendar (start_date, end_date)",
             "CREATE INDEX IF NOT EXISTS idx_calendar_dates_date_exception_type ON calendar_dates (date, exception_type)",
             "CREATE INDEX IF NOT EXISTS idx_stops_lat_lon ON stops (stop_lat, stop_lon)",
         ]
 
+        timings = {}
         for index in tqdm(indexes, desc="Creating GTFS indexes"):
+            start_time = time.perf_counter()
             cursor.execute(index)
+            timings[index.split(" ON ")[0].split()[-1]] = time.perf_counter() - start_time
 
         print("GTFS indexes created successfully.")
 
         conn.commit()
         conn.close()
+        return timings
 
-    def add_nearby_transfers(self, max_distance_m=100, transfer_time_sec=120):
+    def add_nearby_transfers(
+        self, max_distance_m=100, transfer_time_sec=120, region=None, report=None
+    ):
         """
         Add transfers between all stops within max_distance_m meters of each other,
         except if a transfer already exists between the stops or if both stop_id starts with excluded prefixes.
         Uses multiprocessing and a spatial index for efficiency.
+        If a region is given, only the stops inside it get transfers.
+        Returns the phases of the generation (see TransferGenerator.phase),
+        which are also recorded in report if given, even if the generation fails.
         """
+        from transfer_generator import TransferGenerator
+
         tg = TransferGenerator(
             self,
             max_distance_m=max_distance_m,
             transfer_time_sec=transfer_time_sec,
+            region=region,
         )
-        tg.generate_transfers()
+        try:
+            tg.generate_transfers()
+        finally:
+            if report is not None:
+                report.record_phases(tg.phases)
+        return tg.phases
 
-    def load_and_prepare_data(self, data_path: str):
+    def add_footpaths(
+        self,
+        max_distance_m=400,
+        walking_speed_mps=1.2,
+        max_footpath_sec=DEFAULT_MAX_FOOTPATH_SEC,
+        region=None,
+        stop_prefixes=None,
+        report=None,
+    ):
+        """
+        Build the transitively closed footpath graph used by the journey search.
+        Stops within max_distance_m meters of each other are linked by a walking time based on their distance,
+        and the graph is closed up to max_footpath_sec seconds of walking, the transfers given by the feeds
+        being kept whatever their duration.
+        If a region is given, only the stops inside it get walking edges.
+        If stop_prefixes is given, the existing footpaths are only updated around the stops of these sources
+        (see TransferGenerator.update_footpaths).
+        Returns the phases of the generation (see TransferGenerator.phase),
+        which are also recorded in report if given, even if the generation fails.
+        """
+        from transfer_generator import TransferGenerator
+
+        tg = TransferGenerator(
+            self,
+            max_distance_m=max_distance_m,
+            walking_speed_mps=walking_speed_mps,
+            max_footpath_sec=max_footpath_sec,
+            region=region,
+        )
+        try:
+            if stop_prefixes is None:
+                tg.generate_footpaths()
+            else:
+                tg.update_footpaths(stop_prefixes)
+        finally:
+            if report is not None:
+                report.record_phases(tg.phases)
+        return tg.phases
+
+    def build_stop_search_index(self):
+        """
+        Build the stop_search FTS5 table used by the stop search, over the names and aliases (STOP_ALIAS_COLUMNS)
+        of the stops, read from the stops table or its side table depending on the import profile.
+        Names are tokenized with unicode61 and without diacritics, so the search ignores case and accents,
+        and prefix indexes make the search of the first letters of a word fast.
+        The rows are stored by decreasing importance of the stops (see get_stop_importance) to rank the results.
+        The table is not created if SQLite is built without FTS5, the stop search then falls back to LIKE.
+        """
+        conn, cursor = self.get_connection()
+        cursor.execute("DROP TABLE IF EXISTS stop_search")
+        try:
+            cursor.execute(
+                """
+                CREATE VIRTUAL TABLE stop_search USING fts5(
+                    stop_name,
+                    aliases,
+                    stop_id UNINDEXED,
+                    importance UNINDEXED,
+                    tokenize = 'unicode61 remove_diacritics 2',
+                    prefix = '2 3'
+                )
+                """
+            )
+        except sqlite3.OperationalError as e:
+            print(f"Stop search index not created: {e}")
+            conn.close()
+            return
+
+        aliases = {}
+        cursor.execute("PRAGMA table_info(stops)")
+        alias_columns = [
+            row[1] for row in cursor.fetchall() if row[1] in STOP_ALIAS_COLUMNS
+        ]
+        if alias_columns:
+            cursor.execute(f"SELECT stop_id, {', '.join(alias_columns)} FROM stops")
+            for stop_id, *values in cursor.fetchall():
+                for value in values:
+                    if value:
+                        aliases.setdefault(stop_id, []).append(value)
+        cursor.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='stops_attributes'"
+        )
+        if cursor.fetchone()[0] > 0:
+            cursor.execute(
+                f"SELECT stop_id, value FROM stops_attributes WHERE name IN ({', '.join('?' * len(STOP_ALIAS_COLUMNS))})",
+                STOP_ALIAS_COLUMNS,
+            )
+            for stop_id, value in cursor.fetchall():
+                aliases.setdefault(stop_id, []).append(value)
+
+        importance = self.get_stop_importance(cursor)
+        cursor.execute("SELECT stop_id, stop_name FROM stops WHERE stop_name != ''")
+        stops = sorted(
+            cursor.fetchall(),
+            key=lambda stop: (-importance.get(stop[0], 0), len(stop[1]), stop[0]),
+        )
+        # The stops are inserted by decreasing importance, so that the search can return the first matches
+        # in rowid order, without sorting all of them
+        cursor.executemany(
+            "INSERT INTO stop_search (stop_name, aliases, stop_id, importance) VALUES (?, ?, ?, ?)",
+            [
+                (
+                    stop_name,
+                    " ".join(dict.fromkeys(aliases.get(stop_id, ()))),
+                    stop_id,
+                    importance.get(stop_id, 0),
+                )
+                for stop_id, stop_name in stops
+            ],
+        )
+        cursor.execute("INSERT INTO stop_search (stop_search) VALUES ('optimize')")
+        conn.commit()
+        conn.close()
+
+    def get_stop_importance(self, cursor: sqlite3.Cursor) -> dict:
+        """
+        Get the importance of each stop, its number of stop times, the stations getting the sum of their stops.
+        Returns a dict {stop_id: importance}.
+        """
+        cursor.execute(
+            """
+            SELECT stops.stop_id, stops.parent_station, COUNT(stop_times_v2.stop_idx)
+            FROM stops
+            LEFT JOIN stop_times_v2 ON stop_times_v2.stop_idx = stops.stop_idx
+            GROUP BY stops.stop_idx
+            """
+        )
+        importance = {}
+        for stop_id, parent_station, stop_times in cursor.fetchall():
+            importance[stop_id] = importance.get(stop_id, 0) + stop_times
+            if parent_station:
+                parent_id = source_prefix(stop_id) + parent_station
+                importance[parent_id] = importance.get(parent_id, 0) + stop_times
+        return importance
+
+    def download_and_populate_all(
+        self,
+        data_sources: dict,
+        max_workers: int = 4,
+        only_changed: bool = False,
+        profile: str = DEFAULT_IMPORT_PROFILE,
+        window_days: Optional[int] = None,
+        region: Optional[ImportRegion] = None,
+        report: Optional[ImportReport] = None,
+    ) -> list[int]:
+        """
+        Download all the GTFS sources concurrently and import them as soon as they are downloaded.
+        Downloads run in a bounded thread pool, and each downloaded source is imported in its own shard database
+        by a pool of worker processes, so the CSV parsing of the sources runs in parallel.
+        The shards are then merged into this database by the calling thread, which is its only writer.
+        A source failing to download or to import only loses its own shard.
+        If only_changed is True, sources whose URL and content hash did not change since their last import are skipped,
+        and the rows of the changed ones are deleted before being imported again.
+        profile is the import profile of the shards, it must be the one this database was created with.
+        window_days is the service window of the import (see populate_database), with only_changed,
+        the sources imported more than window_days / 2 days ago are imported again to move their window forward.
+        region is the geographic region of the import (see populate_database).
+        If report is given, the download, import and merge metrics and the errors of each source are recorded in it.
+        The index of each source is given by get_source_ids.
+        Returns the indexes of the imported sources.
+        """
+        imported = []
+        source_ids = self.get_source_ids(data_sources)
+        if report is None:
+            report = ImportReport("full")
+        os.makedirs(GTFS_SHARD_DIR, exist_ok=True)
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers
+        ) as downloader, concurrent.futures.ProcessPoolExecutor(
+            max_workers=os.cpu_count()
+        ) as importer:
+            downloads = {}
+            imports = {}
+            for name, gtfs_url in data_sources.items():
+                print(f"Downloading GTFS data from {name}: {gtfs_url}")
+                # the index is used to identify the source, to prefix all the ids with it
+                i = source_ids[name]
+                download = {}
+                report.record_download(name, download)
+                downloads[
+                    downloader.submit(
+                        self.download_gtfs, gtfs_url, GTFS_CACHE_DIR, download
+                    )
+                ] = (i, name)
+            pending = set(downloads)
+            while pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    if future in downloads:
+                        i, name = downloads[future]
+                        try:
+                            zip_path = future.result()
+                            content_hash = self.get_file_hash(zip_path)
+                            gtfs_url = data_sources[name]
+                            if only_changed:
+                                feed_metadata = self.get_feed_metadata(i)
+                                window_expiring = (
+                                    window_days is not None
+                                    and feed_metadata is not None
+                                    and datetime.datetime.now()
+                                    - datetime.datetime.fromisoformat(feed_metadata[4])
+                                    > datetime.timedelta(days=window_days / 2)
+                                )
+                                if (
+                                    feed_metadata
+                                    and feed_metadata[1:3] == (gtfs_url, content_hash)
+                                    and not window_expiring
+                                ):
+                                    print(f"GTFS data from {name} has not changed")
+                                    report.record_skip(name)
+                                    continue
+                            print(f"Importing GTFS data from {name}")
+                            shard = importer.submit(
+                                import_shard,
+                                zip_path,
+                                i,
+                                self.get_shard_path(i),
+                                profile,
+                                window_days,
+                                region,
+                            )
+                            imports[shard] = (i, name, zip_path, content_hash)
+                            pending.add(shard)
+                        except Exception as e:
+                            print(f"Error downloading GTFS data from {name}: {e}")
+                            report.record_error(name, "download", e)
+                    else:
+                        i, name, zip_path, content_hash = imports[future]
+                        try:
+                            shard_path, files, seconds = future.result()
+                            report.record_import(name, files, seconds)
+                        except Exception as e:
+                            print(f"Error importing GTFS data from {name}: {e}")
+                            report.record_error(name, "import", e)
+                            continue
+                        try:
+                            start_time = time.perf_counter()
+                            if only_changed:
+                                self.delete_feed(i)
+                            print(f"Merging GTFS data from {name}")
+                            self.merge_shard(shard_path)
+                            self.set_feed_metadata(
+                                i, name, data_sources[name], content_hash, zip_path
+                            )
+                            os.remove(shard_path)
+                            imported.append(i)
+                            report.record_merge(name, time.perf_counter() - start_time)
+                        except Exception as e:
+                            print(f"Error populating data from {name}: {e}")
+                            report.record_error(name, "merge", e)
+        return imported
+
+    def build_and_swap(self, build: Callable[["Database"], bool]):
+        """
+        Build a new version of the database in a temporary file, then atomically rename it in place of this database.
+        Connections opened before the swap keep reading the previous file until they are closed,
+        so the searches running during a rebuild are not affected, and the next connections use the new file.
+        build is called with the Database of the temporary file.
+        A new random version ID is stored in the metadata of the swapped database.
+        The import_runs of this database are kept in the rebuilt one.
+        If build fails, the database is not swapped, and the import runs recorded by the failed build
+        are added to the import_runs of this database.
+        """
+        building_path = self.db_name + ".building"
+        if os.path.exists(building_path):
+            os.remove(building_path)
+        build_started_at = datetime.datetime.now().isoformat()
+        building = Database(building_path)
+        try:
+            build(building)
+        except Exception:
+            building.close_read_connections()
+            if os.path.exists(self.db_name):
+                try:
+                    self.append_import_runs(building_path, build_started_at)
+                except Exception as e:
+                    print(f"Error keeping the import report of the failed build: {e}")
+            raise
+        if os.path.exists(self.db_name):
+            building.copy_import_runs(self.db_name)
+        version = uuid.uuid4().hex
+        building.set_metadata("version", version)
+        building.close_read_connections()
+        os.replace(building_path, self.db_name)
+        print(f"Database {self.db_name} swapped to version {version}")
+
+    def load_and_prepare_data(
+        self,
+        data_path: str,
+        profile: str = DEFAULT_IMPORT_PROFILE,
+        window_days: Optional[int] = None,
+        region: Optional[ImportRegion] = None,
+        report_path: Optional[str] = None,
+        max_footpath_sec: int = DEFAULT_MAX_FOOTPATH_SEC,
+    ):
+        """
+        Rebuild the database from the sources in data_path into a new file, swapped in place of the current one.
+        """
+        self.build_and_swap(
+            lambda building: building.prepare_data(
+                data_path, profile, window_days, region, report_path, max_footpath_sec
+            )
+        )
+
+    def prepare_data(
+        self,
+        data_path: str,
+        profile: str = DEFAULT_IMPORT_PROFILE,
+        window_days: Optional[int] = None,
+        region: Optional[ImportRegion] = None,
+        report_path: Optional[str] = None,
+        max_footpath_sec: int = DEFAULT_MAX_FOOTPATH_SEC,
+    ) -> bool:
         """
         Load GTFS data from sources in data_path, create tables, indexes, and generate nearby transfers.
+        profile is the import profile, one of IMPORT_PROFILES.
+        If window_days is given, only the trips running in the next window_days days are imported.
+        If region is given, only the trips stopping inside it are imported, and transfers are only generated inside it.
+        max_footpath_sec is the longest walk of the footpaths (see add_footpaths), kept for the refreshes.
+        The import report is stored in the import_runs table, and written to report_path if given,
+        also when the import fails.
         """
-        self.reset_database()
-        self.create_metadata_table()
-        self.create_gtfs_tables()
+        report = ImportReport("full")
+        try:
+            self.reset_database()
+            self.create_metadata_table()
+            self.create_gtfs_tables(profile)
+            self.set_metadata("schema_version", str(SCHEMA_VERSION))
+            self.set_metadata("import_profile", profile)
+            if window_days is not None:
+                self.set_metadata("window_days", str(window_days))
+            if region is not None:
+                self.set_metadata("import_region", region.to_json())
+            self.set_metadata("max_footpath_sec", str(max_footpath_sec))
 
-        with open(data_path, "r") as file:
-            data_sources = json.loads(file.read())
+            with open(data_path, "r") as file:
+                data_sources = json.loads(file.read())
 
-        for i, (name, gtfs_url) in enumerate(data_sources.items()):
-            print(f"Downloading GTFS data from {name}: {gtfs_url}")
-            try:
-                self.download_and_populate_gtfs(
-                    gtfs_url, i
-                )  # the index is used to identify the source, to prefix all the ids with it
-            except Exception as e:
-                print(f"Error downloading or populating data from {name}: {e}")
-        print("Creating indexes for GTFS tables...")
-        self.create_gtfs_indexes()
-        print("Indexes created successfully.")
-        print("Generating nearby transfers...")
-        self.add_nearby_transfers(max_distance_m=100, transfer_time_sec=120)
-        print("GTFS data loaded and transfers generated successfully.")
-        self.set_metadata("updated_at", datetime.datetime.now().isoformat())
-
-    def update_database(self, data_path: str, force_update: bool = False):
-        """
-        Reload GTFS data from sources if the database is empty or if the last update was more than 24 hours ago.
+            self.download_and_populate_all(
+                data_sources,
+                profile=profile,
+                window_days=window_days,
+                region=region,
+                report=report,
+            )
+            print("Creating indexes for GTFS tables...")
+            report.record_indexes(self.create_gtfs_indexes())
+            print("Indexes created successfully.")
+            print("Generating nearby transfers...")
+            self.add_nearby_transfers(
+                max_distance_m=100, transfer_time_sec=120, region=region, report=report
+            )
+            print("Generating footpaths...")
+            self.add_footpaths(
+                max_footpath_sec=max_footpath_sec, region=region, report=report
+            )
+            print("Building the stop search index...")
+            self.build_stop_search_index()
+            print("GTFS data loaded and transfers generated successfully.")
+            print(f"Database size by table ({profile} import profile):")
+            self.print_size_report()
+            self.set_metadata("updated_at", datetime.datetime.now().isoformat())
+        except Exception as e:
+            report.save_failure(e, self.db_name, report_path)
+            raise
+        report.save(self.db_name, report_path)
+        return True
+
+    def refresh_feeds(self, data_path: str, report_path: Optional[str] = None):
+        """
+        Refresh the changed sources of data_path in this database, in a single transaction (see update_feeds).
+        The database is not copied: when no source has changed, only the update time is written,
+        and the searches running during a refresh keep reading the previous data until the commit.
+        """
+        # The transaction is made by another Database, so the requests made meanwhile on this one
+        # do not use its connection
+        refreshing = Database(self.db_name)
+        try:
+            if refreshing.update_feeds(data_path, report_path):
+                version = refreshing.get_metadata("version")
+                print(f"Database {self.db_name} updated to version {version}")
+        finally:
+            refreshing.close_read_connections()
+
+    def update_feeds(self, data_path: str, report_path: Optional[str] = None) -> bool:
+        """
+        Update the database in place, only re-importing the sources whose content changed since their last import.
+        The sources are downloaded and compared to their last import first, and the changes are written
+        in a single transaction (see transaction), with a new version ID if any source has changed or has been removed.
+        The generated transfers and the footpaths (if the table exists) are regenerated only around the stops
+        of the re-imported and removed sources.
+        The import report is stored in the import_runs table, and written to report_path if given,
+        also when the import fails.
+        Returns False if no source has changed.
+        """
+        report = ImportReport("refresh")
+        try:
+            self.create_metadata_table()
+            with self.transaction():
+                with open(data_path, "r") as file:
+                    data_sources = json.loads(file.read())
+
+                window_days = self.get_metadata("window_days")
+                region = self.get_metadata("import_region")
+                region = ImportRegion.from_json(region) if region else None
+                changed = self.download_and_populate_all(
+                    data_sources,
+                    only_changed=True,
+                    profile=self.get_metadata("import_profile") or "full",
+                    window_days=int(window_days) if window_days else None,
+                    region=region,
+                    report=report,
+                )
+
+                # Sources removed from data_path, the others keep their index (see get_source_ids)
+                source_ids = set(self.get_source_ids(data_sources).values())
+                conn, cursor = self.get_connection()
+                cursor.execute("SELECT id FROM feed_metadata")
+                removed = [
+                    row[0] for row in cursor.fetchall() if row[0] not in source_ids
+                ]
+                conn.close()
+                for id in removed:
+                    print(f"Removing GTFS data of source {id}")
+                    self.delete_feed(id)
+
+                if changed or removed:
+                    report.record_indexes(self.create_gtfs_indexes())
+                    if changed:
+                        print("Generating nearby transfers for the updated sources...")
+                        from transfer_generator import TransferGenerator
+
+                        tg = TransferGenerator(
+                            self,
+                            max_distance_m=100,
+                            transfer_time_sec=120,
+                            region=region,
+                        )
+                        try:
+                            tg.generate_transfers(
+                                stop_prefixes=[f"{id:02}/" for id in changed]
+                            )
+                        finally:
+                            report.record_phases(tg.phases)
+                    conn, cursor = self.get_connection()
+                    cursor.execute(
+                        "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='footpaths'"
+                    )
+                    has_footpaths = cursor.fetchone()[0] > 0
+                    conn.close()
+                    if has_footpaths:
+                        print("Updating footpaths around the updated sources...")
+                        max_footpath_sec = self.get_metadata("max_footpath_sec")
+                        self.add_footpaths(
+                            max_footpath_sec=(
+                                int(max_footpath_sec)
+                                if max_footpath_sec
+                                else DEFAULT_MAX_FOOTPATH_SEC
+                            ),
+                            region=region,
+                            stop_prefixes=[f"{id:02}/" for id in changed],
+                            report=report,
+                        )
+                    print("Building the stop search index...")
+                    self.build_stop_search_index()
+                    self.set_metadata("version", uuid.uuid4().hex)
+                    print(
+                        f"{len(changed)} sources updated, {len(removed)} sources removed."
+                    )
+                else:
+                    print("No GTFS source has changed.")
+                self.set_metadata("updated_at", datetime.datetime.now().isoformat())
+        except Exception as e:
+            report.save_failure(e, self.db_name, report_path)
+            raise
+        report.save(self.db_name, report_path)
+        return bool(changed or removed)
+
+    def update_database(
+        self,
+        data_path: str,
+        force_update: bool = False,
+        profile: str = DEFAULT_IMPORT_PROFILE,
+        window_days: Optional[int] = None,
+        region: Optional[ImportRegion] = None,
+        report_path: Optional[str] = None,
+        max_footpath_sec: int = DEFAULT_MAX_FOOTPATH_SEC,
+    ):
+        """
+        Load GTFS data from sources if the database is empty, has an older schema, another import profile,
+        service window, region or footpath limit (or if forced), and refresh the changed sources
+        if the last update was more than 24 hours ago.
+        The report of the import is written to report_path if given (see ImportReport).
         """
         last_update = self.get_metadata("updated_at")
+        schema_outdated = self.get_metadata(
+            "schema_version"
+        ) != str(SCHEMA_VERSION) or self.get_metadata("import_profile") != profile
+        schema_outdated = schema_outdated or self.get_metadata("window_days") != (
+            str(window_days) if window_days is not None else None
+        )
+        schema_outdated = schema_outdated or self.get_metadata("import_region") != (
+            region.to_json() if region is not None else None
+        )
+        # Databases built before the limit was stored used the default one
+        schema_outdated = schema_outdated or (
+            self.get_metadata("max_footpath_sec") or str(DEFAULT_MAX_FOOTPATH_SEC)
+        ) != str(max_footpath_sec)
 
         if (
             not last_update
+            or schema_outdated
             or (
                 datetime.datetime.now() - datetime.datetime.fromisoformat(last_update)
             ).total_seconds()
@@ -504,13 +2058,41 @@ class Database:
         ):
             if not last_update:
                 print("Database is empty, loading GTFS data for the first time.")
+                self.load_and_prepare_data(
+                    data_path,
+                    profile,
+                    window_days,
+                    region,
+                    report_path,
+                    max_footpath_sec,
+                )
             elif force_update:
                 print("Forcing reload of GTFS data.")
+                self.load_and_prepare_data(
+                    data_path,
+                    profile,
+                    window_days,
+                    region,
+                    report_path,
+                    max_footpath_sec,
+                )
+            elif schema_outdated:
+                print(
+                    f"Database schema or import options changed, rebuilding it with schema version {SCHEMA_VERSION} and the {profile} import profile."
+                )
+                self.load_and_prepare_data(
+                    data_path,
+                    profile,
+                    window_days,
+                    region,
+                    report_path,
+                    max_footpath_sec,
+                )
             else:
                 print(
-                    "Database is outdated, reloading GTFS data as last update was more than 24 hours ago."
+                    "Database is outdated, refreshing the changed GTFS sources as last update was more than 24 hours ago."
                 )
-            self.load_and_prepare_data(data_path)
+                self.refresh_feeds(data_path, report_path)
         else:
             print("Database is up-to-date, no need to reload GTFS data.")
 
@@ -526,12 +2108,9 @@ class Database:
         Optional[Agency]
             An Agency object if found, if not found None.
         """
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM agency WHERE agency_id = ?", (agency_id,))
-        row = cursor.fetchone()
-        conn.close()
+        with self.read_connection(sqlite3.Row) as cursor:
+            cursor.execute("SELECT * FROM agency WHERE agency_id = ?", (agency_id,))
+            row = cursor.fetchone()
         return Agency(**dict(row)) if row else None
 
     def get_route_by_id(self, route_id: str) -> Optional[Route]:
@@ -545,12 +2124,9 @@ class Database:
         -------
         Optional[Route]
             A Route object if found, if not found None."""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM routes WHERE route_id = ?", (route_id,))
-        row = cursor.fetchone()
-        conn.close()
+        with self.read_connection(sqlite3.Row) as cursor:
+            cursor.execute("SELECT * FROM routes WHERE route_id = ?", (route_id,))
+            row = cursor.fetchone()
         return Route(**dict(row)) if row else None
 
     def get_shape_by_id(self, shape_id: str) -> Optional[Shape]:
@@ -565,12 +2141,9 @@ class Database:
         Optional[Shape]
             A Shape object if found, if not found None.
         """
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM shapes WHERE shape_id = ?", (shape_id,))
-        row = cursor.fetchone()
-        conn.close()
+        with self.read_connection(sqlite3.Row) as cursor:
+            cursor.execute("SELECT * FROM shapes WHERE shape_id = ?", (shape_id,))
+            row = cursor.fetchone()
         return Shape(**dict(row)) if row else None
 
     def get_stop_time_by_id(
@@ -591,16 +2164,18 @@ class Database:
         Optional[StopTime]
             A StopTime object if found, if not found None.
         """
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT * FROM stop_times WHERE trip_id = ? AND stop_id = ? AND stop_sequence = ?",
-            (trip_id, stop_id, stop_sequence),
-        )
-        row = cursor.fetchone()
-        conn.close()
-        return StopTime(**dict(row)) if row else None
+        with self.read_connection(sqlite3.Row) as cursor:
+            cursor.execute(
+                "SELECT * FROM stop_times WHERE trip_id = ? AND stop_id = ? AND stop_sequence = ?",
+                (trip_id, stop_id, stop_sequence),
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            attributes = self.get_attributes(
+                cursor, "stop_times_v2", (self.get_trip_idx(trip_id), stop_sequence)
+            )
+        return self.build_model(StopTime, dict(row), attributes)
 
     def get_stop_by_id(self, stop_id: str) -> Optional[Stop]:
         """
@@ -614,13 +2189,13 @@ class Database:
         Optional[Stop]
             A Stop object if found, if not found None.
         """
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM stops WHERE stop_id = ?", (stop_id,))
-        row = cursor.fetchone()
-        conn.close()
-        return Stop(**dict(row)) if row else None
+        with self.read_connection(sqlite3.Row) as cursor:
+            cursor.execute("SELECT * FROM stops WHERE stop_id = ?", (stop_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            attributes = self.get_attributes(cursor, "stops", (stop_id,))
+        return self.build_model(Stop, dict(row), attributes)
 
     def get_transfer_by_id(
         self, from_stop_id: str, to_stop_id: str
@@ -638,15 +2213,12 @@ class Database:
         Optional[Transfer]
             A Transfer object if found, if not found None.
         """
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT * FROM transfers WHERE from_stop_id = ? AND to_stop_id = ?",
-            (from_stop_id, to_stop_id),
-        )
-        row = cursor.fetchone()
-        conn.close()
+        with self.read_connection(sqlite3.Row) as cursor:
+            cursor.execute(
+                "SELECT * FROM transfers WHERE from_stop_id = ? AND to_stop_id = ?",
+                (from_stop_id, to_stop_id),
+            )
+            row = cursor.fetchone()
         return Transfer(**dict(row)) if row else None
 
     def get_trip_by_id(self, trip_id: str) -> Optional[Trip]:
@@ -661,32 +2233,294 @@ class Database:
         Optional[Trip]
             A Trip object if found, if not found None.
         """
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
+        with self.read_connection(sqlite3.Row) as cursor:
+            cursor.execute("SELECT * FROM trips WHERE trip_id = ?", (trip_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            attributes = self.get_attributes(cursor, "trips", (trip_id,))
+        return self.build_model(Trip, dict(row), attributes)
+
+    def get_attributes(
+        self, cursor: sqlite3.Cursor, table_name: str, key: tuple
+    ) -> dict:
+        """
+        Get the values stored in the side table of table_name for the row with the given key,
+        an empty dict if the database has no side table for this table.
+        """
+        attributes_table, key_columns = ATTRIBUTE_TABLES[table_name]
+        conditions = " AND ".join(f"{column} = ?" for column in key_columns)
+        try:
+            cursor.execute(
+                f"SELECT name, value FROM {attributes_table} WHERE {conditions}", key
+            )
+        except sqlite3.OperationalError:
+            # no side table for this table in this import profile
+            return {}
+        return {name: value for name, value in cursor.fetchall()}
+
+    def get_table_columns(self, cursor: sqlite3.Cursor, table_name: str) -> tuple:
+        """
+        Get the columns of a table, cached until the database file changes.
+        """
+        columns = self.table_columns.get(table_name)
+        if columns is None:
+            cursor.execute(f'PRAGMA table_info("{table_name}")')
+            columns = tuple(row[1] for row in cursor.fetchall())
+            self.table_columns[table_name] = columns
+        return columns
+
+    def get_columns(
+        self, table_name: str, id: str, columns: Sequence[str]
+    ) -> Optional[tuple]:
+        """
+        Get only the given columns of the row of a table with the given prefixed ID (its FEED_KEY_COLUMNS column),
+        instead of building its whole model.
+        The columns that are not in the table are read from its side table of ATTRIBUTE_TABLES, and are None
+        if they are not stored by the import profile.
+        Returns a tuple of the values in the order of columns, or None if there is no such row.
+        """
+        id_column = FEED_KEY_COLUMNS[table_name]
+        with self.read_connection() as cursor:
+            table_columns = self.get_table_columns(cursor, table_name)
+            selected = [column for column in columns if column in table_columns]
+            cursor.execute(
+                f"SELECT {', '.join(selected) or 1} FROM {table_name} WHERE {id_column} = ?",
+                (id,),
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            values = dict(zip(selected, row))
+            if len(selected) < len(columns) and table_name in ATTRIBUTE_TABLES:
+                values = {**self.get_attributes(cursor, table_name, (id,)), **values}
+        return tuple(values.get(column) for column in columns)
+
+    def get_stop_record(self, stop_id: str) -> Optional[StopRecord]:
+        """
+        Get the name and position of a stop, without its other attributes.
+        """
+        row = self.get_columns("stops", stop_id, StopRecord.__slots__)
+        return StopRecord(*row) if row else None
+
+    def get_route_record(self, route_id: str) -> Optional[RouteRecord]:
+        """
+        Get the names, type and agency of a route, without its other attributes.
+        """
+        row = self.get_columns("routes", route_id, RouteRecord.__slots__)
+        return RouteRecord(*row) if row else None
+
+    def get_trip_record(self, trip_id: str) -> Optional[TripRecord]:
+        """
+        Get the route, service and headsign of a trip, without its other attributes.
+        """
+        row = self.get_columns("trips", trip_id, TripRecord.__slots__)
+        return TripRecord(*row) if row else None
+
+    def get_stop_time_records(self, trip_id: str) -> list[StopTimeRecord]:
+        """
+        Get the stop times of a trip in stop sequence order, with their stop, sequence and times only.
+        """
+        with self.read_connection() as cursor:
+            cursor.execute(
+                f"""
+                SELECT {', '.join(StopTimeRecord.__slots__)}
+                FROM stop_times
+                WHERE trip_id = ?
+                ORDER BY stop_sequence
+                """,
+                (trip_id,),
+            )
+            return [StopTimeRecord(*row) for row in cursor.fetchall()]
+
+    def iter_rows(
+        self,
+        table_name: str,
+        columns: Sequence[str],
+        batch_size: int = IMPORT_BATCH_SIZE,
+    ) -> Iterator[tuple]:
+        """
+        Iterate over the given columns of all the rows of a table, as plain tuples fetched in batches of batch_size rows,
+        without building a model per row.
+        The pooled connection is held until the iteration is over (or the iterator is closed).
+        Raises ValueError if a column is not in the table.
+        """
+        with self.read_connection() as cursor:
+            table_columns = self.get_table_columns(cursor, table_name)
+            unknown = [column for column in columns if column not in table_columns]
+            if unknown:
+                raise ValueError(f"Unknown columns of table {table_name}: {unknown}")
+            cursor.execute(f"SELECT {', '.join(columns)} FROM {table_name}")
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield from rows
+
+    def build_model(self, model: type, row: dict, attributes: dict):
+        """
+        Build a model from a row and its side table attributes, ignoring the values of the columns it does not have.
+        """
+        names = {field.name for field in dataclasses.fields(model)}
+        values = {**attributes, **row}
+        return model(**{name: value for name, value in values.items() if name in names})
+
+    def get_size_report(self) -> dict:
+        """
+        Get the size on disk of each table and index of the database, measured with the dbstat virtual table,
+        and the number of rows of each table.
+        Returns a dict {name: {"rows": int or None, "bytes": int}}, sorted by decreasing size.
+        Raises sqlite3.OperationalError if SQLite is built without the dbstat virtual table.
+        """
+        conn, cursor = self.get_connection()
+        try:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+            tables = {row[0] for row in cursor.fetchall()}
+            cursor.execute(
+                "SELECT name, SUM(pgsize) FROM dbstat GROUP BY name ORDER BY SUM(pgsize) DESC"
+            )
+            report = {}
+            for name, size in cursor.fetchall():
+                rows = None
+                if name in tables:
+                    cursor.execute(f'SELECT COUNT(*) FROM "{name}"')
+                    rows = cursor.fetchone()[0]
+                report[name] = {"rows": rows, "bytes": size}
+        finally:
+            conn.close()
+        return report
+
+    def print_size_report(self):
+        """
+        Print the size report of the database, one line per table or index.
+        The report is skipped if SQLite has no dbstat virtual table, it is not worth failing an import for.
+        """
+        try:
+            report = self.get_size_report()
+        except sqlite3.OperationalError as e:
+            print(f"  Size report skipped: {e}")
+            return
+        for name, size in report.items():
+            rows = f"{size['rows']} rows" if size["rows"] is not None else "index"
+            print(f"  {name}: {size['bytes'] / 1e6:.1f} MB ({rows})")
+
+    def copy_import_runs(self, source_path: str):
+        """
+        Copy the import_runs of another database into this one, before its own runs.
+        """
+        conn = sqlite3.connect(self.db_name, isolation_level=None)
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM trips WHERE trip_id = ?", (trip_id,))
-        row = cursor.fetchone()
+        cursor.execute("ATTACH DATABASE ? AS source", (source_path,))
+        cursor.execute(
+            "SELECT COUNT(*) FROM source.sqlite_master WHERE type='table' AND name='import_runs'"
+        )
+        if cursor.fetchone()[0] > 0:
+            cursor.execute("BEGIN")
+            cursor.execute("SELECT * FROM import_runs ORDER BY id")
+            runs = cursor.fetchall()
+            cursor.execute("DELETE FROM import_runs")
+            cursor.execute(
+                "INSERT INTO import_runs (started_at, kind, seconds, feeds, failed_feeds, report) "
+                "SELECT started_at, kind, seconds, feeds, failed_feeds, report FROM source.import_runs ORDER BY id"
+            )
+            cursor.executemany(
+                "INSERT INTO import_runs (started_at, kind, seconds, feeds, failed_feeds, report) VALUES (?, ?, ?, ?, ?, ?)",
+                [run[1:] for run in runs],
+            )
+            cursor.execute("COMMIT")
+        cursor.execute("DETACH DATABASE source")
         conn.close()
-        return Trip(**dict(row)) if row else None
 
-    def get_stop_sequences(self, from_stop_id: str, to_stop_id: str, trip_id: str):
+    def append_import_runs(self, source_path: str, since: str):
         """
-        Get the stop sequences for the departure and arrival stops for a given trip.
+        Add the import_runs of another database started since the given ISO time after the runs of this one.
+        """
+        self.create_metadata_table()
+        conn = sqlite3.connect(self.db_name, isolation_level=None)
+        cursor = conn.cursor()
+        cursor.execute("ATTACH DATABASE ? AS source", (source_path,))
+        cursor.execute(
+            "SELECT COUNT(*) FROM source.sqlite_master WHERE type='table' AND name='import_runs'"
+        )
+        if cursor.fetchone()[0] > 0:
+            cursor.execute(
+                "INSERT INTO import_runs (started_at, kind, seconds, feeds, failed_feeds, report) "
+                "SELECT started_at, kind, seconds, feeds, failed_feeds, report FROM source.import_runs "
+                "WHERE started_at >= ? ORDER BY id",
+                (since,),
+            )
+        cursor.execute("DETACH DATABASE source")
+        conn.close()
+
+    def get_import_runs(self, limit: int = 10) -> list[dict]:
+        """
+        Get the reports of the last import runs, most recent first (see ImportReport.to_dict).
         """
         conn, cursor = self.get_connection()
         cursor.execute(
-            """
-            SELECT stop_sequence
-            FROM stop_times
-            WHERE trip_id = ? AND stop_id IN (?, ?)
-            ORDER BY stop_sequence
-            """,
-            (trip_id, from_stop_id, to_stop_id),
+            "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='import_runs'"
         )
-        stop_sequences = cursor.fetchall()
+        if cursor.fetchone()[0] == 0:
+            conn.close()
+            return []
+        cursor.execute("SELECT report FROM import_runs ORDER BY id DESC LIMIT ?", (limit,))
+        runs = [json.loads(row[0]) for row in cursor.fetchall()]
         conn.close()
+        return runs
+
+    def get_stop_sequences(self, from_stop_id: str, to_stop_id: str, trip_id: str):
+        """
+        Get the stop sequences for the departure and arrival stops for a given trip.
+        """
+        with self.read_connection() as cursor:
+            cursor.execute(
+                """
+                SELECT stop_sequence
+                FROM stop_times
+                WHERE trip_id = ? AND stop_id IN (?, ?)
+                ORDER BY stop_sequence
+                """,
+                (trip_id, from_stop_id, to_stop_id),
+            )
+            stop_sequences = cursor.fetchall()
         if len(stop_sequences) != 2:
             raise ValueError(
                 f"Expected exactly two stop sequences for trip {trip_id}, got {len(stop_sequences)}"
             )
         return stop_sequences[0][0], stop_sequences[1][0]
+
+    def get_trip_stop_sequences(self, trip_id: str) -> dict[str, int]:
+        """
+        Get the stop sequence of each stop of a trip, as a dict stop_id -> stop_sequence.
+        A stop served twice by the trip keeps its first stop sequence.
+        """
+        return {
+            record.stop_id: record.stop_sequence
+            for record in reversed(self.get_stop_time_records(trip_id))
+        }
+
+
+def import_shard(
+    zip_path: str,
+    id: int,
+    shard_path: str,
+    profile: str = DEFAULT_IMPORT_PROFILE,
+    window_days: Optional[int] = None,
+    region: Optional[ImportRegion] = None,
+) -> tuple[str, dict, float]:
+    """
+    Import a GTFS source into its own shard database, run in a worker process by Database.download_and_populate_all.
+    The shard is rebuilt from scratch, and removed if the import fails.
+    Returns the path of the shard, the import statistics of each table and the import time in seconds.
+    """
+    start_time = time.perf_counter()
+    if os.path.exists(shard_path):
+        os.remove(shard_path)
+    shard = Database(shard_path)
+    shard.create_gtfs_tables(profile)
+    try:
+        stats = shard.populate_database(zip_path, id, window_days, region)
+    except Exception:
+        os.remove(shard_path)
+        raise
+    return shard_path, stats, time.perf_counter() - start_time
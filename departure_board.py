@@ -0,0 +1,284 @@
+import bisect
+import datetime
+import heapq
+import sqlite3
+import threading
+from collections import OrderedDict
+from operator import itemgetter
+from typing import TYPE_CHECKING, Iterator
+
+from models import Departure
+from utils import gtfs_time_to_seconds, source_prefix
+
+if TYPE_CHECKING:
+    from database import Database
+
+# Trips of a service day can depart after midnight (25:10:00), so the boards also read the previous service days
+PREVIOUS_SERVICE_DAYS = 1
+# Number of days after the start of a board in which its departures are searched
+BOARD_HORIZON_DAYS = 1
+
+
+class DepartureBoard:
+    def __init__(
+        self, db: "Database", max_stops: int = 512, max_stop_days: int = 2048
+    ):
+        """
+        This class lists the departures of a station or of a list of stops, in time order.
+        The departures of each stop are read once, sorted by departure time (the departure index of the stop),
+        and filtered by the services running on a service day (the day index of the stop), both kept in LRU caches.
+        A board merges the day indexes of its stops over the previous and the current service days,
+        so that the trips of the previous day departing after midnight are listed with the others.
+        The caches are cleared when the version of the database changes.
+        """
+        self.db = db
+        self.max_stops = max_stops
+        self.max_stop_days = max_stop_days
+        self.version = None
+        # stop_id -> [(departure seconds, trip_id, service_id, arrival_time, departure_time, route_short_name,
+        # route_long_name, trip_headsign)] sorted by departure seconds and trip_id
+        self.stop_departures = OrderedDict()
+        # (stop_id, service date) -> the departures of the stop on the services running that day
+        self.day_departures = OrderedDict()
+        # service date -> IDs of the services running that day
+        self.service_ids = {}
+        # stop_id -> the stop and its child stops
+        self.station_stops = {}
+        self.lock = threading.Lock()
+
+    def check_database_version(self):
+        """
+        Clear the caches if the database has been updated since they were filled.
+        """
+        version = self.db.get_metadata("version") or self.db.get_metadata("updated_at")
+        with self.lock:
+            if version != self.version:
+                self.stop_departures.clear()
+                self.day_departures.clear()
+                self.service_ids.clear()
+                self.station_stops.clear()
+                self.version = version
+
+    def get_station_stops(self, cursor: sqlite3.Cursor, stop_id: str) -> tuple:
+        """
+        Get the stops of a station: the stop itself and its child stops.
+        """
+        stops = self.station_stops.get(stop_id)
+        if stops is not None:
+            return stops
+        # parent_station is not prefixed with the source index like stop_id, so it is compared without the prefix
+        prefix = source_prefix(stop_id)
+        cursor.execute(
+            """
+            SELECT stop_id FROM stops WHERE stop_id = ?
+            UNION
+            SELECT stop_id FROM stops
+            WHERE parent_station = ? AND substr(stop_id, 1, ?) = ?
+            """,
+            (stop_id, stop_id[len(prefix) :], len(prefix), prefix),
+        )
+        stops = tuple(sorted(row[0] for row in cursor.fetchall()))
+        with self.lock:
+            self.station_stops[stop_id] = stops
+        return stops
+
+    def get_service_ids(self, cursor: sqlite3.Cursor, date: datetime.date) -> frozenset:
+        """
+        Get the IDs of the services running on a date, from the calendar and its exceptions.
+        """
+        service_ids = self.service_ids.get(date)
+        if service_ids is not None:
+            return service_ids
+        weekday = date.strftime("%A").lower()
+        date_str = date.strftime("%Y%m%d")
+        cursor.execute(
+            f"""
+            SELECT service_id
+            FROM calendar
+            WHERE ? BETWEEN start_date AND end_date AND {weekday} = 1
+            UNION
+            SELECT service_id
+            FROM calendar_dates
+            WHERE date = ? AND exception_type = 1
+            EXCEPT
+            SELECT service_id
+            FROM calendar_dates
+            WHERE date = ? AND exception_type = 2
+            """,
+            (date_str, date_str, date_str),
+        )
+        service_ids = frozenset(row[0] for row in cursor.fetchall())
+        with self.lock:
+            self.service_ids[date] = service_ids
+        return service_ids
+
+    def get_stop_departures(self, cursor: sqlite3.Cursor, stop_id: str) -> list:
+        """
+        Get the departure index of a stop: all its departures on any service, sorted by departure time.
+        The stop times without pickup are left out.
+        """
+        with self.lock:
+            departures = self.stop_departures.get(stop_id)
+            if departures is not None:
+                self.stop_departures.move_to_end(stop_id)
+                return departures
+        cursor.execute(
+            """
+            SELECT trips.trip_id, trips.service_id, st.arrival_time, st.departure_time,
+                routes.route_short_name, routes.route_long_name, trips.trip_headsign
+            FROM stops
+            JOIN stop_times_v2 AS st ON st.stop_idx = stops.stop_idx
+            JOIN trips ON trips.trip_idx = st.trip_idx
+            LEFT JOIN routes ON routes.route_id = trips.route_id
+            WHERE stops.stop_id = ? AND (st.pickup_type IS NULL OR st.pickup_type != 1)
+            """,
+            (stop_id,),
+        )
+        departures = sorted(
+            ((gtfs_time_to_seconds(row[3]), *row) for row in cursor.fetchall()),
+            key=itemgetter(0, 1),
+        )
+        with self.lock:
+            self.stop_departures[stop_id] = departures
+            if len(self.stop_departures) > self.max_stops:
+                self.stop_departures.popitem(last=False)
+        return departures
+
+    def get_day_departures(
+        self, cursor: sqlite3.Cursor, stop_id: str, date: datetime.date
+    ) -> list:
+        """
+        Get the day index of a stop: its departures on the services running on a service date, sorted by departure time.
+        """
+        key = (stop_id, date)
+        with self.lock:
+            departures = self.day_departures.get(key)
+            if departures is not None:
+                self.day_departures.move_to_end(key)
+                return departures
+        service_ids = self.get_service_ids(cursor, date)
+        departures = [
+            departure
+            for departure in self.get_stop_departures(cursor, stop_id)
+            if departure[2] in service_ids
+        ]
+        with self.lock:
+            self.day_departures[key] = departures
+            if len(self.day_departures) > self.max_stop_days:
+                self.day_departures.popitem(last=False)
+        return departures
+
+    def iter_departures(
+        self,
+        stops: str | list[str],
+        start: datetime.datetime,
+        end: datetime.datetime | None = None,
+        after: str | None = None,
+    ) -> Iterator[Departure]:
+        """
+        Iterate over the departures of a station (all its child stops) given by its stop_id,
+        or of a list of stops, from start to end (BOARD_HORIZON_DAYS after the start service date by default), in time order.
+        after is the page token of a departure returned by get_board, to only iterate over the departures after it.
+        """
+        self.check_database_version()
+        after_key = None
+        if after is not None:
+            after_time, after_stop_id, after_trip_id = after.split("|", 2)
+            after_key = (
+                datetime.datetime.fromisoformat(after_time),
+                after_stop_id,
+                after_trip_id,
+            )
+            start = max(start, after_key[0])
+        first_date = start.date() - datetime.timedelta(days=PREVIOUS_SERVICE_DAYS)
+        last_date = start.date() + datetime.timedelta(days=BOARD_HORIZON_DAYS)
+        if end is None:
+            end = datetime.datetime.combine(
+                last_date + datetime.timedelta(days=1), datetime.time()
+            )
+
+        # The day indexes are read at once, so that no connection is held while the departures are iterated
+        streams = []
+        with self.db.read_connection() as cursor:
+            if isinstance(stops, str):
+                stops = self.get_station_stops(cursor, stops)
+            for stop_id in stops:
+                date = first_date
+                while date <= last_date:
+                    departures = self.get_day_departures(cursor, stop_id, date)
+                    midnight = datetime.datetime.combine(date, datetime.time())
+                    first = bisect.bisect_left(
+                        departures,
+                        (start - midnight).total_seconds(),
+                        key=itemgetter(0),
+                    )
+                    if first < len(departures):
+                        streams.append(
+                            self.iter_day_departures(
+                                stop_id, date, midnight, departures, first
+                            )
+                        )
+                    date += datetime.timedelta(days=1)
+
+        for key, departure in heapq.merge(*streams, key=itemgetter(0)):
+            if key[0] > end:
+                return
+            if after_key is not None and key <= after_key:
+                continue
+            yield departure
+
+    def iter_day_departures(
+        self,
+        stop_id: str,
+        date: datetime.date,
+        midnight: datetime.datetime,
+        departures: list,
+        first: int,
+    ):
+        """
+        Iterate over the departures of a day index from the given index, as ((time, stop_id, trip_id), Departure) tuples.
+        """
+        for index in range(first, len(departures)):
+            (
+                seconds,
+                trip_id,
+                _,
+                arrival_time,
+                departure_time,
+                route_short_name,
+                route_long_name,
+                trip_headsign,
+            ) = departures[index]
+            time = midnight + datetime.timedelta(seconds=seconds)
+            yield (time, stop_id, trip_id), Departure(
+                time,
+                date,
+                stop_id,
+                trip_id,
+                arrival_time,
+                departure_time,
+                route_short_name,
+                route_long_name,
+                trip_headsign,
+            )
+
+    def get_board(
+        self,
+        stops: str | list[str],
+        start: datetime.datetime,
+        limit: int = 20,
+        after: str | None = None,
+    ) -> tuple[list[Departure], str | None]:
+        """
+        Get the next limit departures of a station or of a list of stops (see iter_departures) from start.
+        Returns the departures and the page token to give as after to get the next ones, None if there are no more.
+        """
+        departures = []
+        for departure in self.iter_departures(stops, start, after=after):
+            departures.append(departure)
+            if len(departures) == limit:
+                break
+        if len(departures) < limit:
+            return departures, None
+        last = departures[-1]
+        return departures, f"{last.time.isoformat()}|{last.stop_id}|{last.trip_id}"
@@ -0,0 +1,71 @@
+import json
+from dataclasses import dataclass
+from typing import Literal, Optional
+
+from utils import point_in_polygon
+
+REGIONS_PATH = "regions.json"
+
+
+@dataclass(frozen=True)
+class ImportRegion:
+    """
+    A geographic region to which the GTFS import is limited, given by a bounding box
+    (min_lat, min_lon, max_lat, max_lon) and/or a polygon of (lat, lon) vertices.
+    trips tells what to do with the trips stopping both inside and outside the region:
+    "touch" keeps them whole, "clip" only keeps their stops inside the region.
+    Trips that never stop inside the region are always dropped.
+    """
+
+    name: str
+    bbox: Optional[tuple] = None
+    polygon: Optional[tuple] = None
+    trips: Literal["touch", "clip"] = "touch"
+
+    def __post_init__(self):
+        if self.trips not in ("touch", "clip"):
+            raise ValueError(
+                f"Unknown trips policy {self.trips} for region {self.name}, expected touch or clip"
+            )
+        if self.polygon is not None:
+            polygon = tuple(tuple(point) for point in self.polygon)
+            object.__setattr__(self, "polygon", polygon)
+            if self.bbox is None:
+                lats = [lat for lat, _ in polygon]
+                lons = [lon for _, lon in polygon]
+                bbox = (min(lats), min(lons), max(lats), max(lons))
+                object.__setattr__(self, "bbox", bbox)
+        if self.bbox is None:
+            raise ValueError(f"Region {self.name} needs a bbox or a polygon")
+        object.__setattr__(self, "bbox", tuple(self.bbox))
+
+    def contains(self, lat: float, lon: float) -> bool:
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+            return False
+        return self.polygon is None or point_in_polygon(lat, lon, self.polygon)
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "name": self.name,
+                "bbox": self.bbox,
+                "polygon": self.polygon,
+                "trips": self.trips,
+            }
+        )
+
+    @classmethod
+    def from_json(cls, data: str) -> "ImportRegion":
+        return cls(**json.loads(data))
+
+    @classmethod
+    def load(cls, name: str, path: str = REGIONS_PATH) -> "ImportRegion":
+        """
+        Load a region by its name from the regions file.
+        """
+        with open(path, "r") as file:
+            regions = json.loads(file.read())
+        if name not in regions:
+            raise ValueError(f"Unknown region {name}, expected one of {list(regions)}")
+        return cls(name=name, **regions[name])
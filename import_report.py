@@ -0,0 +1,130 @@
+import datetime
+import json
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+
+class ImportReport:
+    def __init__(self, kind: str):
+        """
+        This class collects the metrics of an import run: download size and time of each source,
+        rows and insert rate of each GTFS file, merge time, errors, build time of each index,
+        and duration and database growth of each phase of the transfer and footpath generation.
+        kind is "full" for a rebuild of the database and "refresh" for an update of the changed sources.
+        The report is stored in the import_runs table of the database, and can be written to a JSON file,
+        so that a slower refresh can be attributed to a source or a step.
+        """
+        self.kind = kind
+        self.started_at = datetime.datetime.now()
+        self.start_time = time.perf_counter()
+        self.feeds = {}
+        self.indexes = {}
+        self.phases = []
+        self.error = None
+        self.lock = threading.Lock()
+
+    def feed(self, name: str) -> dict:
+        with self.lock:
+            return self.feeds.setdefault(name, {"status": "pending"})
+
+    def record_download(self, name: str, download: dict):
+        """
+        Record the download of a source: {"bytes": int, "seconds": float, "status": int}, status being the HTTP status.
+        """
+        self.feed(name)["download"] = download
+
+    def record_skip(self, name: str):
+        self.feed(name)["status"] = "unchanged"
+
+    def record_import(self, name: str, files: dict, seconds: float):
+        """
+        Record the import of a source, files being the statistics returned by Database.populate_database.
+        """
+        feed = self.feed(name)
+        feed["files"] = {
+            table_name: {
+                "rows": stats["rows"],
+                "seconds": round(stats["seconds"], 3),
+                "rows_per_second": round(stats["rows"] / stats["seconds"])
+                if stats["seconds"]
+                else None,
+            }
+            for table_name, stats in files.items()
+        }
+        feed["import_seconds"] = round(seconds, 3)
+
+    def record_merge(self, name: str, seconds: float):
+        feed = self.feed(name)
+        feed["merge_seconds"] = round(seconds, 3)
+        feed["status"] = "imported"
+
+    def record_error(self, name: str, step: str, error: Exception):
+        feed = self.feed(name)
+        feed["status"] = "failed"
+        feed["error"] = {"step": step, "message": str(error)}
+
+    def record_indexes(self, indexes: dict):
+        self.indexes.update(
+            {name: round(seconds, 3) for name, seconds in indexes.items()}
+        )
+
+    def record_phases(self, phases: list):
+        """
+        Record the phases of a TransferGenerator: [{"phase": str, "seconds": float, "size_growth": int}].
+        """
+        self.phases.extend(phases)
+
+    def to_dict(self) -> dict:
+        return {
+            "kind": self.kind,
+            "started_at": self.started_at.isoformat(),
+            "seconds": round(time.perf_counter() - self.start_time, 3),
+            "feeds": self.feeds,
+            "indexes": self.indexes,
+            "phases": self.phases,
+            "error": self.error,
+        }
+
+    def save(self, db_name: str, report_path: Optional[str] = None) -> dict:
+        """
+        Store the report in the import_runs table of the database, and write it to report_path if given.
+        Returns the report as a dict.
+        """
+        report = self.to_dict()
+        failed = [name for name, feed in self.feeds.items() if feed["status"] == "failed"]
+        conn = sqlite3.connect(db_name)
+        conn.execute(
+            """
+            INSERT INTO import_runs (started_at, kind, seconds, feeds, failed_feeds, report)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (
+                report["started_at"],
+                self.kind,
+                report["seconds"],
+                len(self.feeds),
+                len(failed),
+                json.dumps(report),
+            ),
+        )
+        conn.commit()
+        conn.close()
+        if report_path:
+            with open(report_path, "w") as file:
+                json.dump(report, file, indent=2)
+        return report
+
+    def save_failure(
+        self, error: Exception, db_name: str, report_path: Optional[str] = None
+    ):
+        """
+        Record the error that stopped the import run, and save the report like save.
+        An error while saving is only printed, so that it does not hide the error of the import.
+        """
+        self.error = {"type": type(error).__name__, "message": str(error)}
+        try:
+            self.save(db_name, report_path)
+        except Exception as e:
+            print(f"Error saving the import report: {e}")
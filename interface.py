@@ -1,16 +1,23 @@
 import tkinter as tk
 from tkinter import BOTTOM, ttk, messagebox
 from tkintermapview import TkinterMapView
-from database import Database
+from autocomplete import AutocompleteIndex, CompletionWorker
+from database import DEFAULT_IMPORT_PROFILE, SCHEMA_VERSION, Database
 
 from models import StopTime, Stop, Transfer, Trip, JourneyStep
-import sqlite3
 from journey_planner import JourneyPlanner
+from query_cache import QueryCache
+from search_feed import SearchFeed
 import datetime
 import os
 import pytz
 import threading
 
+# Delay without a key press before the completions of the typed text are looked up
+AUTOCOMPLETE_DEBOUNCE_MS = 120
+# Delay between two refreshes of the progress of a database update in the status bar
+UPDATE_POLL_MS = 500
+
 
 class RoutePlannerApp:
     def __init__(self, master: tk.Tk, db_path="railfinder.db"):
@@ -18,7 +25,23 @@ class RoutePlannerApp:
         self.db_path = db_path
         self.db = Database(self.db_path)
         # self.db.load_and_prepare_data()
-        self.planner = JourneyPlanner(self.db)
+        self.planner = JourneyPlanner(self.db, cache=QueryCache(self.db))
+        # Import profile the database must have, set by start_database_update
+        self.import_profile = None
+        # The database is missing until its first import is done, see start_database_update
+        self.database_ready = self.is_database_ready()
+        # Set when the database update and the warm-up running in the background are done
+        self.database_updated = threading.Event()
+        self.warmed_up = threading.Event()
+        self.warmed_up_file = None
+        # Loaded in the background, the stop search is used until it is ready
+        self.autocomplete = AutocompleteIndex(self.db)
+        if self.database_ready:
+            self.autocomplete.load_async()
+        self.completion_worker = CompletionWorker(
+            self.autocomplete, self.planner.search_stop_custom
+        )
+        self.completion_job = None
         self.journey_geometry = []
         self.active_entry = None
         self.loading_label = ttk.Label(
@@ -130,6 +153,10 @@ class RoutePlannerApp:
         self.route_details_text.config(state=tk.DISABLED)
         self.loading_label.destroy()
 
+        # Status bar, showing the progress of the database update
+        self.status_label = ttk.Label(master, text="", anchor="w")
+        self.status_label.pack(side=BOTTOM, fill="x", padx=10)
+
         # Chargement label + progressbar
         self.loading_frame = ttk.Frame(master, relief="raised", padding=15)
         self.loading_label = ttk.Label(
@@ -149,21 +176,108 @@ class RoutePlannerApp:
         self.suggestions_history = set()
 
     # Methods
+    def is_database_ready(self):
+        """Returns True if the database has been imported with the current schema version,
+        and with the import profile of the update if one has been started (see start_database_update).
+        An older database is not used, the loading state is shown until the rebuilt one is swapped in place."""
+        if not os.path.exists(self.db_path):
+            return False
+        with self.db.read_connection() as cursor:
+            if not self.db.get_table_columns(cursor, "stops"):
+                return False
+        if self.db.get_metadata("schema_version") != str(SCHEMA_VERSION):
+            return False
+        return (
+            self.import_profile is None
+            or self.db.get_metadata("import_profile") == self.import_profile
+        )
+
+    def start_database_update(self, data_path, **options):
+        """Checks the freshness of the database and updates it if needed in a background thread,
+        the progress being shown in the status bar. options are passed to Database.update_database.
+        The interface keeps using the current database until the updated one is swapped in place.
+        """
+        result = {}
+        # A database imported with another profile is rebuilt by the update, it is not used until then
+        self.import_profile = options.get("profile", DEFAULT_IMPORT_PROFILE)
+        self.database_ready = self.is_database_ready()
+
+        def update():
+            try:
+                self.db.update_database(data_path, **options)
+            except Exception as e:
+                result["error"] = e
+
+        thread = threading.Thread(target=update, daemon=True)
+        thread.start()
+        if self.database_ready:
+            self.start_warm_up()
+        self.poll_database_update(thread, result, datetime.datetime.now())
+
+    def poll_database_update(self, thread, result, started_at):
+        """Shows the progress of the database update in the status bar.
+        Method called every UPDATE_POLL_MS on the UI thread until the update is done."""
+        if thread.is_alive():
+            elapsed = int((datetime.datetime.now() - started_at).total_seconds())
+            text = f"🔄 Vérification et mise à jour des données... ({elapsed // 60:02}:{elapsed % 60:02})"
+            building_path = self.db_path + ".building"
+            if os.path.exists(building_path):
+                size_mb = os.path.getsize(building_path) / (1024 * 1024)
+                text += f" - {size_mb:.0f} Mo importés"
+            self.status_label.config(text=text)
+            self.master.after(
+                UPDATE_POLL_MS, self.poll_database_update, thread, result, started_at
+            )
+            return
+        if "error" in result:
+            self.status_label.config(
+                text=f"⚠️ Échec de la mise à jour des données : {result['error']}"
+            )
+        else:
+            self.status_label.config(text="✅ Données à jour")
+            self.master.after(5000, lambda: self.status_label.config(text=""))
+        was_ready = self.database_ready
+        self.database_ready = self.is_database_ready()
+        if self.database_ready and not was_ready:
+            self.autocomplete.load_async()
+        self.database_updated.set()
+        # The pages of a swapped database are not in the cache yet
+        if self.database_ready and self.db.get_file_identity() != self.warmed_up_file:
+            self.start_warm_up()
+
+    def start_warm_up(self):
+        """Reads the small tables of the database and warms up the planner caches in a background thread,
+        so that the first searches do not wait for the disk."""
+        self.warmed_up_file = self.db.get_file_identity()
+
+        def warm_up():
+            self.db.warm_up()
+            # Switching the planner to the current version of the database warms up its caches
+            self.planner.begin_request()
+            self.planner.end_request()
+            self.warmed_up.set()
+
+        threading.Thread(target=warm_up, daemon=True).start()
+
     def get_all_stop_names(self):
         """
         Returns a sorted list of all unique stop names from the database.
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT stop_id, stop_name, stop_lat, stop_lon FROM stops")
-        stops = [Stop(*row) for row in cursor.fetchall()]
-        conn.close()
-        return sorted(set(stop.stop_name for stop in stops if stop.stop_name))
+        return sorted(
+            {stop_name for (stop_name,) in self.db.iter_rows("stops", ("stop_name",))}
+            - {None, ""}
+        )
 
     def calculate_route(self):
         """Calculates the route based on the data entered by the user.
         Displays the route details and draws the route on the map.
         """
+        if not self.database_ready:
+            messagebox.showinfo(
+                "Données en cours de chargement",
+                "Les données sont en cours de téléchargement, veuillez patienter.",
+            )
+            return
 
         def route_calculation():
             """
@@ -199,6 +313,7 @@ class RoutePlannerApp:
                 self.map_canvas.delete("all")
                 self.tracage_map()
                 self.loading_bar.stop()
+                self.loading_label.config(text="🔄 Calcul de l'itinéraire...")
                 self.loading_frame.place_forget()
                 self.departure_city_entry.config(state="normal")
                 self.arrival_city_entry.config(state="normal")
@@ -280,45 +395,113 @@ class RoutePlannerApp:
             self.master.after(0, update_ui)
 
             if from_stop_id and to_stop_id:
-                p, execution_time = self.planner.journey_search(
-                    from_stop_id,
-                    to_stop_id,
-                    departure_datetime_utc,
-                    "fastest" if preference == "Le plus rapide" else "least_transfers",
-                    max_execution_time_seconds=300,  # 5 minutes
-                    gui=self,
-                )
+                feed = SearchFeed()
+                self.master.after(0, self.poll_search_feed, feed)
                 result_str = ""
-                if p is not None:
-                    journey_steps = self.planner.get_journey_details(p, tz=local_tz)
-                    summary = self.planner.get_journey_summary_fr(journey_steps)
-                    result_str += f"Temps d'exécution de la recherche: {execution_time:.2f} secondes\n"
-                    result_str += summary
-                    self.journey_geometry = []
-                    line = self.planner.get_journey_geometry(journey_steps)
-                    if line:
-                        self.journey_geometry = line
-                else:
-                    result_str += "Aucun trajet trouvé.\n"
+                try:
+                    # All the stops of the departure and arrival stations are searched at once
+                    p, execution_time = self.planner.journey_search_area(
+                        departure,
+                        arrival,
+                        departure_datetime_utc,
+                        "fastest" if preference == "Le plus rapide" else "least_transfers",
+                        max_execution_time_seconds=300,  # 5 minutes
+                        feed=feed,
+                    )
+                    if p is not None:
+                        journey_steps = self.planner.get_journey_details(p, tz=local_tz)
+                        summary = self.planner.get_journey_summary_fr(journey_steps)
+                        result_str += f"Temps d'exécution de la recherche: {execution_time:.2f} secondes\n"
+                        result_str += summary
+                        self.journey_geometry = []
+                        line = self.planner.get_journey_geometry(journey_steps)
+                        if line:
+                            self.journey_geometry = line
+                    else:
+                        result_str += "Aucun trajet trouvé.\n"
+                except Exception as e:
+                    result_str += f"Erreur lors du calcul de l'itinéraire: {e}\n"
+                finally:
+                    # Stops the polling of the map even if the calculation failed
+                    feed.close()
 
                 self.master.after(0, update_ui_final)
 
         threading.Thread(target=route_calculation).start()
 
+    def poll_search_feed(self, feed: SearchFeed, explored_stops: int = 0):
+        """Draws the state of the running journey search on the map.
+        Method called every 40 ms on the UI thread while the search is running, all the pending updates
+        are coalesced into a single frame so the map is redrawn at most once per call.
+        The updates still pending when the search ends are drawn before stopping.
+        """
+        frame = feed.drain()
+        if frame["bounds"]:
+            (start_lat, start_lon), (final_lat, final_lon) = frame["bounds"]
+            self.map_canvas.set_position(
+                (start_lat + final_lat) / 2, (start_lon + final_lon) / 2
+            )
+            self.map_canvas.set_zoom(7)
+        if frame["explored"]:
+            explored_stops += frame["explored"]
+            self.loading_label.config(
+                text=f"🔄 Calcul de l'itinéraire... ({explored_stops} arrêts explorés)"
+            )
+        if frame["path"]:
+            self.map_canvas.delete_all_path()
+            self.map_canvas.set_path(frame["path"], color="purple", width=3)
+        if feed.is_closed():
+            return
+        self.master.after(40, self.poll_search_feed, feed, explored_stops)
+
     def auto_completion_proposition(self, event):
         """Displays auto-completion suggestions for the departure, arrival, and intermediate stop entry fields.
         Method called every time a key is released in one of the entry fields.
+        The suggestions of a recent text are displayed at once, the others are looked up by the completion worker
+        once no key has been pressed for AUTOCOMPLETE_DEBOUNCE_MS.
         """
         widget = event.widget
         self.active_entry = widget
         input_text = widget.get()
 
+        if not self.database_ready:
+            return
+
+        if self.completion_job is not None:
+            self.master.after_cancel(self.completion_job)
+            self.completion_job = None
+
         if not input_text:
+            self.completion_worker.cancel()
             self.suggestions_listbox.delete(0, tk.END)
             self.suggestions_listbox.place_forget()
             return
 
-        self.suggestions = self.planner.search_stop_custom(input_text)
+        suggestions = self.completion_worker.cached(input_text)
+        if suggestions is not None:
+            self.completion_worker.cancel()
+            self.show_suggestions(widget, input_text, suggestions)
+            return
+
+        self.completion_job = self.master.after(
+            AUTOCOMPLETE_DEBOUNCE_MS, self.request_suggestions, widget, input_text
+        )
+
+    def request_suggestions(self, widget, input_text):
+        """Sends the text to the completion worker, the suggestions are displayed from the Tkinter thread."""
+        self.completion_job = None
+        self.completion_worker.submit(
+            input_text,
+            lambda text, suggestions: self.master.after(
+                0, self.show_suggestions, widget, text, suggestions
+            ),
+        )
+
+    def show_suggestions(self, widget, input_text, suggestions):
+        """Displays the suggestions of a text under the entry field, unless the text has changed since."""
+        if widget is not self.active_entry or widget.get() != input_text:
+            return
+        self.suggestions = suggestions
         self.suggestions_names = [s[1] for s in self.suggestions]
         self.suggestions_history.update(set(self.suggestions))
 
@@ -395,14 +578,12 @@ class RoutePlannerApp:
         """
         Returns (lat, lon), the latitude and longitude coordinates for a given stop_name, or None if not found.
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT stop_id, stop_name, stop_lat, stop_lon FROM stops WHERE stop_name = ? COLLATE NOCASE",
-            (stop_name,),
-        )
-        row = cursor.fetchone()
-        conn.close()
+        with self.db.read_connection() as cursor:
+            cursor.execute(
+                "SELECT stop_id, stop_name, stop_lat, stop_lon FROM stops WHERE stop_name = ? COLLATE NOCASE",
+                (stop_name,),
+            )
+            row = cursor.fetchone()
         if row:
             stop = Stop(*row)
             return stop.stop_lat, stop.stop_lon
@@ -441,13 +622,11 @@ class RoutePlannerApp:
         """
         Returns the stop_id for a given stop_name, or None if not found.
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT stop_id FROM stops WHERE stop_name = ? COLLATE NOCASE", (stop_name,)
-        )
-        row = cursor.fetchone()
-        conn.close()
+        with self.db.read_connection() as cursor:
+            cursor.execute(
+                "SELECT stop_id FROM stops WHERE stop_name = ? COLLATE NOCASE", (stop_name,)
+            )
+            row = cursor.fetchone()
         return row[0] if row else None
 
 
@@ -1,37 +1,120 @@
-from calendar import c
 import datetime
+import math
 import re
 import sqlite3
-from turtle import st
+import threading
+from functools import wraps
 from typing import Literal
-import tkinter as tk
 import pytz
 
 
 from database import Database
+from departure_board import DepartureBoard
 from models import JourneyStep
+from search_feed import SearchFeed
 import heapq
-from utils import geodistance
+import itertools
+from query_cache import QueryCache
+from realtime_overlay import RealtimeOverlay, RealtimeSnapshot
+from utils import (
+    geodistance,
+    geodistance_meters,
+    gtfs_time_to_seconds,
+    seconds_to_gtfs_time,
+)
+
+# Virtual node of the journey search, linked to all the target stops by their walking time to the destination
+DESTINATION = "__destination__"
+
+
+def database_request(method):
+    """
+    Mark a JourneyPlanner method as a request on the database, during which the planner does not switch
+    to a new version of the database.
+    """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.begin_request()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.end_request()
+
+    return wrapper
 
 
 class JourneyPlanner:
-    def __init__(self, db: Database):
+    def __init__(
+        self,
+        db: Database,
+        overlay: RealtimeOverlay | None = None,
+        cache: QueryCache | None = None,
+    ):
         self.db = db
-        self._last_date = None
+        self.overlay = overlay
+        self.cache = cache
+        self.departure_board = DepartureBoard(db)
+        self.db_version = None
+        self.active_requests = 0
+        self.version_lock = threading.Lock()
+
+    def begin_request(self):
+        """
+        Start a request, switching to the new version of the database first if it has been swapped
+        and no other request is still running on the previous one.
+        """
+        with self.version_lock:
+            if self.active_requests == 0:
+                version = self.db.get_metadata("version")
+                if version != self.db_version:
+                    if self.db_version is not None:
+                        print(f"Switching to database version {version}")
+                    self.db_version = version
+                    threading.Thread(target=self.warm_caches, daemon=True).start()
+            self.active_requests += 1
+
+    def end_request(self):
+        with self.version_lock:
+            self.active_requests -= 1
+
+    def warm_caches(self):
+        """
+        Rebuild the in-memory caches of the planner for the current version of the database.
+        """
+        with self.db.read_connection() as cursor:
+            self.has_footpaths(cursor)
+        if self.cache is not None:
+            with self.cache.lock:
+                self.cache.check_database_version()
 
     def search_stop(self, name: str, limit: int = 10):
         """
         Get all stops that match the given name.
-        This searches for stops whose names start with the given name, sorted by relevance.
-        The relevance is determined by how closely the stop name matches the search term.
+        The words of the name are searched as prefixes of the words of the stop names and aliases in the stop_search
+        full-text index, ignoring case and accents, and the stops are sorted by importance (their number of stop times, see Database.build_stop_search_index).
+        On a database without the stop_search table, this searches for stops whose names start with the given name.
         """
-        conn, cursor = self.db.get_connection()
-        cursor.execute(
-            "SELECT stop_id, stop_name FROM stops WHERE stop_name LIKE ? ORDER BY (stop_name LIKE ?) DESC LIMIT ?",
-            (f"{name}%", f"%{name}%", limit),
-        )  # TODO: Sort by relevance using the source of the stop: train, bus, tram
-        stops = cursor.fetchall()
-        conn.close()
+        with self.db.read_connection() as cursor:
+            if not self.db.get_table_columns(cursor, "stop_search"):
+                cursor.execute(
+                    "SELECT stop_id, stop_name FROM stops WHERE stop_name LIKE ? ORDER BY (stop_name LIKE ?) DESC LIMIT ?",
+                    (f"{name}%", f"%{name}%", limit),
+                )
+                return cursor.fetchall()
+            words = re.findall(r"\w+", name)
+            if not words:
+                return []
+            cursor.execute(
+                """
+                SELECT stop_id, stop_name FROM stop_search
+                WHERE stop_search MATCH ?
+                ORDER BY rowid
+                LIMIT ?
+                """,
+                (" ".join(f'"{word}"*' for word in words), limit),
+            )
+            stops = cursor.fetchall()
         return stops
 
     def search_stop_custom(self, name: str, limit: int = 10):
@@ -66,6 +149,7 @@ class JourneyPlanner:
 
         return stops
 
+    @database_request
     def list_departures(
         self,
         stop_id: str,
@@ -74,54 +158,29 @@ class JourneyPlanner:
         limit: int = 10,
     ):
         """
-        Get all departures from a stop in a given time range.
+        Get the departures from a stop in the hour following date + time_delta, including the trips
+        of the previous service day departing after midnight.
+        Returns (trip_id, arrival_time, departure_time, route_short_name, route_long_name, trip_headsign) tuples,
+        see DepartureBoard for boards of whole stations.
         """
-        conn, cursor = self.db.get_connection()
         start_time = date + time_delta
         end_time = start_time + datetime.timedelta(hours=1)
-        weekday = start_time.strftime("%A").lower()
-        sql = f"""
-        SELECT DISTINCT stop_times.trip_id, stop_times.arrival_time, stop_times.departure_time, routes.route_short_name, routes.route_long_name, trips.trip_headsign
-        FROM stop_times
-        JOIN trips ON stop_times.trip_id = trips.trip_id
-        JOIN routes ON trips.route_id = routes.route_id
-        WHERE stop_times.stop_id = ?
-          AND stop_times.departure_time BETWEEN ? AND ?
-          AND (
-            (
-              trips.service_id IN (
-                SELECT service_id FROM calendar
-                WHERE ? BETWEEN start_date AND end_date
-                  AND {weekday} = 1
-              )
-              AND trips.service_id NOT IN (
-                SELECT service_id FROM calendar_dates
-                WHERE date = ? AND exception_type = 2
-              )
-            )
-            OR trips.service_id IN (
-              SELECT service_id FROM calendar_dates
-              WHERE date = ? AND exception_type = 1
-            )
-          )
-        ORDER BY stop_times.arrival_time
-        LIMIT ?
-        """
-
-        cursor.execute(
-            sql,
-            (
-                stop_id,
-                start_time.strftime("%H:%M:%S"),
-                end_time.strftime("%H:%M:%S"),
-                start_time.strftime("%Y%m%d"),
-                start_time.strftime("%Y%m%d"),
-                start_time.strftime("%Y%m%d"),
-                limit,
-            ),
-        )
-        departures = cursor.fetchall()
-        conn.close()
+        departures = []
+        for departure in self.departure_board.iter_departures(
+            [stop_id], start_time, end_time
+        ):
+            if len(departures) == limit:
+                break
+            departures.append(
+                (
+                    departure.trip_id,
+                    departure.arrival_time,
+                    departure.departure_time,
+                    departure.route_short_name,
+                    departure.route_long_name,
+                    departure.trip_headsign,
+                )
+            )
         return departures
 
     def get_neighbors_stop_times(
@@ -132,10 +191,15 @@ class JourneyPlanner:
         limit: int = 10,
         conn: sqlite3.Connection | None = None,
         cursor: sqlite3.Cursor | None = None,
+        trips_per_stop: int = 1,
+        realtime: RealtimeSnapshot | None = None,
     ):
         """
         Find all next stop_times reachable from the given stop and time, on valid trips.
         Precompute valid service IDs for the given date and time, this has improved performance by 351%
+        By default only the earliest arrival at each reachable stop is returned, trips_per_stop allows
+        to get the earliest arrivals of several trips per stop (used to find alternative journeys).
+        If a realtime snapshot with updates is given, delays are applied and canceled trips and skipped stops are ignored.
         """
         if conn is None or cursor is None:
             conn, cursor = self.db.get_connection()
@@ -149,8 +213,9 @@ class JourneyPlanner:
         # Track the current date
         current_date = start_time.date()
 
-        # If the temporary table doesn't exist or the date has changed, recreate it
-        if self._last_date != current_date:
+        # If the temporary table doesn't exist on this connection or the date has changed, recreate it
+        state = self.get_connection_state(cursor)
+        if state.get("valid_service_date") != current_date:
             cursor.execute("DROP TABLE IF EXISTS valid_service_ids")
             weekday = start_time.strftime("%A").lower()
             cursor.execute(
@@ -177,27 +242,62 @@ class JourneyPlanner:
             cursor.execute(
                 "CREATE INDEX idx_valid_service_ids ON valid_service_ids(service_id);"
             )
-            self._last_date = current_date
+            state["valid_service_date"] = current_date
 
         sql = f"""
         SELECT 
-            st2.stop_id,
+            stops.stop_id,
             MIN(st2.arrival_time) AS earliest_arrival,
             trips.trip_id,
             stops.stop_lat,
             stops.stop_lon
-        FROM stop_times AS st1
-        JOIN stop_times AS st2 
-            ON st1.trip_id = st2.trip_id 
+        FROM stops AS from_stop
+        JOIN stop_times_v2 AS st1 ON st1.stop_idx = from_stop.stop_idx
+        JOIN stop_times_v2 AS st2 
+            ON st1.trip_idx = st2.trip_idx 
             AND st2.stop_sequence > st1.stop_sequence
-        JOIN trips ON st1.trip_id = trips.trip_id
-        JOIN stops ON st2.stop_id = stops.stop_id
-        WHERE st1.stop_id = ?
+        JOIN trips ON st1.trip_idx = trips.trip_idx
+        JOIN stops ON st2.stop_idx = stops.stop_idx
+        WHERE from_stop.stop_id = ?
           AND st1.departure_time BETWEEN ? AND ?
           AND trips.service_id IN valid_service_ids
-        GROUP BY st2.stop_id
+        GROUP BY st2.stop_idx
         LIMIT ?
         """
+        if realtime is not None and realtime.trips:
+            neighbors_stop_times = self.get_realtime_neighbors_stop_times(
+                from_stop_id, start_time, end_time, limit, cursor, trips_per_stop, realtime
+            )
+            if close_conn:
+                conn.close()
+            return neighbors_stop_times
+        if trips_per_stop > 1:
+            sql = f"""
+            SELECT stop_id, arrival_time, trip_id, stop_lat, stop_lon
+            FROM (
+                SELECT
+                    stops.stop_id,
+                    st2.arrival_time,
+                    trips.trip_id,
+                    stops.stop_lat,
+                    stops.stop_lon,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY st2.stop_idx ORDER BY st2.arrival_time
+                    ) AS arrival_rank
+                FROM stops AS from_stop
+                JOIN stop_times_v2 AS st1 ON st1.stop_idx = from_stop.stop_idx
+                JOIN stop_times_v2 AS st2
+                    ON st1.trip_idx = st2.trip_idx
+                    AND st2.stop_sequence > st1.stop_sequence
+                JOIN trips ON st1.trip_idx = trips.trip_idx
+                JOIN stops ON st2.stop_idx = stops.stop_idx
+                WHERE from_stop.stop_id = ?
+                  AND st1.departure_time BETWEEN ? AND ?
+                  AND trips.service_id IN valid_service_ids
+            )
+            WHERE arrival_rank <= {int(trips_per_stop)}
+            LIMIT ?
+            """
 
         # Debug: Print the query plan
         """cursor.execute(f"EXPLAIN QUERY PLAN {sql}", (
@@ -225,6 +325,99 @@ class JourneyPlanner:
             conn.close()
         return neighbors_stop_times
 
+    def get_realtime_neighbors_stop_times(
+        self,
+        from_stop_id: str,
+        start_time: datetime.datetime,
+        end_time: datetime.datetime,
+        limit: int,
+        cursor: sqlite3.Cursor,
+        trips_per_stop: int,
+        realtime: RealtimeSnapshot,
+    ):
+        """
+        Same as get_neighbors_stop_times, with the delays of the realtime snapshot applied.
+        The departure window starts earlier by the maximum delay of the snapshot, so that delayed trips
+        scheduled before the current time can still be caught, and the earliest arrivals are computed in Python.
+        The valid service IDs table must already exist on the cursor connection.
+        """
+        lookback_start = start_time - datetime.timedelta(seconds=realtime.max_delay)
+        if lookback_start.date() < start_time.date():
+            lookback_start_str = "00:00:00"
+        else:
+            lookback_start_str = lookback_start.strftime("%H:%M:%S")
+        cursor.execute(
+            """
+            SELECT
+                stops.stop_id,
+                st2.arrival_time,
+                trips.trip_id,
+                stops.stop_lat,
+                stops.stop_lon,
+                st1.departure_time,
+                st1.stop_sequence,
+                st2.stop_sequence
+            FROM stops AS from_stop
+            JOIN stop_times_v2 AS st1 ON st1.stop_idx = from_stop.stop_idx
+            JOIN stop_times_v2 AS st2
+                ON st1.trip_idx = st2.trip_idx
+                AND st2.stop_sequence > st1.stop_sequence
+            JOIN trips ON st1.trip_idx = trips.trip_idx
+            JOIN stops ON st2.stop_idx = stops.stop_idx
+            WHERE from_stop.stop_id = ?
+              AND st1.departure_time BETWEEN ? AND ?
+              AND trips.service_id IN valid_service_ids
+            """,
+            (from_stop_id, lookback_start_str, end_time.strftime("%H:%M:%S")),
+        )
+        current_seconds = gtfs_time_to_seconds(start_time.strftime("%H:%M:%S"))
+        arrivals = {}
+        for (
+            stop_id,
+            arrival_time,
+            trip_id,
+            stop_lat,
+            stop_lon,
+            departure_time,
+            from_sequence,
+            to_sequence,
+        ) in cursor.fetchall():
+            if (
+                realtime.is_canceled(trip_id)
+                or realtime.is_skipped(trip_id, from_sequence, from_stop_id)
+                or realtime.is_skipped(trip_id, to_sequence, stop_id)
+            ):
+                continue
+            departure_seconds = gtfs_time_to_seconds(departure_time) + realtime.get_delay(
+                trip_id, from_sequence, from_stop_id, departure=True
+            )
+            if departure_seconds < current_seconds:
+                continue
+            arrival_seconds = gtfs_time_to_seconds(arrival_time) + realtime.get_delay(
+                trip_id, to_sequence, stop_id
+            )
+            arrivals.setdefault(stop_id, []).append(
+                (arrival_seconds, trip_id, stop_lat, stop_lon)
+            )
+        neighbors_stop_times = []
+        for stop_id, stop_arrivals in arrivals.items():
+            stop_arrivals.sort()
+            for arrival_seconds, trip_id, stop_lat, stop_lon in stop_arrivals[
+                :trips_per_stop
+            ]:
+                neighbors_stop_times.append(
+                    (
+                        stop_id,
+                        seconds_to_gtfs_time(arrival_seconds),
+                        trip_id,
+                        stop_lat,
+                        stop_lon,
+                    )
+                )
+        if limit >= 0:
+            neighbors_stop_times = neighbors_stop_times[:limit]
+        return neighbors_stop_times
+
     def get_transfers(
         self,
         from_stop_id: str,
@@ -234,27 +427,63 @@ class JourneyPlanner:
     ):
         """
         Get all transfers from a stop within a maximum duration.
+        If the footpaths table has been built, all the footpaths of the stop are returned at once,
+        as the footpath graph is transitively closed, there is no need to walk again from the reached stops.
+        Returns a list of tuples (from_stop_id, to_stop_id, duration, to_stop_lat, to_stop_lon).
         """
         if conn is None or cursor is None:
-            conn, cursor = self.db.get_connection()
-            close_conn = True
+            with self.db.read_connection() as cursor:
+                return self.get_transfers(
+                    from_stop_id, max_duration, cursor.connection, cursor
+                )
+        if self.has_footpaths(cursor):
+            sql = """
+            SELECT
+                s1.stop_id,
+                s2.stop_id,
+                f.duration,
+                s2.stop_lat,
+                s2.stop_lon
+            FROM stops AS s1
+            JOIN footpaths AS f ON f.from_stop_idx = s1.stop_idx
+            JOIN stops AS s2 ON s2.stop_idx = f.to_stop_idx
+            WHERE s1.stop_id = ? AND f.duration <= ?
+            """
         else:
-            close_conn = False
-        sql = """
-        SELECT 
-            t.from_stop_id, 
-            t.to_stop_id, 
-            t.min_transfer_time
-        FROM transfers AS t
-        JOIN stops AS s1 ON t.from_stop_id = s1.stop_id
-        JOIN stops AS s2 ON t.to_stop_id = s2.stop_id
-        WHERE t.from_stop_id = ? AND t.min_transfer_time <= ?
-        """
+            sql = """
+            SELECT 
+                t.from_stop_id, 
+                t.to_stop_id, 
+                t.min_transfer_time,
+                s2.stop_lat,
+                s2.stop_lon
+            FROM transfers AS t
+            JOIN stops AS s1 ON t.from_stop_id = s1.stop_id
+            JOIN stops AS s2 ON t.to_stop_id = s2.stop_id
+            WHERE t.from_stop_id = ? AND t.min_transfer_time <= ?
+            """
         cursor.execute(sql, (from_stop_id, max_duration))
-        transfers = cursor.fetchall()
-        if close_conn:
-            conn.close()
-        return transfers
+        return cursor.fetchall()
+
+    def get_connection_state(self, cursor: sqlite3.Cursor) -> dict:
+        """
+        Get the state the planner keeps about the connection of a cursor (see database.Connection),
+        so that it always matches the file read by the connection, even if the database is swapped during a request.
+        Connections not opened by Database get an empty state each time.
+        """
+        return getattr(cursor.connection, "state", {})
+
+    def has_footpaths(self, cursor: sqlite3.Cursor) -> bool:
+        """
+        Check once per connection whether the transitively closed footpaths table exists in the database.
+        """
+        state = self.get_connection_state(cursor)
+        if "has_footpaths" not in state:
+            cursor.execute(
+                "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='footpaths'"
+            )
+            state["has_footpaths"] = cursor.fetchone()[0] > 0
+        return state["has_footpaths"]
 
     def parse_gtfs_time(
         self, date_reference: datetime.datetime, time_str: str
@@ -291,7 +520,8 @@ class JourneyPlanner:
         Returns a tuple (latitude, longitude) or None if the stop is not found.
         """
         if conn is None or cursor is None:
-            conn, cursor = self.db.get_connection()
+            with self.db.read_connection() as cursor:
+                return self.get_stop_pos(stop_id, cursor.connection, cursor)
         sql = """SELECT stop_lat, stop_lon FROM stops WHERE stop_id = ?"""
         cursor.execute(sql, (stop_id,))
         return cursor.fetchone()
@@ -347,16 +577,24 @@ class JourneyPlanner:
         """
         return t[0], t[1]
 
-    def update_gui(self, gui, path: list[tuple[float, float]]):
+    def publish_search_state(
+        self,
+        feed: SearchFeed,
+        path: list[tuple],
+        explored: int,
+        stop_coords: dict[str, tuple[float, float]],
+    ):
         """
-        Update the GUI with the current state of the journey search.
-        If a GUI is provided, it will update the marker position and redraw the map.
+        Publish the current state of the journey search to the visualization feed.
+        The path is converted to coordinates using the in-memory stop coordinates, so no database query is made.
         """
-        journey_steps = self.get_journey_details(path)
-        geometry = self.get_journey_geometry(journey_steps)
-        gui.map_canvas.delete_all_path()
-        gui.map_canvas.set_path(geometry, color="purple", width=3)
+        if explored:
+            feed.publish("explored", explored)
+        coords = [stop_coords[node[0]] for node in path if node[0] in stop_coords]
+        if len(coords) > 1:
+            feed.publish("path", coords)
 
+    @database_request
     def journey_search(
         self,
         from_stop_id: str,
@@ -365,7 +603,11 @@ class JourneyPlanner:
         mode: 'Literal["fastest", "least_transfers"]' = "fastest",
         max_rides: int = -1,
         max_execution_time_seconds: int = 60,
-        gui=None,
+        feed: SearchFeed | None = None,
+        sources: list[tuple[str, datetime.datetime]] | None = None,
+        conn: sqlite3.Connection | None = None,
+        cursor: sqlite3.Cursor | None = None,
+        targets: dict[str, int] | None = None,
     ):
         """
         Search for a journey from one stop to another with a maximum number of transfers.
@@ -374,6 +616,12 @@ class JourneyPlanner:
         If the trip_id is None, it means the stop is a transfer and the time is the arrival time at that stop.
         The heuristic is based on the geographical distance between the stops.
         It assumes a straight line distance in km, converted to time in seconds, with constant speed.
+        If a SearchFeed is provided, the search state is published to it every 40 ms for visualization.
+        sources are additional (stop_id, time) origins, the search starts from all of them at once
+        and the returned path starts from the one giving the best journey.
+        targets are additional destination stops, with the walking time in seconds from each of them to the final destination,
+        the search ends at the stop giving the earliest arrival at the final destination.
+        If a connection is provided, it is kept open and its valid service IDs table is reused by the next searches.
         """
         if mode not in ["fastest", "least_transfers"]:
             raise ValueError(
@@ -387,190 +635,794 @@ class JourneyPlanner:
             max_rides = 20
             mode_int = 0
         start_execution_time = datetime.datetime.now()
-        conn, cursor = self.db.get_connection()
+        close_conn = False
+        try:
+            # The realtime snapshot is taken once, so the whole search sees consistent delays
+            realtime = self.overlay.snapshot() if self.overlay else None
+
+            # Only plain stop to stop searches on the static timetable are cached
+            use_cache = (
+                self.cache is not None
+                and not sources
+                and not targets
+                and (realtime is None or not realtime.trips)
+            )
+            if use_cache:
+                path = self.cache.get(from_stop_id, to_stop_id, departure, mode)
+                if path is not None:
+                    execution_time_seconds = (
+                        datetime.datetime.now() - start_execution_time
+                    ).total_seconds()
+                    return path, execution_time_seconds
+
+            if conn is None or cursor is None:
+                conn, cursor = self.db.get_connection()
+                close_conn = True
+
+            # Increase cache size and use memory for temporary tables, improves performance by ~200%
+            cursor.execute("PRAGMA cache_size = 20000")
+            cursor.execute("PRAGMA temp_store = MEMORY")
+
+            visited = set()
+            previous = {}
+            start_pos = self.get_stop_pos(from_stop_id, conn, cursor)
+            stop_pos = self.get_stop_pos(to_stop_id, conn, cursor)
+            if not start_pos or not stop_pos:
+                return None, 0.0
+            final_lat, final_lon = stop_pos
+
+            # Stop coordinates seen during the search, used to publish the search state without querying the database
+            stop_coords = {from_stop_id: tuple(start_pos), to_stop_id: tuple(stop_pos)}
+            explored = 0
+            if feed:
+                feed.publish("bounds", [tuple(start_pos), tuple(stop_pos)])
+
+            target_offsets = {to_stop_id: 0}
+            target_offsets.update(targets or {})
+            # Target stops with a walking time are linked to a virtual destination node, reached at time -> (stop_id, time)
+            destination_previous = {}
+
+            priority_queue = []  # (cost, stop_id, time, ride_count, transfert_duration)
+            earliest_arrival = {}
+            best_cost = {}  # Track the best cost to each stop
+            for source_stop_id, source_time in [(from_stop_id, departure)] + (
+                sources or []
+            ):
+                if source_time >= earliest_arrival.get(
+                    source_stop_id, datetime.datetime.max
+                ):
+                    continue
+                previous[(source_stop_id, source_time)] = (source_stop_id, source_time)
+                earliest_arrival[source_stop_id] = source_time
+                best_cost[source_stop_id] = int(
+                    (source_time - departure).total_seconds()
+                )
+                priority_queue.append(
+                    (best_cost[source_stop_id], source_stop_id, source_time, 0, 0)
+                )
+            heapq.heapify(priority_queue)
+            found = False
+
+            nodes_processed = 0
+
+            neighbor_search_window = datetime.timedelta(hours=5)
+            update_start_time = datetime.datetime.now()
+            while len(priority_queue) > 0 and not found:
+                if (
+                    nodes_processed % 1000 == 0
+                    and datetime.datetime.now() - start_execution_time
+                    > datetime.timedelta(seconds=max_execution_time_seconds)
+                ):
+                    break
+                u = heapq.heappop(priority_queue)
+                current_cost = u[0]
+                current_stop_id = u[1]
+                current_time = u[2]
+                current_ride_count = u[3]
+                current_transfert_duration = u[4]
+
+                if current_stop_id == DESTINATION:
+                    current_stop_id, current_time = destination_previous[current_time]
+                    found = True
+                    break
+
+                if (
+                    feed
+                    and datetime.datetime.now() - update_start_time
+                    > datetime.timedelta(milliseconds=40)
+                ):
+                    path = self.reconstruct_path(
+                        previous, current_stop_id, current_time
+                    )
+                    self.publish_search_state(feed, path, explored, stop_coords)
+                    explored = 0
+                    update_start_time = datetime.datetime.now()
+
+                # Skip if this path is not optimal
+                if current_cost > best_cost.get(current_stop_id, float("inf")):
+                    continue
+
+                if max_rides >= 0 and current_ride_count > max_rides + 1:
+                    continue
+
+                """print(
+                    f"Processing node {nodes_processed}: {current_stop_id} at {current_time.strftime('%H:%M:%S')} with cost {current_cost}, ride count {current_ride_count}, transfer duration {current_transfert_duration}"
+                )"""
+                egress = target_offsets.get(current_stop_id)
+                if egress == 0:
+                    found = True
+                else:
+                    if egress is not None:
+                        destination_time = current_time + datetime.timedelta(
+                            seconds=egress
+                        )
+                        if destination_time not in destination_previous:
+                            destination_previous[destination_time] = (
+                                current_stop_id,
+                                current_time,
+                            )
+                            heapq.heappush(
+                                priority_queue,
+                                (
+                                    current_cost + egress,
+                                    DESTINATION,
+                                    destination_time,
+                                    current_ride_count,
+                                    current_transfert_duration,
+                                ),
+                            )
+                    for v in self.get_neighbors_stop_times(
+                        current_stop_id,
+                        current_time,
+                        neighbor_search_window,
+                        limit=-1,
+                        conn=conn,
+                        cursor=cursor,
+                        realtime=realtime,
+                    ):
+                        v_datetime = self.parse_gtfs_time(current_time, v[1])
+                        if not v_datetime:
+                            continue
+                        if (v[0], v_datetime) not in visited and (
+                            v_datetime
+                            < earliest_arrival.get(v[0], datetime.datetime.max)
+                        ):
+                            vlat = v[3]
+                            vlon = v[4]
+                            trip_id = v[2]
+                            visited.add((v[0], v_datetime))
+                            if feed:
+                                stop_coords[v[0]] = (vlat, vlon)
+                                explored += 1
+                            previous[(v[0], v_datetime)] = (
+                                current_stop_id,
+                                current_time,
+                                trip_id,
+                            )
+                            earliest_arrival[v[0]] = v_datetime
+                            h = self.heuristic(
+                                vlat,
+                                vlon,
+                                final_lat,
+                                final_lon,
+                                current_ride_count + 1,
+                                current_transfert_duration,
+                                mode_int=mode_int,
+                            )
+                            cost = int((v_datetime - departure).total_seconds() + h)
+                            # Update best cost and push to queue
+                            if cost < best_cost.get(v[0], float("inf")):
+                                best_cost[v[0]] = cost
+                                heapq.heappush(
+                                    priority_queue,
+                                    (
+                                        cost,
+                                        v[0],
+                                        v_datetime,
+                                        current_ride_count + 1,
+                                        current_transfert_duration,
+                                    ),
+                                )
+                    # With closed footpaths, a stop reached by walking has nothing more to walk to
+                    previous_node = previous[(current_stop_id, current_time)]
+                    if self.has_footpaths(cursor) and (
+                        len(previous_node) > 2 and previous_node[2] is None
+                    ):
+                        transfers = []
+                    else:
+                        transfers = self.get_transfers(
+                            current_stop_id, conn=conn, cursor=cursor
+                        )
+                    for t in transfers:
+                        t_datetime = current_time + datetime.timedelta(seconds=t[2])
+                        if (t[1], t_datetime) not in visited and (
+                            t_datetime
+                            < earliest_arrival.get(t[1], datetime.datetime.max)
+                        ):
+                            visited.add((t[1], t_datetime))
+                            tlat, tlon = t[3], t[4]
+                            if feed:
+                                stop_coords[t[1]] = (tlat, tlon)
+                                explored += 1
+                            previous[(t[1], t_datetime)] = (
+                                current_stop_id,
+                                current_time,
+                                None,
+                            )
+                            earliest_arrival[t[1]] = t_datetime
+                            h = self.heuristic(
+                                tlat,
+                                tlon,
+                                final_lat,
+                                final_lon,
+                                current_ride_count,
+                                current_transfert_duration + t[2],
+                                mode_int=mode_int,
+                            )
+                            cost = int((t_datetime - departure).total_seconds() + h)
+                            # Update best cost and push to queue
+                            if cost < best_cost.get(t[1], float("inf")):
+                                best_cost[t[1]] = cost
+                                heapq.heappush(
+                                    priority_queue,
+                                    (
+                                        cost,
+                                        t[1],
+                                        t_datetime,
+                                        current_ride_count,
+                                        current_transfert_duration + t[2],
+                                    ),
+                                )
+                nodes_processed += 1
+            if not found:
+                execution_time_seconds = (
+                    datetime.datetime.now() - start_execution_time
+                ).total_seconds()
+                return None, execution_time_seconds
+            # Reconstruct the path
+            path = self.reconstruct_path(previous, current_stop_id, current_time)
 
-        # Increase cache size and use memory for temporary tables, improves performance by ~200%
-        cursor.execute("PRAGMA cache_size = 20000")
-        cursor.execute("PRAGMA temp_store = MEMORY")
+            execution_time_seconds = (
+                datetime.datetime.now() - start_execution_time
+            ).total_seconds()
+            if use_cache:
+                self.cache.put(
+                    from_stop_id,
+                    to_stop_id,
+                    departure,
+                    mode,
+                    path,
+                    self.get_latest_departure(path),
+                    execution_time_seconds,
+                )
+            return path, execution_time_seconds
+        finally:
+            # The feed is closed even if the search fails, so the interface stops polling it
+            if close_conn:
+                conn.close()
+            if feed:
+                feed.close()
+
+    def get_latest_departure(
+        self,
+        path: list,
+        conn: sqlite3.Connection | None = None,
+        cursor: sqlite3.Cursor | None = None,
+    ) -> datetime.datetime:
+        """
+        Get the latest time at which a journey can be started from its first stop while still catching its first trip.
+        This is the departure time of the first trip, minus the transfers made before boarding it.
+        """
+        departure = path[0][1]
+        for node in path[:-1]:
+            if len(node) > 2 and node[2]:
+                break
+        else:
+            return departure
+        if conn is None or cursor is None:
+            with self.db.read_connection() as cursor:
+                return self.get_latest_departure(path, cursor.connection, cursor)
+        cursor.execute(
+            "SELECT departure_time FROM stop_times WHERE trip_id = ? AND stop_id = ? ORDER BY stop_sequence LIMIT 1",
+            (node[2], node[0]),
+        )
+        row = cursor.fetchone()
+        boarding_time = self.parse_gtfs_time(node[1], row[0]) if row else None
+        if boarding_time is None or boarding_time < node[1]:
+            return departure
+        return boarding_time - (node[1] - departure)
 
-        visited = set()
-        previous = {}
-        previous[(from_stop_id, departure)] = (from_stop_id, departure)
-        start_pos = self.get_stop_pos(from_stop_id)
-        if not start_pos:
-            return None, 0.0
-        stop_pos = self.get_stop_pos(to_stop_id, conn, cursor)
-        if not stop_pos:
+    def find_stops_near(
+        self,
+        lat: float,
+        lon: float,
+        radius_m: float,
+        walking_speed_mps: float = 1.2,
+        cursor: sqlite3.Cursor | None = None,
+    ) -> list[tuple[str, int]]:
+        """
+        Find all stops within radius_m meters of the given position, using the stop_index R-tree.
+        Returns a list of tuples (stop_id, walking time in seconds), sorted by walking time.
+        """
+        if cursor is None:
+            with self.db.read_connection() as cursor:
+                return self.find_stops_near(
+                    lat, lon, radius_m, walking_speed_mps, cursor
+                )
+        delta_lat = radius_m / 111320
+        delta_lon = radius_m / (40075000 * math.cos(math.radians(lat)) / 360)
+        cursor.execute(
+            """
+            SELECT stops.stop_id, stops.stop_lat, stops.stop_lon
+            FROM stop_index AS si
+            JOIN stops ON stops.stop_idx = si.id
+            WHERE si.min_lat BETWEEN ? AND ? AND si.min_lon BETWEEN ? AND ?
+            """,
+            (lat - delta_lat, lat + delta_lat, lon - delta_lon, lon + delta_lon),
+        )
+        stops = []
+        rows = cursor.fetchall()
+        for stop_id, stop_lat, stop_lon in rows:
+            distance = geodistance_meters(lat, lon, stop_lat, stop_lon)
+            if distance <= radius_m:
+                stops.append((stop_id, math.ceil(distance / walking_speed_mps)))
+        return sorted(stops, key=lambda stop: stop[1])
+
+    def find_station_stops(
+        self, name: str, cursor: sqlite3.Cursor | None = None
+    ) -> list[tuple[str, int]]:
+        """
+        Find all stops of a station by its name: the stops with this name, the stops of their parent stations,
+        and the children of the stops which are stations themselves.
+        Returns a list of tuples (stop_id, walking time in seconds), the walking time being 0 for all of them.
+        """
+        if cursor is None:
+            with self.db.read_connection() as cursor:
+                return self.find_station_stops(name, cursor)
+        # parent_station is not prefixed with the source index like stop_id, so it is compared without the prefix
+        cursor.execute(
+            """
+            WITH named AS (
+                SELECT stop_id, parent_station, substr(stop_id, 1, instr(stop_id, '/')) AS prefix
+                FROM stops WHERE stop_name = ? COLLATE NOCASE
+            )
+            SELECT stop_id FROM named
+            UNION
+            SELECT stops.stop_id FROM stops
+            JOIN named ON substr(stops.stop_id, 1, length(named.prefix)) = named.prefix
+            WHERE stops.parent_station = substr(named.stop_id, length(named.prefix) + 1)
+               OR (named.parent_station != '' AND stops.parent_station = named.parent_station)
+               OR stops.stop_id = named.prefix || named.parent_station
+            """,
+            (name,),
+        )
+        stops = [(row[0], 0) for row in cursor.fetchall()]
+        return stops
+
+    def resolve_place(
+        self,
+        place: str | tuple[float, float],
+        walking_radius_m: float = 500,
+        walking_speed_mps: float = 1.2,
+        cursor: sqlite3.Cursor | None = None,
+    ) -> list[tuple[str, int]]:
+        """
+        Get the stops to use for an origin or a destination, given either as a station name or as a (lat, lon) position.
+        Returns a list of tuples (stop_id, walking time in seconds), sorted by walking time.
+        """
+        if isinstance(place, str):
+            return self.find_station_stops(place, cursor)
+        lat, lon = place
+        return self.find_stops_near(
+            lat, lon, walking_radius_m, walking_speed_mps, cursor
+        )
+
+    @database_request
+    def journey_search_area(
+        self,
+        origin: str | tuple[float, float],
+        destination: str | tuple[float, float],
+        departure: datetime.datetime,
+        mode: 'Literal["fastest", "least_transfers"]' = "fastest",
+        walking_radius_m: float = 500,
+        walking_speed_mps: float = 1.2,
+        max_execution_time_seconds: int = 60,
+        feed: SearchFeed | None = None,
+    ):
+        """
+        Search for a journey between two places, each given as a station name or a (lat, lon) position.
+        All the stops of the origin are used as sources at once, starting after their walking time,
+        and the search ends at the first stop of the destination, taking the walking time to the destination into account.
+        This is a single search, instead of one search per combination of stops.
+        Returns a tuple (path, execution_time) like journey_search, the path ending at the destination stop used.
+        """
+        start_execution_time = datetime.datetime.now()
+        use_cache = self.cache is not None and (
+            self.overlay is None or not self.overlay.snapshot().trips
+        )
+        if use_cache:
+            path = self.cache.get(str(origin), str(destination), departure, mode)
+            if path is not None:
+                if feed:
+                    feed.close()
+                execution_time_seconds = (
+                    datetime.datetime.now() - start_execution_time
+                ).total_seconds()
+                return path, execution_time_seconds
+
+        with self.db.read_connection() as cursor:
+            origin_stops = self.resolve_place(
+                origin, walking_radius_m, walking_speed_mps, cursor
+            )
+            destination_stops = self.resolve_place(
+                destination, walking_radius_m, walking_speed_mps, cursor
+            )
+        if not origin_stops or not destination_stops:
+            if feed:
+                feed.close()
             return None, 0.0
-        final_lat, final_lon = stop_pos
 
-        if gui:
-            gui.master.after(0, gui.map_canvas.set_zoom, 5)
-            # calculate the medium position of the two stops
-            if start_pos:
-                start_lat, start_lon = start_pos
-                gui.master.after(
-                    0,
-                    gui.map_canvas.set_position,
-                    (final_lat + start_lat) / 2,
-                    (final_lon + start_lon) / 2,
-                )
+        sources = [
+            (stop_id, departure + datetime.timedelta(seconds=walking_time))
+            for stop_id, walking_time in origin_stops
+        ]
+        targets = dict(destination_stops)
+        path, execution_time_seconds = self.journey_search(
+            sources[0][0],
+            destination_stops[0][0],
+            sources[0][1],
+            mode=mode,
+            max_execution_time_seconds=max_execution_time_seconds,
+            feed=feed,
+            sources=sources[1:],
+            targets=targets,
+        )
+        if use_cache and path:
+            # The walk to the first stop has to fit before the latest departure from it
+            self.cache.put(
+                str(origin),
+                str(destination),
+                departure,
+                mode,
+                path,
+                self.get_latest_departure(path) - (path[0][1] - departure),
+                execution_time_seconds,
+            )
+        return path, execution_time_seconds
 
-                zoom_level = 7
+    @database_request
+    def journey_search_alternatives(
+        self,
+        from_stop_id: str,
+        to_stop_id: str,
+        departure: datetime.datetime,
+        k: int = 3,
+        mode: 'Literal["fastest", "least_transfers"]' = "fastest",
+        max_execution_time_seconds: int = 60,
+        sources: list[tuple] | None = None,
+        conn: sqlite3.Connection | None = None,
+        cursor: sqlite3.Cursor | None = None,
+        ride_count: int = 0,
+    ):
+        """
+        Search for the k best distinct journeys from one stop to another, in a single search run.
+        This is the same A* search as journey_search, but instead of keeping one label per stop,
+        each stop can be settled up to k times, and each label keeps a pointer to its parent label.
+        The search stops when k journeys using distinct sequences of trips have reached the destination.
+        Returns a tuple (paths, execution_time), paths being a list of paths in the same format as journey_search,
+        sorted by cost.
+        sources and the connection are handled like in journey_search.
+        ride_count is the number of rides already taken before the departure (by the previous legs of a via search),
+        and a source can carry its own as a third element (stop_id, time, ride_count). The rides are part of the cost
+        of the sources, so that a later source needing fewer rides can be expanded before an earlier one.
+        """
+        if mode not in ["fastest", "least_transfers"]:
+            raise ValueError(
+                f"Invalid mode: {mode}. Must be 'fastest' or 'least_transfers'."
+            )
+        if k < 1:
+            raise ValueError(f"Invalid k: {k}. Must be at least 1.")
 
-                gui.master.after(0, gui.map_canvas.set_zoom, zoom_level)
+        if mode == "least_transfers":
+            max_rides = 5
+            mode_int = 1
+        else:
+            max_rides = 20
+            mode_int = 0
+        start_execution_time = datetime.datetime.now()
+        # The realtime snapshot is taken once, so the whole search sees consistent delays
+        realtime = self.overlay.snapshot() if self.overlay else None
+        if conn is None or cursor is None:
+            conn, cursor = self.db.get_connection()
+            close_conn = True
+        else:
+            close_conn = False
+        cursor.execute("PRAGMA cache_size = 20000")
+        cursor.execute("PRAGMA temp_store = MEMORY")
 
-        priority_queue = [
-            (0, from_stop_id, departure, 0, 0)
-        ]  # (cost, stop_id, time, ride_count, transfert_duration)
-        earliest_arrival = {from_stop_id: departure}
-        best_cost = {from_stop_id: 0}  # Track the best cost to each stop
+        start_pos = self.get_stop_pos(from_stop_id, conn, cursor)
+        stop_pos = self.get_stop_pos(to_stop_id, conn, cursor)
+        if not start_pos or not stop_pos:
+            if close_conn:
+                conn.close()
+            return [], 0.0
+        final_lat, final_lon = stop_pos
+
+        # Each label is (stop_id, time, trip_id used to reach it, parent label index, ride_count, transfert_duration)
+        labels = []
+        priority_queue = []  # (cost, label index)
+        for source in [(from_stop_id, departure, ride_count)] + (sources or []):
+            source_stop_id, source_time = source[:2]
+            source_ride_count = source[2] if len(source) > 2 else 0
+            source_pos = (
+                start_pos
+                if source_stop_id == from_stop_id
+                else self.get_stop_pos(source_stop_id, conn, cursor)
+            )
+            if not source_pos:
+                continue
+            h = self.heuristic(
+                source_pos[0],
+                source_pos[1],
+                final_lat,
+                final_lon,
+                source_ride_count,
+                0,
+                mode_int=mode_int,
+            )
+            labels.append(
+                (source_stop_id, source_time, None, -1, source_ride_count, 0)
+            )
+            priority_queue.append(
+                (int((source_time - departure).total_seconds() + h), len(labels) - 1)
+            )
         heapq.heapify(priority_queue)
-        found = False
+        settled = {}  # Number of times each stop has been settled
+        paths = []
+        seen_trip_sequences = set()
 
         nodes_processed = 0
-
         neighbor_search_window = datetime.timedelta(hours=5)
-        update_start_time = datetime.datetime.now()
-        while len(priority_queue) > 0 and not found:
+        while priority_queue and len(paths) < k:
             if (
                 nodes_processed % 1000 == 0
                 and datetime.datetime.now() - start_execution_time
                 > datetime.timedelta(seconds=max_execution_time_seconds)
             ):
                 break
-            u = heapq.heappop(priority_queue)
-            current_cost = u[0]
-            current_stop_id = u[1]
-            current_time = u[2]
-            current_ride_count = u[3]
-            current_transfert_duration = u[4]
-
-            if gui and datetime.datetime.now() - update_start_time > datetime.timedelta(
-                milliseconds=40
-            ):
-                path = self.reconstruct_path(previous, current_stop_id, current_time)
+            _, label_index = heapq.heappop(priority_queue)
+            (
+                current_stop_id,
+                current_time,
+                _,
+                parent_index,
+                current_ride_count,
+                current_transfert_duration,
+            ) = labels[label_index]
+            nodes_processed += 1
 
-                gui.master.after(
-                    0,
-                    self.update_gui,
-                    gui,
-                    path,
+            if current_stop_id == to_stop_id:
+                path = self.reconstruct_label_path(labels, label_index)
+                # Consecutive nodes on the same trip are one ride
+                trip_sequence = tuple(
+                    trip_id
+                    for trip_id, _ in itertools.groupby(
+                        node[2] for node in path[:-1] if node[2]
+                    )
                 )
-                update_start_time = datetime.datetime.now()
+                if trip_sequence not in seen_trip_sequences:
+                    seen_trip_sequences.add(trip_sequence)
+                    paths.append(path)
+                continue
 
-            # Skip if this path is not optimal
-            if current_cost > best_cost.get(current_stop_id, float("inf")):
+            if settled.get(current_stop_id, 0) >= k:
                 continue
+            settled[current_stop_id] = settled.get(current_stop_id, 0) + 1
 
             if max_rides >= 0 and current_ride_count > max_rides + 1:
                 continue
+            parent_stop_id = labels[parent_index][0] if parent_index >= 0 else None
+            current_trip_id = labels[label_index][2]
+
+            for v in self.get_neighbors_stop_times(
+                current_stop_id,
+                current_time,
+                neighbor_search_window,
+                limit=-1,
+                conn=conn,
+                cursor=cursor,
+                trips_per_stop=k,
+                realtime=realtime,
+            ):
+                v_datetime = self.parse_gtfs_time(current_time, v[1])
+                # Staying on the trip that reached this stop gives the stops already reached from the boarding stop
+                if (
+                    not v_datetime
+                    or v[0] == parent_stop_id
+                    or settled.get(v[0], 0) >= k
+                    or (current_trip_id is not None and v[2] == current_trip_id)
+                ):
+                    continue
+                h = self.heuristic(
+                    v[3],
+                    v[4],
+                    final_lat,
+                    final_lon,
+                    current_ride_count + 1,
+                    current_transfert_duration,
+                    mode_int=mode_int,
+                )
+                cost = int((v_datetime - departure).total_seconds() + h)
+                labels.append(
+                    (
+                        v[0],
+                        v_datetime,
+                        v[2],
+                        label_index,
+                        current_ride_count + 1,
+                        current_transfert_duration,
+                    )
+                )
+                heapq.heappush(priority_queue, (cost, len(labels) - 1))
+            # With closed footpaths, a stop reached by walking has nothing more to walk to
+            if self.has_footpaths(cursor) and (
+                parent_index >= 0 and labels[label_index][2] is None
+            ):
+                transfers = []
+            else:
+                transfers = self.get_transfers(
+                    current_stop_id, conn=conn, cursor=cursor
+                )
+            for t in transfers:
+                t_datetime = current_time + datetime.timedelta(seconds=t[2])
+                if t[1] == parent_stop_id or settled.get(t[1], 0) >= k:
+                    continue
+                h = self.heuristic(
+                    t[3],
+                    t[4],
+                    final_lat,
+                    final_lon,
+                    current_ride_count,
+                    current_transfert_duration + t[2],
+                    mode_int=mode_int,
+                )
+                cost = int((t_datetime - departure).total_seconds() + h)
+                labels.append(
+                    (
+                        t[1],
+                        t_datetime,
+                        None,
+                        label_index,
+                        current_ride_count,
+                        current_transfert_duration + t[2],
+                    )
+                )
+                heapq.heappush(priority_queue, (cost, len(labels) - 1))
+        if close_conn:
+            conn.close()
+        execution_time_seconds = (
+            datetime.datetime.now() - start_execution_time
+        ).total_seconds()
+        return paths, execution_time_seconds
 
-            """print(
-                f"Processing node {nodes_processed}: {current_stop_id} at {current_time.strftime('%H:%M:%S')} with cost {current_cost}, ride count {current_ride_count}, transfer duration {current_transfert_duration}"
-            )"""
-            if current_stop_id == to_stop_id:
-                found = True
+    @database_request
+    def journey_search_via(
+        self,
+        stops: list[str],
+        departure: datetime.datetime,
+        min_dwell: int = 0,
+        mode: 'Literal["fastest", "least_transfers"]' = "fastest",
+        via_candidates: int = 1,
+        max_execution_time_seconds: int = 60,
+    ):
+        """
+        Search for a journey going through all the given stops in order, staying at least min_dwell seconds at each via stop.
+        All the legs are searched on the same connection, so the valid service IDs table and the SQLite cache
+        are built once and reused by every leg.
+        If via_candidates is greater than 1, the via_candidates best arrivals at each via stop are kept with the number
+        of rides taken to reach them, and the next leg is searched from all of them at once with journey_search_alternatives,
+        which counts these rides in the cost of each source: the search itself picks the candidate giving the best journey.
+        Returns a tuple (path, execution_time), the path having the same format as journey_search,
+        a dwell at a via stop being represented as a transfer from the stop to itself.
+        """
+        if len(stops) < 2:
+            raise ValueError("At least two stops are needed to search for a journey.")
+        if via_candidates < 1:
+            raise ValueError(
+                f"Invalid via_candidates: {via_candidates}. Must be at least 1."
+            )
+        start_execution_time = datetime.datetime.now()
+        conn, cursor = self.db.get_connection()
+
+        # (path, ride count) leading to the current via stop, indexed by the time the next leg can start from it
+        candidates = {departure: ([], 0)}
+        path = None
+        for i, (leg_from, leg_to) in enumerate(zip(stops, stops[1:])):
+            start_times = sorted(candidates)
+            leg_sources = [
+                (leg_from, start_time, candidates[start_time][1])
+                for start_time in start_times[1:]
+            ]
+            remaining_time = max_execution_time_seconds - int(
+                (datetime.datetime.now() - start_execution_time).total_seconds()
+            )
+            if remaining_time <= 0:
+                path = None
+                break
+            if via_candidates > 1:
+                # Only the best journey of the last leg is needed
+                leg_paths, _ = self.journey_search_alternatives(
+                    leg_from,
+                    leg_to,
+                    start_times[0],
+                    k=via_candidates if i < len(stops) - 2 else 1,
+                    mode=mode,
+                    max_execution_time_seconds=remaining_time,
+                    sources=leg_sources,
+                    conn=conn,
+                    cursor=cursor,
+                    ride_count=candidates[start_times[0]][1],
+                )
             else:
-                for v in self.get_neighbors_stop_times(
-                    current_stop_id,
-                    current_time,
-                    neighbor_search_window,
-                    limit=-1,
+                leg_path, _ = self.journey_search(
+                    leg_from,
+                    leg_to,
+                    start_times[0],
+                    mode=mode,
+                    max_execution_time_seconds=remaining_time,
+                    sources=leg_sources,
                     conn=conn,
                     cursor=cursor,
-                ):
-                    v_datetime = self.parse_gtfs_time(current_time, v[1])
-                    if not v_datetime:
-                        continue
-                    if (v[0], v_datetime) not in visited and (
-                        v_datetime < earliest_arrival.get(v[0], datetime.datetime.max)
-                    ):
-                        vlat = v[3]
-                        vlon = v[4]
-                        trip_id = v[2]
-                        visited.add((v[0], v_datetime))
-                        previous[(v[0], v_datetime)] = (
-                            current_stop_id,
-                            current_time,
-                            trip_id,
-                        )
-                        earliest_arrival[v[0]] = v_datetime
-                        h = self.heuristic(
-                            vlat,
-                            vlon,
-                            final_lat,
-                            final_lon,
-                            current_ride_count + 1,
-                            current_transfert_duration,
-                            mode_int=mode_int,
-                        )
-                        cost = int((v_datetime - departure).total_seconds() + h)
-                        # Update best cost and push to queue
-                        if cost < best_cost.get(v[0], float("inf")):
-                            best_cost[v[0]] = cost
-                            heapq.heappush(
-                                priority_queue,
-                                (
-                                    cost,
-                                    v[0],
-                                    v_datetime,
-                                    current_ride_count + 1,
-                                    current_transfert_duration,
-                                ),
-                            )
-                for t in self.get_transfers(current_stop_id, conn=conn, cursor=cursor):
-                    t_datetime = current_time + datetime.timedelta(seconds=t[2])
-                    if (t[1], t_datetime) not in visited and (
-                        t_datetime < earliest_arrival.get(t[1], datetime.datetime.max)
-                    ):
-                        visited.add((t[1], t_datetime))
-                        tlat, tlon = self.get_stop_pos(t[1], conn, cursor)
-                        previous[(t[1], t_datetime)] = (
-                            current_stop_id,
-                            current_time,
-                            None,
-                        )
-                        earliest_arrival[t[1]] = t_datetime
-                        h = self.heuristic(
-                            tlat,
-                            tlon,
-                            final_lat,
-                            final_lon,
-                            current_ride_count,
-                            current_transfert_duration + t[2],
-                            mode_int=mode_int,
-                        )
-                        cost = int((t_datetime - departure).total_seconds() + h)
-                        # Update best cost and push to queue
-                        if cost < best_cost.get(t[1], float("inf")):
-                            best_cost[t[1]] = cost
-                            heapq.heappush(
-                                priority_queue,
-                                (
-                                    cost,
-                                    t[1],
-                                    t_datetime,
-                                    current_ride_count,
-                                    current_transfert_duration + t[2],
-                                ),
-                            )
-            nodes_processed += 1
-        conn.close()
-        self._last_date = None  # Reset last date after search
-        if not found:
-            execution_time_seconds = (
-                datetime.datetime.now() - start_execution_time
-            ).total_seconds()
-            return None, execution_time_seconds
-        # Reconstruct the path
-        path = self.reconstruct_path(previous, current_stop_id, current_time)
+                )
+                leg_paths = [leg_path] if leg_path else []
+            if not leg_paths:
+                path = None
+                break
+
+            if i == len(stops) - 2:
+                # The leg starts from one of the candidates, prepend the path that led to it
+                path = candidates[leg_paths[0][0][1]][0] + leg_paths[0]
+                break
 
+            next_candidates = {}
+            for leg_path in leg_paths:
+                candidate_path, candidate_ride_count = candidates[leg_path[0][1]]
+                prefix = candidate_path + leg_path[:-1]
+                # Consecutive nodes on the same trip are one ride
+                ride_count = candidate_ride_count + sum(
+                    1
+                    for trip_id, _ in itertools.groupby(
+                        node[2] for node in leg_path[:-1]
+                    )
+                    if trip_id
+                )
+                arrival_stop_id, arrival_time = leg_path[-1][:2]
+                if min_dwell > 0:
+                    # The dwell is a transfer from the via stop to itself
+                    prefix.append((arrival_stop_id, arrival_time, None))
+                    arrival_time += datetime.timedelta(seconds=min_dwell)
+                # The leg paths are sorted by cost, the first one arriving at a time is kept
+                next_candidates.setdefault(arrival_time, (prefix, ride_count))
+            candidates = next_candidates
+        conn.close()
         execution_time_seconds = (
             datetime.datetime.now() - start_execution_time
         ).total_seconds()
         return path, execution_time_seconds
 
+    def reconstruct_label_path(self, labels: list[tuple], label_index: int):
+        """Reconstruct the path ending at the given label, by following the parent label indexes.
+        Returns a list of tuples (stop_id, time, optional trip_id), like reconstruct_path."""
+        stop_id, time, trip_id, parent_index = labels[label_index][:4]
+        path = [(stop_id, time)]
+        while parent_index >= 0:
+            parent_stop_id, parent_time, parent_trip_id, grand_parent_index = labels[
+                parent_index
+            ][:4]
+            path.insert(0, (parent_stop_id, parent_time, trip_id))
+            trip_id, parent_index = parent_trip_id, grand_parent_index
+        return path
+
     def reconstruct_path(self, previous, current_stop_id, current_time):
         """Reconstruct the path from the previous nodes.
         Returns a list of tuples (stop_id, time, optional trip_id)."""
@@ -594,10 +1446,10 @@ class JourneyPlanner:
         Get the next departure from a stop after a given arrival time on a specific trip.
         """
         if conn is None or cursor is None:
-            conn, cursor = self.db.get_connection()
-            close_conn = True
-        else:
-            close_conn = False
+            with self.db.read_connection() as cursor:
+                return self.get_next_departure(
+                    stop_id, trip_id, arrival_time, cursor.connection, cursor
+                )
         sql = """
         SELECT departure_time 
         FROM stop_times 
@@ -607,8 +1459,6 @@ class JourneyPlanner:
         """
         cursor.execute(sql, (stop_id, trip_id, arrival_time.strftime("%H:%M:%S")))
         result = cursor.fetchone()
-        if close_conn:
-            conn.close()
         return result[0] if result else None
 
     def get_journey_details(self, path: list, tz: pytz.BaseTzInfo = pytz.UTC):
@@ -617,6 +1467,7 @@ class JourneyPlanner:
         Args:
             path (list): A list of tuples representing the journey path.
             timezone (str): The timezone to localize the dates.
+        If a realtime overlay is set, the departure times include the current delays.
 
         Returns:
             list[JourneyStep]: A list of JourneyStep objects with localized times.
@@ -625,6 +1476,7 @@ class JourneyPlanner:
             return []
         journey_steps = []
         db = self.db
+        realtime = self.overlay.snapshot() if self.overlay else None
         for i in range(len(path) - 1):
             from_stop_id = path[i][0]
             from_arrival_time = tz.fromutc(path[i][1])
@@ -632,8 +1484,8 @@ class JourneyPlanner:
             to_arrival_time = tz.fromutc(path[i + 1][1])
             trip_id = path[i][2] if len(path[i]) > 2 else None
 
-            from_stop = db.get_stop_by_id(from_stop_id)
-            to_stop = db.get_stop_by_id(to_stop_id)
+            from_stop = db.get_stop_record(from_stop_id)
+            to_stop = db.get_stop_record(to_stop_id)
             from_stop_name = from_stop.stop_name if from_stop else ""
             from_stop_lat = from_stop.stop_lat if from_stop else 0.0
             from_stop_lon = from_stop.stop_lon if from_stop else 0.0
@@ -653,10 +1505,10 @@ class JourneyPlanner:
             agency_name = None
 
             if trip_id:
-                trip = db.get_trip_by_id(trip_id)
+                trip = db.get_trip_record(trip_id)
                 route_id = trip.route_id if trip else None
                 route_short_name = trip.route_short_name if trip else None
-                route = db.get_route_by_id(route_id) if route_id else None
+                route = db.get_route_record(route_id) if route_id else None
                 route_long_name = route.route_long_name if route else None
                 try:
                     from_stop_sequence, to_stop_sequence = db.get_stop_sequences(
@@ -666,16 +1518,33 @@ class JourneyPlanner:
                     from_stop_sequence = None
                     to_stop_sequence = None
                 trip_headsign = trip.trip_headsign if trip else None
+                departure_delay = (
+                    realtime.get_delay(
+                        trip_id, from_stop_sequence, from_stop_id, departure=True
+                    )
+                    if realtime
+                    else 0
+                )
                 # Get departure time from the database (since path times are arrivals)
                 departure_time = self.get_next_departure(
-                    from_stop_id, trip_id, from_arrival_time
+                    from_stop_id,
+                    trip_id,
+                    from_arrival_time - datetime.timedelta(seconds=departure_delay),
                 )
                 if departure_time is None:
                     departure_time = from_arrival_time.strftime("%H:%M:%S")
+                elif departure_delay:
+                    departure_time = seconds_to_gtfs_time(
+                        gtfs_time_to_seconds(departure_time) + departure_delay
+                    )
 
                 agency_id = route.agency_id if route else None
-                agency = db.get_agency_by_id(agency_id) if agency_id else None
-                agency_name = agency.agency_name if agency else None
+                agency = (
+                    db.get_columns("agency", agency_id, ("agency_name",))
+                    if agency_id
+                    else None
+                )
+                agency_name = agency[0] if agency else None
             else:
                 # Transfer: compute transfer time if possible
                 transfer_time = int(
@@ -873,10 +1742,8 @@ class JourneyPlanner:
         Returns a list of tuples (latitude, longitude).
         """
         if conn is None or cursor is None:
-            conn, cursor = self.db.get_connection()
-            close_conn = True
-        else:
-            close_conn = False
+            with self.db.read_connection() as cursor:
+                return self.get_journey_step_geometry(step, cursor.connection, cursor)
         geometry = [(step.from_stop_lat, step.from_stop_lon)]
         if (
             step.trip_id
@@ -902,8 +1769,6 @@ class JourneyPlanner:
             for lat, lon in intermediate_stops:
                 geometry.append((lat, lon))
         geometry.append((step.to_stop_lat, step.to_stop_lon))
-        if close_conn:
-            conn.close()
         return geometry
 
     def get_journey_geometry(
@@ -914,13 +1779,14 @@ class JourneyPlanner:
         Returns a list of tuples (latitude, longitude).
         """
         geometry = []
-        conn, cursor = self.db.get_connection()
-        for step in journey_steps:
-            step_geometry = self.get_journey_step_geometry(step, conn, cursor)
-            if geometry and step_geometry:
-                # Avoid duplicate points between steps
-                geometry.extend(step_geometry[1:])
-            else:
-                geometry.extend(step_geometry)
-        conn.close()
+        with self.db.read_connection() as cursor:
+            for step in journey_steps:
+                step_geometry = self.get_journey_step_geometry(
+                    step, cursor.connection, cursor
+                )
+                if geometry and step_geometry:
+                    # Avoid duplicate points between steps
+                    geometry.extend(step_geometry[1:])
+                else:
+                    geometry.extend(step_geometry)
         return geometry
@@ -1,24 +1,111 @@
+import time
+
+# Start of the startup measured by --startup-profile, before the other imports
+START_TIME = time.perf_counter()
+
+import argparse
 import os
-from database import Database
-from interface import RoutePlannerApp
-import tkinter as tk
+import threading
+from database import DEFAULT_MAX_FOOTPATH_SEC
+from import_region import ImportRegion
 
 DATA_SOURCES_PATH = "data_sources.json"
 DB_PATH = "railfinder.db"
 STATIC_DB_PATH = "railfinder_static.db"
 
+
+class StartupProfile:
+    def __init__(self, start_time: float):
+        """
+        This class prints the time elapsed since the start of the application at each step of the startup:
+        the imports, the creation of the window, the first idle loop of the interface (time to interactive),
+        and the background steps (autocomplete index, database update, warm-up).
+        """
+        self.start_time = start_time
+        self.lock = threading.Lock()
+
+    def mark(self, step: str):
+        with self.lock:
+            print(f"[startup] {step}: {time.perf_counter() - self.start_time:.3f} s")
+
+    def watch(self, event: threading.Event, step: str):
+        """
+        Mark a step when the given event is set, from a daemon thread.
+        """
+
+        def wait():
+            event.wait()
+            self.mark(step)
+
+        threading.Thread(target=wait, daemon=True).start()
+
+
 # Example usage
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RailFinder journey planner")
+    parser.add_argument(
+        "--window-days",
+        type=int,
+        default=None,
+        help="only import the trips running in the next N days",
+    )
+    parser.add_argument(
+        "--region",
+        default=None,
+        help="only import the trips stopping in this region of regions.json",
+    )
+    parser.add_argument(
+        "--max-footpath-sec",
+        type=int,
+        default=DEFAULT_MAX_FOOTPATH_SEC,
+        help="longest walk in seconds of the footpaths chained between close stops",
+    )
+    parser.add_argument(
+        "--import-report",
+        default=None,
+        help="write the timings of the database update to this JSON file",
+    )
+    parser.add_argument(
+        "--startup-profile",
+        action="store_true",
+        help="print the time to interactive and the duration of the startup steps",
+    )
+    args = parser.parse_args()
+    profile = StartupProfile(START_TIME) if args.startup_profile else None
+
     print("Welcome to RailFinder!")
-    print("Initializing database...")
-    if os.path.exists(STATIC_DB_PATH):
+    static = os.path.exists(STATIC_DB_PATH)
+    if static:
         print(f"Using static database at {STATIC_DB_PATH}")
-        db_path = STATIC_DB_PATH
-    else:
-        db_path = DB_PATH
-        db = Database(db_path)
-        db.update_database(DATA_SOURCES_PATH, force_update=False)
+    db_path = STATIC_DB_PATH if static else DB_PATH
 
+    # The interface is imported here, so that the command line (railfinder.py) can import main without it
+    import tkinter as tk
+    from interface import RoutePlannerApp
+
+    if profile:
+        profile.mark("imports")
     root = tk.Tk()
     app = RoutePlannerApp(root, db_path)
+    if profile:
+        profile.mark("window created")
+        # Idle callbacks run after the pending redraws, once the window is shown and responds to input
+        root.after_idle(profile.mark, "interactive")
+        profile.watch(app.autocomplete.loaded, "autocomplete index loaded")
+        profile.watch(app.warmed_up, "database and planner caches warmed up")
+
+    # The database is checked and updated in the background, the window is shown at once
+    if static:
+        app.start_warm_up()
+    else:
+        if profile:
+            profile.watch(app.database_updated, "database freshness check and update")
+        app.start_database_update(
+            DATA_SOURCES_PATH,
+            force_update=False,
+            window_days=args.window_days,
+            region=ImportRegion.load(args.region) if args.region else None,
+            report_path=args.import_report,
+            max_footpath_sec=args.max_footpath_sec,
+        )
     root.mainloop()
@@ -5,7 +5,7 @@ from tracemalloc import start
 from typing import Optional
 
 
-@dataclass
+@dataclass(slots=True)
 class Agency:
     agency_id: str
     agency_name: str
@@ -18,7 +18,7 @@ class Agency:
     agency_email: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class Stop:
     stop_id: str
     stop_name: str
@@ -54,7 +54,7 @@ class Stop:
     stop_idx: Optional[int] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class Route:
     route_id: str
     route_short_name: str
@@ -73,7 +73,7 @@ class Route:
     regional_fare_card: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class Trip:
     trip_id: str
     route_id: str
@@ -102,9 +102,10 @@ class Trip:
     boarding_type: Optional[int] = None
     attributes_ch: Optional[str] = None
     realtime_trip_id: Optional[str] = None
+    trip_idx: Optional[int] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class StopTime:
     trip_id: str
     arrival_time: str
@@ -132,7 +133,7 @@ class StopTime:
     fare_units_traveled: Optional[int] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class Transfer:
     from_stop_id: str
     to_stop_id: str
@@ -144,7 +145,7 @@ class Transfer:
     to_trip_id: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class Shape:
     shape_id: str
     shape_pt_lat: float
@@ -153,7 +154,59 @@ class Shape:
     shape_dist_traveled: Optional[float] = None
 
 
-@dataclass
+# Compact records of the columns used on hot paths, see Database.get_stop_record and the other record getters
+
+
+@dataclass(slots=True)
+class StopRecord:
+    stop_id: str
+    stop_name: str
+    stop_lat: float
+    stop_lon: float
+
+
+@dataclass(slots=True)
+class RouteRecord:
+    route_id: str
+    route_short_name: str
+    route_long_name: str
+    route_type: int
+    agency_id: Optional[str] = None
+
+
+@dataclass(slots=True)
+class TripRecord:
+    trip_id: str
+    route_id: str
+    service_id: str
+    trip_headsign: Optional[str] = None
+    route_short_name: Optional[str] = None
+
+
+@dataclass(slots=True)
+class StopTimeRecord:
+    trip_id: str
+    stop_id: str
+    stop_sequence: int
+    arrival_time: str
+    departure_time: str
+
+
+@dataclass(slots=True)
+class Departure:
+    # Departure time, from the service date and the GTFS departure time which can exceed 24:00:00
+    time: datetime.datetime
+    service_date: datetime.date
+    stop_id: str
+    trip_id: str
+    arrival_time: str
+    departure_time: str
+    route_short_name: Optional[str]
+    route_long_name: Optional[str]
+    trip_headsign: Optional[str]
+
+
+@dataclass(slots=True)
 class JourneyStep:
     start_time: datetime.datetime
     end_time: datetime.datetime
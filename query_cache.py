@@ -0,0 +1,210 @@
+import datetime
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from database import Database
+
+
+class QueryCache:
+    def __init__(
+        self,
+        db: "Database",
+        bucket_minutes: int = 15,
+        max_entries: int = 1024,
+        persistent_path: str | None = None,
+    ):
+        """
+        This class caches the results of journey searches, keyed by (from, to, service date, departure bucket, mode).
+        Results are kept in an in-memory LRU, and optionally in a SQLite file that survives restarts.
+        The whole cache is invalidated when the version of the database changes (its updated_at metadata for databases
+        built before versions were stored).
+        A cached journey computed for a departure d0 is only served for a departure d if d0 <= d and the journey
+        can still be started at d, in which case it is also the best journey for d.
+        """
+        self.db = db
+        self.bucket_minutes = bucket_minutes
+        self.max_entries = max_entries
+        self.persistent_path = persistent_path
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.updated_at = None
+        self.counters = {
+            "hits": 0,
+            "memory_hits": 0,
+            "persistent_hits": 0,
+            "misses": 0,
+            "revalidation_failures": 0,
+            "saved_seconds": 0.0,
+        }
+        if persistent_path:
+            conn = sqlite3.connect(persistent_path)
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS query_cache (
+                    key TEXT PRIMARY KEY,
+                    updated_at TEXT,
+                    entry TEXT NOT NULL
+                )
+                """
+            )
+            conn.commit()
+            conn.close()
+
+    def make_key(
+        self, from_stop_id: str, to_stop_id: str, departure: datetime.datetime, mode: str
+    ) -> str:
+        """
+        Build the cache key of a query, the departure time being rounded down to the bucket.
+        """
+        minutes = departure.hour * 60 + departure.minute
+        bucket = minutes // self.bucket_minutes
+        return f"{from_stop_id}|{to_stop_id}|{departure.strftime('%Y%m%d')}|{bucket}|{mode}"
+
+    def check_database_version(self):
+        """
+        Clear the cache if the database has been updated since the cached results were computed.
+        """
+        updated_at = self.db.get_metadata("version") or self.db.get_metadata(
+            "updated_at"
+        )
+        if updated_at != self.updated_at:
+            self.entries.clear()
+            self.updated_at = updated_at
+            if self.persistent_path:
+                conn = sqlite3.connect(self.persistent_path)
+                conn.execute(
+                    "DELETE FROM query_cache WHERE updated_at IS NOT ?", (updated_at,)
+                )
+                conn.commit()
+                conn.close()
+
+    def serialize_entry(self, entry: dict) -> str:
+        return json.dumps(
+            {
+                "departure": entry["departure"].isoformat(),
+                "latest_departure": entry["latest_departure"].isoformat(),
+                "execution_time": entry["execution_time"],
+                "path": [
+                    [node[0], node[1].isoformat()] + list(node[2:])
+                    for node in entry["path"]
+                ],
+            }
+        )
+
+    def deserialize_entry(self, data: str) -> dict:
+        entry = json.loads(data)
+        return {
+            "departure": datetime.datetime.fromisoformat(entry["departure"]),
+            "latest_departure": datetime.datetime.fromisoformat(
+                entry["latest_departure"]
+            ),
+            "execution_time": entry["execution_time"],
+            "path": [
+                (node[0], datetime.datetime.fromisoformat(node[1])) + tuple(node[2:])
+                for node in entry["path"]
+            ],
+        }
+
+    def get(
+        self, from_stop_id: str, to_stop_id: str, departure: datetime.datetime, mode: str
+    ) -> list | None:
+        """
+        Get the cached journey for a query, re-validated for the exact departure time.
+        Returns the path with its nodes up to the first boarding shifted to the requested departure time,
+        or None if there is no valid entry.
+        """
+        lookup_start = time.perf_counter()
+        key = self.make_key(from_stop_id, to_stop_id, departure, mode)
+        with self.lock:
+            self.check_database_version()
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                source = "memory_hits"
+            elif self.persistent_path:
+                conn = sqlite3.connect(self.persistent_path)
+                row = conn.execute(
+                    "SELECT entry FROM query_cache WHERE key = ? AND updated_at IS ?",
+                    (key, self.updated_at),
+                ).fetchone()
+                conn.close()
+                if row:
+                    entry = self.deserialize_entry(row[0])
+                    self.store_in_memory(key, entry)
+                    source = "persistent_hits"
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            if not entry["departure"] <= departure <= entry["latest_departure"]:
+                self.counters["revalidation_failures"] += 1
+                self.counters["misses"] += 1
+                return None
+            self.counters["hits"] += 1
+            self.counters[source] += 1
+            self.counters["saved_seconds"] += max(
+                0.0, entry["execution_time"] - (time.perf_counter() - lookup_start)
+            )
+        # The walks before the first trip are made later by the same delay, the trip is still caught
+        # as the departure is not after the latest departure (see JourneyPlanner.get_latest_departure)
+        delta = departure - entry["departure"]
+        path = list(entry["path"])
+        for i, node in enumerate(path):
+            path[i] = (node[0], node[1] + delta) + tuple(node[2:])
+            if len(node) > 2 and node[2]:
+                break
+        return path
+
+    def store_in_memory(self, key: str, entry: dict):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def put(
+        self,
+        from_stop_id: str,
+        to_stop_id: str,
+        departure: datetime.datetime,
+        mode: str,
+        path: list,
+        latest_departure: datetime.datetime,
+        execution_time: float,
+    ):
+        """
+        Store the journey found for a query, from_stop_id and to_stop_id can also be place names or positions.
+        latest_departure is the latest departure time of the query for which the journey can still be made.
+        """
+        key = self.make_key(from_stop_id, to_stop_id, departure, mode)
+        entry = {
+            "departure": departure,
+            "latest_departure": latest_departure,
+            "execution_time": execution_time,
+            "path": path,
+        }
+        with self.lock:
+            self.check_database_version()
+            self.store_in_memory(key, entry)
+            if self.persistent_path:
+                conn = sqlite3.connect(self.persistent_path)
+                conn.execute(
+                    "INSERT OR REPLACE INTO query_cache (key, updated_at, entry) VALUES (?, ?, ?)",
+                    (key, self.updated_at, self.serialize_entry(entry)),
+                )
+                conn.commit()
+                conn.close()
+
+    def stats(self) -> dict:
+        """
+        Get the cache counters: hits (in memory and persistent), misses, failed re-validations,
+        hit rate and the search time saved in seconds.
+        """
+        with self.lock:
+            stats = dict(self.counters)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,329 @@
+import argparse
+import concurrent.futures
+import csv
+import dataclasses
+import datetime
+import json
+import os
+import re
+import sys
+import time
+from typing import Iterator
+
+import pytz
+from tqdm import tqdm
+
+from database import Database
+from journey_planner import JourneyPlanner
+from models import JourneyStep
+from main import DB_PATH, STATIC_DB_PATH
+
+# Number of queries submitted to the pool per worker, ahead of the results being written
+BATCH_QUEUE_PER_WORKER = 4
+
+# The planner of a batch worker process, see init_worker
+planner: JourneyPlanner | None = None
+
+
+def get_default_db_path() -> str:
+    return STATIC_DB_PATH if os.path.exists(STATIC_DB_PATH) else DB_PATH
+
+
+def parse_place(place: str) -> str | tuple[float, float]:
+    """
+    Parse an origin or a destination: a "lat,lon" position, or a station name.
+    """
+    match = re.fullmatch(r"\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*", place)
+    if match:
+        return float(match.group(1)), float(match.group(2))
+    return place
+
+
+def parse_departure(departure: str | None, timezone: str) -> datetime.datetime:
+    """
+    Convert a local departure time in ISO format (now if None) to a naive UTC datetime, as used by the planner.
+    """
+    tz = pytz.timezone(timezone)
+    if departure:
+        local = tz.localize(datetime.datetime.fromisoformat(departure))
+    else:
+        local = datetime.datetime.now(tz)
+    return local.astimezone(pytz.utc).replace(tzinfo=None)
+
+
+def find_journey(
+    planner: JourneyPlanner,
+    query: dict,
+    timezone: str,
+    max_execution_time_seconds: int,
+) -> tuple[list[JourneyStep] | None, float]:
+    """
+    Search the journey of a query {"from", "to", "departure", "mode"}.
+    Returns the journey steps (None if no journey was found) and the search time in seconds.
+    """
+    path, execution_time = planner.journey_search_area(
+        parse_place(query["from"]),
+        parse_place(query["to"]),
+        parse_departure(query.get("departure"), timezone),
+        query.get("mode") or "fastest",
+        max_execution_time_seconds=max_execution_time_seconds,
+    )
+    if path is None:
+        return None, execution_time
+    return planner.get_journey_details(path, tz=pytz.timezone(timezone)), execution_time
+
+
+def run_query(
+    planner: JourneyPlanner,
+    query: dict,
+    timezone: str,
+    max_execution_time_seconds: int,
+) -> dict:
+    """
+    Run a journey query and return the result as a JSON-serializable dict.
+    Other fields of the query (an "id" for example) are copied to the result.
+    """
+    start_time = time.perf_counter()
+    result = dict(query)
+    try:
+        steps, execution_time = find_journey(
+            planner, query, timezone, max_execution_time_seconds
+        )
+        result["found"] = steps is not None
+        result["search_seconds"] = round(execution_time, 3)
+        if steps is not None:
+            result["departure_time"] = steps[0].start_time.isoformat()
+            result["arrival_time"] = steps[-1].end_time.isoformat()
+            result["transfers"] = sum(1 for step in steps if not step.transfer) - 1
+            result["steps"] = [
+                {
+                    key: value.isoformat() if isinstance(value, datetime.datetime) else value
+                    for key, value in dataclasses.asdict(step).items()
+                }
+                for step in steps
+            ]
+    except Exception as e:
+        result["found"] = False
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["seconds"] = round(time.perf_counter() - start_time, 3)
+    return result
+
+
+def init_worker(db_path: str):
+    """
+    Open the database and warm up the planner of a batch worker process.
+    """
+    global planner
+    planner = JourneyPlanner(Database(db_path))
+    # Switching the planner to the current version of the database warms up its caches
+    planner.begin_request()
+    planner.end_request()
+
+
+def run_worker_query(
+    index: int, query: dict, timezone: str, max_execution_time_seconds: int
+) -> tuple[int, dict]:
+    return index, run_query(planner, query, timezone, max_execution_time_seconds)
+
+
+def read_queries(path: str) -> Iterator[dict]:
+    """
+    Read the queries of a batch one by one, from a CSV file with a header (from,to,departure,mode)
+    or from a JSONL file with one query object per line ("-" for the standard input).
+    The file is read as the queries are consumed, so a large batch is never held in memory.
+    """
+    file = sys.stdin if path == "-" else open(path, newline="", encoding="utf-8")
+    try:
+        if path.lower().endswith(".csv"):
+            for row in csv.DictReader(file):
+                yield {key: value for key, value in row.items() if value != ""}
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+    finally:
+        if file is not sys.stdin:
+            file.close()
+
+
+def search_command(args):
+    planner = JourneyPlanner(Database(args.db))
+    query = {
+        "from": args.origin,
+        "to": args.destination,
+        "departure": args.departure,
+        "mode": args.mode,
+    }
+    if args.json:
+        result = run_query(planner, query, args.timezone, args.max_time)
+        print(json.dumps(result, ensure_ascii=False))
+        return 0 if result["found"] else 1
+    steps, execution_time = find_journey(planner, query, args.timezone, args.max_time)
+    if steps is None:
+        print("❌ No journey found.")
+        return 1
+    print(planner.get_journey_summary(steps))
+    print(f"⏱️ Search time: {execution_time:.2f} seconds")
+    return 0
+
+
+def batch_command(args):
+    queries = read_queries(args.input)
+    workers = args.workers or os.cpu_count() or 1
+    output = (
+        open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    )
+    start_time = time.perf_counter()
+    found = failed = processed = 0
+    # The number of queries is not known before the end of the input
+    progress = tqdm(unit="query", file=sys.stderr)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=init_worker, initargs=(args.db,)
+        ) as executor:
+            pending = set()
+            queued = iter(enumerate(queries))
+            while True:
+                # The queries are submitted as the results come, so that a large batch is not queued at once
+                for index, query in queued:
+                    pending.add(
+                        executor.submit(
+                            run_worker_query, index, query, args.timezone, args.max_time
+                        )
+                    )
+                    if len(pending) >= workers * BATCH_QUEUE_PER_WORKER:
+                        break
+                if not pending:
+                    break
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    index, result = future.result()
+                    result["index"] = index
+                    found += result["found"]
+                    failed += "error" in result
+                    output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    processed += 1
+                    progress.update()
+                output.flush()
+    finally:
+        queries.close()
+        progress.close()
+        if output is not sys.stdout:
+            output.close()
+    seconds = time.perf_counter() - start_time
+    print(
+        f"{processed} queries in {seconds:.1f} s ({processed / seconds:.2f} queries/s) "
+        f"with {workers} workers: {found} found, {processed - found - failed} not found, {failed} failed",
+        file=sys.stderr,
+    )
+    return 0 if not failed else 1
+
+
+def departures_command(args):
+    planner = JourneyPlanner(Database(args.db))
+    # A single stop is shown as a station, with its child stops
+    stops = args.stops[0] if len(args.stops) == 1 else args.stops
+    start = (
+        datetime.datetime.fromisoformat(args.time)
+        if args.time
+        else datetime.datetime.now(pytz.timezone(args.timezone)).replace(tzinfo=None)
+    )
+    departures, page = planner.departure_board.get_board(
+        stops, start, args.limit, args.page
+    )
+    if args.json:
+        for departure in departures:
+            row = dataclasses.asdict(departure)
+            row["time"] = departure.time.isoformat()
+            row["service_date"] = departure.service_date.isoformat()
+            print(json.dumps(row, ensure_ascii=False))
+    else:
+        for departure in departures:
+            route_name = departure.route_short_name or departure.route_long_name or ""
+            print(
+                f"{departure.time:%H:%M}  {route_name:<10}  {departure.trip_headsign or '':<40}  {departure.stop_id}"
+            )
+    if page:
+        print(f"Next page: --page '{page}'", file=sys.stderr)
+    return 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="railfinder", description="RailFinder journey planner, without the interface"
+    )
+    parser.add_argument(
+        "--db",
+        default=get_default_db_path(),
+        help="database to query (railfinder_static.db if it exists, railfinder.db otherwise)",
+    )
+    parser.add_argument(
+        "--timezone",
+        default="Europe/Paris",
+        help="time zone of the departure times given and printed",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    search_parser = subparsers.add_parser("search", help="search a journey")
+    search_parser.add_argument("origin", help='station name or "lat,lon" position')
+    search_parser.add_argument("destination", help='station name or "lat,lon" position')
+    search_parser.add_argument(
+        "--departure", default=None, help="departure time in ISO format (now by default)"
+    )
+    search_parser.add_argument(
+        "--mode", choices=["fastest", "least_transfers"], default="fastest"
+    )
+    search_parser.add_argument(
+        "--max-time", type=int, default=60, help="maximum search time in seconds"
+    )
+    search_parser.add_argument(
+        "--json", action="store_true", help="print the result as JSON"
+    )
+    search_parser.set_defaults(handler=search_command)
+
+    batch_parser = subparsers.add_parser(
+        "batch", help="run the journey queries of a CSV or JSONL file"
+    )
+    batch_parser.add_argument(
+        "input",
+        help='CSV file with a from,to,departure,mode header, or JSONL file of queries ("-" for the standard input)',
+    )
+    batch_parser.add_argument(
+        "--output", "-o", default=None, help="JSONL results file (standard output by default)"
+    )
+    batch_parser.add_argument(
+        "--workers", type=int, default=None, help="number of worker processes (one per CPU by default)"
+    )
+    batch_parser.add_argument(
+        "--max-time", type=int, default=60, help="maximum search time of each query in seconds"
+    )
+    batch_parser.set_defaults(handler=batch_command)
+
+    departures_parser = subparsers.add_parser(
+        "departures", help="print the next departures of a station or of stops"
+    )
+    departures_parser.add_argument(
+        "stops", nargs="+", help="stop_id of a station (with its child stops), or several stop_ids"
+    )
+    departures_parser.add_argument(
+        "--time",
+        default=None,
+        help="start time in ISO format, in the local time of the feeds (now by default)",
+    )
+    departures_parser.add_argument("--limit", type=int, default=20)
+    departures_parser.add_argument(
+        "--page", default=None, help="page token printed by the previous call"
+    )
+    departures_parser.add_argument(
+        "--json", action="store_true", help="print the departures as JSONL"
+    )
+    departures_parser.set_defaults(handler=departures_command)
+
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,230 @@
+import json
+import threading
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    from database import Database
+
+
+@dataclass
+class TripDelay:
+    trip_id: str
+    canceled: bool = False
+    # (stop_sequence, stop_id, arrival_delay, departure_delay), sorted by stop_sequence
+    stop_delays: list = field(default_factory=list)
+    skipped_stop_sequences: set = field(default_factory=set)
+    skipped_stop_ids: set = field(default_factory=set)
+
+
+@dataclass(frozen=True)
+class RealtimeSnapshot:
+    version: int
+    trips: dict
+    max_delay: int = 0
+
+    def get_delay(
+        self,
+        trip_id: str,
+        stop_sequence: Optional[int] = None,
+        stop_id: Optional[str] = None,
+        departure: bool = False,
+    ) -> int:
+        """
+        Get the delay in seconds of a trip at a stop.
+        As in GTFS-Realtime, the delay of a stop time update is propagated to the next stops of the trip,
+        until the next stop time update. The trip-level delay (stored at stop sequence 0) applies before
+        the first stop time update, and to the stops whose sequence is not known.
+        """
+        trip = self.trips.get(trip_id)
+        if trip is None:
+            return 0
+        delay = 0
+        for update_sequence, update_stop_id, arrival_delay, departure_delay in (
+            trip.stop_delays
+        ):
+            if stop_id is not None and update_stop_id == stop_id:
+                return departure_delay if departure else arrival_delay
+            if update_sequence is not None and (
+                (update_sequence == 0 and update_stop_id is None)
+                or (stop_sequence is not None and update_sequence <= stop_sequence)
+            ):
+                delay = departure_delay if departure else arrival_delay
+        return delay
+
+    def is_canceled(self, trip_id: str) -> bool:
+        trip = self.trips.get(trip_id)
+        return trip is not None and trip.canceled
+
+    def is_skipped(self, trip_id: str, stop_sequence: int, stop_id: str) -> bool:
+        trip = self.trips.get(trip_id)
+        return trip is not None and (
+            stop_sequence in trip.skipped_stop_sequences
+            or stop_id in trip.skipped_stop_ids
+        )
+
+
+class RealtimeOverlay:
+    def __init__(self, db: "Database | None" = None):
+        """
+        This class holds the GTFS-Realtime delays and cancellations in memory, on top of the static database.
+        Updates are applied incrementally, without touching the database, and each update produces a new
+        immutable snapshot with a new version number, so that a running search keeps using the snapshot
+        it started with.
+        If a database is given, the stop time updates identified only by their stop_id get the stop sequence
+        of the stop in their trip when they are applied, so that their delay is propagated to the next stops.
+        """
+        self.db = db
+        self.current = RealtimeSnapshot(version=0, trips={})
+        self.write_lock = threading.Lock()
+
+    def snapshot(self) -> RealtimeSnapshot:
+        """
+        Get the current snapshot, it is never modified afterwards.
+        """
+        return self.current
+
+    def parse_feed(self, data: bytes) -> dict:
+        """
+        Parse a GTFS-Realtime feed, either in its JSON form or as a protobuf message.
+        Reading protobuf messages needs the optional gtfs-realtime-bindings package.
+        Returns the feed as a dict, with the keys of the protobuf JSON mapping (entity, tripUpdate, ...).
+        """
+        if data.lstrip()[:1] == b"{":
+            return json.loads(data)
+        try:
+            from google.protobuf.json_format import MessageToDict
+            from google.transit import gtfs_realtime_pb2
+        except ImportError as e:
+            raise ImportError(
+                "The gtfs-realtime-bindings package is needed to read GTFS-Realtime protobuf feeds."
+            ) from e
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(data)
+        return MessageToDict(feed)
+
+    def parse_trip_update(self, trip_update: dict, id: int) -> TripDelay:
+        """
+        Convert a TripUpdate entity to a TripDelay, prefixing the IDs like the static data of the same source.
+        Only relative delays are supported, absolute times of stop time updates are ignored.
+        """
+        trip = trip_update.get("trip", {})
+        trip_delay = TripDelay(
+            trip_id=f"{id:02}/{trip.get('tripId')}",
+            canceled=trip.get("scheduleRelationship") in ("CANCELED", 3),
+        )
+        trip_level_delay = trip_update.get("delay")
+        if trip_level_delay is not None:
+            trip_delay.stop_delays.append(
+                (0, None, int(trip_level_delay), int(trip_level_delay))
+            )
+        for update in trip_update.get("stopTimeUpdate", []):
+            stop_sequence = update.get("stopSequence")
+            stop_sequence = int(stop_sequence) if stop_sequence is not None else None
+            stop_id = f"{id:02}/{update['stopId']}" if "stopId" in update else None
+            if update.get("scheduleRelationship") in ("SKIPPED", 1):
+                if stop_sequence is not None:
+                    trip_delay.skipped_stop_sequences.add(stop_sequence)
+                if stop_id is not None:
+                    trip_delay.skipped_stop_ids.add(stop_id)
+                continue
+            arrival_delay = update.get("arrival", {}).get("delay")
+            departure_delay = update.get("departure", {}).get("delay")
+            if arrival_delay is None and departure_delay is None:
+                continue
+            arrival_delay = int(
+                arrival_delay if arrival_delay is not None else departure_delay
+            )
+            departure_delay = int(
+                departure_delay if departure_delay is not None else arrival_delay
+            )
+            trip_delay.stop_delays.append(
+                (stop_sequence, stop_id, arrival_delay, departure_delay)
+            )
+        self.resolve_stop_sequences(trip_delay)
+        trip_delay.stop_delays.sort(
+            key=lambda update: update[0] if update[0] is not None else -1
+        )
+        return trip_delay
+
+    def resolve_stop_sequences(self, trip_delay: TripDelay):
+        """
+        Set the stop sequence of the stop time updates given only by their stop_id,
+        from the stop times of the trip in the database (if the overlay has one).
+        """
+        if self.db is None or not any(
+            update[0] is None and update[1] is not None
+            for update in trip_delay.stop_delays
+        ):
+            return
+        stop_sequences = self.db.get_trip_stop_sequences(trip_delay.trip_id)
+        trip_delay.stop_delays = [
+            (
+                stop_sequences.get(stop_id) if stop_sequence is None else stop_sequence,
+                stop_id,
+                arrival_delay,
+                departure_delay,
+            )
+            for stop_sequence, stop_id, arrival_delay, departure_delay in trip_delay.stop_delays
+        ]
+
+    def apply_feed(self, feed: dict, id: int) -> RealtimeSnapshot:
+        """
+        Apply a parsed GTFS-Realtime feed to the overlay and publish a new snapshot.
+        id is the index of the source in data_sources.json, used to prefix the IDs.
+        A FULL_DATASET feed replaces all the previous updates of this source, a DIFFERENTIAL feed only
+        replaces the trips it contains (and removes the deleted ones).
+        """
+        prefix = f"{id:02}/"
+        full_dataset = feed.get("header", {}).get("incrementality") not in (
+            "DIFFERENTIAL",
+            1,
+        )
+        with self.write_lock:
+            trips = dict(self.current.trips)
+            if full_dataset:
+                for trip_id in [t for t in trips if t.startswith(prefix)]:
+                    del trips[trip_id]
+            for entity in feed.get("entity", []):
+                trip_update = entity.get("tripUpdate")
+                if trip_update is None:
+                    continue
+                trip_delay = self.parse_trip_update(trip_update, id)
+                if entity.get("isDeleted"):
+                    trips.pop(trip_delay.trip_id, None)
+                else:
+                    trips[trip_delay.trip_id] = trip_delay
+            max_delay = max(
+                (
+                    max(update[2], update[3])
+                    for trip in trips.values()
+                    for update in trip.stop_delays
+                ),
+                default=0,
+            )
+            self.current = RealtimeSnapshot(
+                version=self.current.version + 1,
+                trips=trips,
+                max_delay=max(0, max_delay),
+            )
+            return self.current
+
+    def load_file(self, path: str, id: int) -> RealtimeSnapshot:
+        """
+        Apply a GTFS-Realtime feed stored in a local file.
+        """
+        with open(path, "rb") as file:
+            return self.apply_feed(self.parse_feed(file.read()), id)
+
+    def load_url(self, url: str, id: int) -> RealtimeSnapshot:
+        """
+        Download a GTFS-Realtime feed from the given URL and apply it.
+        """
+        import requests
+
+        response = requests.get(url, timeout=30)
+        if response.status_code != 200:
+            raise Exception(
+                f"Failed to download GTFS-Realtime data. HTTP status code: {response.status_code}"
+            )
+        return self.apply_feed(self.parse_feed(response.content), id)
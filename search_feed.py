@@ -0,0 +1,73 @@
+import queue
+import threading
+
+
+class SearchFeed:
+    def __init__(self, maxsize: int = 16):
+        """
+        This class is a lightweight channel between the journey search thread and the interface.
+        The search pushes the coordinates of its current best path, taken from the stop coordinates
+        it already holds in memory, and the number of stops explored since the last update,
+        so the interface never has to query the database to animate the search.
+        The queue is bounded: when the interface is late, the oldest updates are dropped instead of
+        slowing down the search. The bounds are published once and kept apart, so they are never dropped.
+        """
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.closed = threading.Event()
+        self.bounds = None
+        self.lock = threading.Lock()
+
+    def publish(self, kind: str, coords: list[tuple[float, float]] | int):
+        """
+        Push an update without ever blocking the search thread.
+        kind is one of "bounds", "path" (coordinate arrays) or "explored" (a number of stops).
+        If the queue is full, the oldest update is discarded to make room for the new one.
+        """
+        if kind == "bounds":
+            with self.lock:
+                self.bounds = coords
+            return
+        update = (kind, coords)
+        while True:
+            try:
+                self.queue.put_nowait(update)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def close(self):
+        """
+        Signal that the search is over, no more updates will be published.
+        """
+        self.closed.set()
+
+    def is_closed(self) -> bool:
+        """
+        Returns True once the search is over and all its updates have been drained.
+        """
+        with self.lock:
+            pending_bounds = self.bounds is not None
+        return self.closed.is_set() and self.queue.empty() and not pending_bounds
+
+    def drain(self) -> dict:
+        """
+        Get all pending updates, coalesced into a single frame.
+        Explored stop counts are summed, while only the latest path and bounds are kept.
+        Returns a dict with the keys "bounds", "explored" and "path" (None if no path or bounds update).
+        """
+        with self.lock:
+            frame = {"bounds": self.bounds, "explored": 0, "path": None}
+            self.bounds = None
+        while True:
+            try:
+                kind, coords = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "explored":
+                frame["explored"] += coords
+            else:
+                frame[kind] = coords
+        return frame
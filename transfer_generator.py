@@ -1,37 +1,94 @@
-from calendar import c
 import sqlite3
+import heapq
 import math
-from multiprocessing import Pool, cpu_count
+from collections import defaultdict
 from tqdm import tqdm
 from utils import geodistance_meters
 from typing import TYPE_CHECKING
 import concurrent.futures
+import contextlib
+import os
 import threading
+import time
 import cProfile
 import pstats
 
 if TYPE_CHECKING:
     from database import Database
+    from import_region import ImportRegion
 
 EXCLUDED_PREFIXES = ("IDFM", "de", "NSR", "cz", "ch", "pl")
 
 DEBUG = False
 
+# Number of closed footpaths written to the database at once
+FOOTPATH_WRITE_BATCH = 100_000
+
+
+class LazyAdjacency(dict):
+    def __init__(self, find_edges):
+        """
+        Walking graph stop_idx -> list of tuples (stop_idx, walking_time), where the edges of a stop
+        are searched by find_edges(stop_idx) the first time they are read.
+        """
+        super().__init__()
+        self.find_edges = find_edges
+
+    def __missing__(self, stop):
+        edges = self[stop] = self.find_edges(stop)
+        return edges
+
 
 class TransferGenerator:
     def __init__(
-        self, db: "Database", max_distance_m=100, transfer_time_sec=120, batch_size=1000
+        self,
+        db: "Database",
+        max_distance_m=100,
+        transfer_time_sec=120,
+        batch_size=1000,
+        walking_speed_mps=1.2,
+        max_footpath_sec=900,
+        region: "ImportRegion | None" = None,
     ):
         """
         This class handles the generation of transfers between close stops in a public transport network.
         It avoids creating transfers between stops that are too far apart or already have a transfer defined.
         It allows interoperability between different transport networks, especially for cross-border journeys.
+        It also builds the footpath graph used by the journey search: walking times based on the distance
+        between stops, transitively closed up to max_footpath_sec (the transfers given by the feeds are kept
+        whatever their duration).
+        If a region is given, only the stops inside it are processed.
+        The duration and the database growth of each step are recorded in phases.
         """
         self.db = db
         self.max_distance_m = max_distance_m
         self.transfer_time_sec = transfer_time_sec
         self.batch_size = batch_size
+        self.walking_speed_mps = walking_speed_mps
+        self.max_footpath_sec = max_footpath_sec
+        self.region = region
         self.db_write_lock = threading.Lock()
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """
+        Record the duration in seconds and the growth in bytes of the database file of a step,
+        as {"phase": name, "seconds": float, "size_growth": int} in phases.
+        """
+        size_before = os.path.getsize(self.db.db_name)
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            # A failed step is recorded too, with the time it ran before failing
+            self.phases.append(
+                {
+                    "phase": name,
+                    "seconds": round(time.perf_counter() - start_time, 3),
+                    "size_growth": os.path.getsize(self.db.db_name) - size_before,
+                }
+            )
 
     def ensure_spatial_index(self):
         """
@@ -83,6 +140,72 @@ class TransferGenerator:
         delta_lon = distance / (40075000 * math.cos(math.radians(lat)) / 360)
         return delta_lat, delta_lon
 
+    def get_candidates(
+        self,
+        cur,
+        stop_id: str,
+        lat: float,
+        lon: float,
+        distance: float,
+        exclude_same_network: bool = True,
+    ):
+        """
+        Get the stops inside the bounding box of the given distance around a stop, using the spatial index.
+        Stops of the same network are excluded for the networks in EXCLUDED_PREFIXES, as they already provide their own transfers,
+        unless exclude_same_network is False.
+        Returns a list of tuples (stop_id, lat, lon), the exact distance still has to be checked.
+        """
+        delta_lat, delta_lon = self.latlon_bbox(lat, distance)
+        if not exclude_same_network:
+            return cur.execute(
+                """
+                SELECT s2.stop_id, s2.stop_lat, s2.stop_lon
+                FROM stop_index AS si
+                JOIN stops AS s2 ON s2.stop_idx = si.id
+                WHERE si.min_lat BETWEEN ? AND ? AND
+                      si.min_lon BETWEEN ? AND ? AND
+                      s2.stop_id != ?
+                """,
+                (
+                    lat - delta_lat,
+                    lat + delta_lat,
+                    lon - delta_lon,
+                    lon + delta_lon,
+                    stop_id,
+                ),
+            ).fetchall()
+        return cur.execute(
+            """
+            SELECT s2.stop_id, s2.stop_lat, s2.stop_lon
+            FROM stop_index AS si
+            JOIN stops AS s2 ON s2.stop_idx = si.id
+            WHERE si.min_lat BETWEEN ? AND ? AND
+                  si.min_lon BETWEEN ? AND ? AND
+                  s2.stop_id != ?
+                  AND NOT (
+    (substr(s2.stop_id, 4) LIKE 'IDFM%' AND substr(?, 4) LIKE 'IDFM%')
+ OR (substr(s2.stop_id, 4) LIKE 'de%'   AND substr(?, 4) LIKE 'de%')
+ OR (substr(s2.stop_id, 4) LIKE 'NSR%'  AND substr(?, 4) LIKE 'NSR%')
+ OR (substr(s2.stop_id, 4) LIKE 'cz%'   AND substr(?, 4) LIKE 'cz%')
+ OR (substr(s2.stop_id, 4) LIKE 'ch%'   AND substr(?, 4) LIKE 'ch%')
+ OR (substr(s2.stop_id, 4) LIKE 'pl%'   AND substr(?, 4) LIKE 'pl%')
+)
+            """,
+            (
+                lat - delta_lat,
+                lat + delta_lat,
+                lon - delta_lon,
+                lon + delta_lon,
+                stop_id,
+                stop_id,  # for IDFM
+                stop_id,  # for de
+                stop_id,  # for NSR
+                stop_id,  # for cz
+                stop_id,  # for ch
+                stop_id,  # for pl
+            ),
+        ).fetchall()
+
     def process_chunk(self, args):
         """
         Process a chunk of stops to find potential transfers.
@@ -117,38 +240,9 @@ class TransferGenerator:
                 profiler.enable()
 
         for i, (stop_id, lat, lon) in enumerate(stop_chunk, 1):
-            delta_lat, delta_lon = self.latlon_bbox(lat, self.max_distance_m)
-            candidates = cur.execute(
-                """
-                SELECT s2.stop_id, s2.stop_lat, s2.stop_lon
-                FROM stop_index AS si
-                JOIN stops AS s2 ON s2.stop_idx = si.id
-                WHERE si.min_lat BETWEEN ? AND ? AND
-                      si.min_lon BETWEEN ? AND ? AND
-                      s2.stop_id != ?
-                      AND NOT (
-    (substr(s2.stop_id, 4) LIKE 'IDFM%' AND substr(?, 4) LIKE 'IDFM%')
- OR (substr(s2.stop_id, 4) LIKE 'de%'   AND substr(?, 4) LIKE 'de%')
- OR (substr(s2.stop_id, 4) LIKE 'NSR%'  AND substr(?, 4) LIKE 'NSR%')
- OR (substr(s2.stop_id, 4) LIKE 'cz%'   AND substr(?, 4) LIKE 'cz%')
- OR (substr(s2.stop_id, 4) LIKE 'ch%'   AND substr(?, 4) LIKE 'ch%')
- OR (substr(s2.stop_id, 4) LIKE 'pl%'   AND substr(?, 4) LIKE 'pl%')
-)
-                """,
-                (
-                    lat - delta_lat,
-                    lat + delta_lat,
-                    lon - delta_lon,
-                    lon + delta_lon,
-                    stop_id,
-                    stop_id,  # for IDFM
-                    stop_id,  # for de
-                    stop_id,  # for NSR
-                    stop_id,  # for cz
-                    stop_id,  # for ch
-                    stop_id,  # for pl
-                ),
-            ).fetchall()
+            candidates = self.get_candidates(
+                cur, stop_id, lat, lon, self.max_distance_m
+            )
             for other_id, other_lat, other_lon in candidates:
                 if (stop_id, other_id) in existing_transfers or (
                     other_id,
@@ -184,6 +278,14 @@ class TransferGenerator:
         # Return all insertions for this chunk to be written in main thread
         return stops_processed, insertions_total, list(insertions)
 
+    def filter_region(self, stops: list) -> list:
+        """
+        Keep the (stop_id, lat, lon) stops inside the region of the generator, if it has one.
+        """
+        if self.region is None:
+            return stops
+        return [stop for stop in stops if self.region.contains(stop[1], stop[2])]
+
     def chunkify(self, lst: list, n: int) -> list:
         """
         Split a list into n nearly equal chunks.
@@ -198,16 +300,22 @@ class TransferGenerator:
         k, m = divmod(len(lst), n)
         return [lst[i * k + min(i, m) : (i + 1) * k + min(i + 1, m)] for i in range(n)]
 
-    def generate_transfers(self):
-        """Generate transfers between stops that are close to each other."""
-        self.ensure_spatial_index()
+    def generate_transfers(self, stop_prefixes: list[str] | None = None):
+        """Generate transfers between stops that are close to each other.
+        If stop_prefixes is given, only the transfers from and to the stops of these sources are generated."""
+        with self.phase("transfers_spatial_index"):
+            self.ensure_spatial_index()
         conn, cur = self.db.get_connection()
         stops = cur.execute("SELECT stop_id, stop_lat, stop_lon FROM stops").fetchall()
+        if stop_prefixes is not None:
+            stop_prefixes = tuple(stop_prefixes)
+            stops = [stop for stop in stops if stop[0].startswith(stop_prefixes)]
+        stops = self.filter_region(stops)
         # Fetch all existing transfers ONCE
         cur.execute("SELECT from_stop_id, to_stop_id FROM transfers")
         existing_transfers = set(cur.fetchall())
         conn.close()
-        nproc = cpu_count()
+        nproc = os.cpu_count() or 1
         print(f"Processing {len(stops)} stops across {nproc} threads...")
         lock = threading.Lock()
         update_every = 100
@@ -215,7 +323,9 @@ class TransferGenerator:
         total_stops = 0
         total_inserted = 0
         all_insertions = set()
-        with tqdm(total=len(stops), desc="Stops processed") as pbar:
+        with self.phase("transfers_search"), tqdm(
+            total=len(stops), desc="Stops processed"
+        ) as pbar:
             with concurrent.futures.ThreadPoolExecutor(max_workers=nproc) as executor:
                 futures = [
                     executor.submit(
@@ -230,12 +340,259 @@ class TransferGenerator:
                     total_inserted += inserted
                     all_insertions.update(insertions)
         print(f"Writing {len(all_insertions)} transfers to database...")
+        with self.phase("transfers_write"):
+            conn, cur = self.db.get_connection()
+            cur.executemany(
+                "INSERT OR IGNORE INTO transfers (from_stop_id, to_stop_id, transfer_type, min_transfer_time) VALUES (?, ?, 2, ?)",
+                [(a, b, self.transfer_time_sec) for a, b in all_insertions]
+                + [(b, a, self.transfer_time_sec) for a, b in all_insertions],
+            )
+            conn.commit()
+            conn.close()
+        print(f"Inserted {len(all_insertions) * 2} new transfers.")
+
+    def walking_time(self, distance_m: float) -> int:
+        """
+        Walking time in seconds for the given distance, never less than the fixed transfer time.
+        """
+        return max(self.transfer_time_sec, math.ceil(distance_m / self.walking_speed_mps))
+
+    def process_footpath_chunk(self, args):
+        """
+        Find the direct walking edges from a chunk of stops, to all stops within max_distance_m meters.
+        Unlike the transfers, the stops of the same network are included: walking between them is still possible
+        when their feed gives no transfer.
+        This function is run in parallel for each chunk of stops.
+        Args:
+            args (tuple): A tuple containing:
+                - stop_chunk: List of tuples (stop_id, lat, lon) for the chunk of stops
+                - pbar: progress bar instance for updating progress
+                - lock: threading lock for thread-safe updates to the progress bar
+        Returns:
+            list: List of tuples (from_stop_id, to_stop_id, walking_time) for the edges found.
+        """
+        stop_chunk, pbar, lock = args
         conn, cur = self.db.get_connection()
+        edges = []
+        for i, (stop_id, lat, lon) in enumerate(stop_chunk, 1):
+            candidates = self.get_candidates(
+                cur, stop_id, lat, lon, self.max_distance_m, exclude_same_network=False
+            )
+            for other_id, other_lat, other_lon in candidates:
+                dist = geodistance_meters(lat, lon, other_lat, other_lon)
+                if dist <= self.max_distance_m:
+                    edges.append((stop_id, other_id, self.walking_time(dist)))
+            if i % 100 == 0:
+                with lock:
+                    pbar.update(100)
+        with lock:
+            pbar.update(len(stop_chunk) % 100)
+        conn.close()
+        return edges
+
+    def close_footpaths(
+        self,
+        adjacency: dict,
+        sources: set | None = None,
+        batch_size: int = FOOTPATH_WRITE_BATCH,
+    ):
+        """
+        Compute the transitive closure of the footpath graph.
+        A bounded Dijkstra is run from each stop, so that a stop reachable by several short walks gets
+        a single direct footpath, with the shortest walking time, as long as it is below max_footpath_sec.
+        The direct edges of a stop are always kept, so a transfer given by a feed is never dropped by the limit.
+        The closure is yielded in batches as the sources are processed, so that it never has to be held in memory at once.
+        Args:
+            adjacency (dict): stop_idx -> list of tuples (stop_idx, walking_time), giving the edges of any stop
+            sources (set): stop_idx of the stops to compute the footpaths of, all the stops of adjacency by default
+            batch_size (int): minimum number of footpaths of a batch, except for the last one
+        Yields:
+            list: Lists of tuples (from_stop_idx, to_stop_idx, duration), in primary key order
+        """
+        footpaths = []
+        sources = sorted(adjacency if sources is None else sources)
+        for source in tqdm(sources, desc="Closing footpaths"):
+            durations = {source: 0}
+            queue = [(0, source)]
+            while queue:
+                duration, stop = heapq.heappop(queue)
+                if duration > durations[stop]:
+                    continue
+                for other, walking_time in adjacency[stop]:
+                    other_duration = duration + walking_time
+                    if other_duration <= self.max_footpath_sec and other_duration < (
+                        durations.get(other, self.max_footpath_sec + 1)
+                    ):
+                        durations[other] = other_duration
+                        heapq.heappush(queue, (other_duration, other))
+            # The direct edges, like the transfers given by the feeds, are kept even above max_footpath_sec
+            for other, walking_time in adjacency[source]:
+                if other != source and walking_time < durations.get(other, walking_time + 1):
+                    durations[other] = walking_time
+            footpaths.extend(
+                (source, other, durations[other])
+                for other in sorted(durations)
+                if other != source
+            )
+            if len(footpaths) >= batch_size:
+                yield footpaths
+                footpaths = []
+        if footpaths:
+            yield footpaths
+
+    def generate_footpaths(self):
+        """
+        Build the footpaths table, the transitively closed walking graph between stops.
+        Direct edges are the stops within max_distance_m meters of each other and the transfers of the database,
+        the closure is then stored with integer stop indexes, so that the journey search can relax all
+        the footpaths of a stop with a single query.
+        """
+        with self.phase("footpaths_spatial_index"):
+            self.ensure_spatial_index()
+        conn, cur = self.db.get_connection()
+        stops = cur.execute("SELECT stop_id, stop_lat, stop_lon FROM stops").fetchall()
+        stops = self.filter_region(stops)
+        stop_idx = dict(cur.execute("SELECT stop_id, stop_idx FROM stops").fetchall())
+        # Transfers given by the feeds (or generated) are also walking edges
+        transfers = cur.execute(
+            """
+            SELECT from_stop_id, to_stop_id, min_transfer_time
+            FROM transfers
+            WHERE min_transfer_time IS NOT NULL AND transfer_type != 3
+            """
+        ).fetchall()
+        conn.close()
+
+        nproc = os.cpu_count() or 1
+        lock = threading.Lock()
+        chunks = self.chunkify(stops, nproc)
+        edges = []
+        with self.phase("footpaths_search"), tqdm(
+            total=len(stops), desc="Walking edges"
+        ) as pbar:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=nproc) as executor:
+                futures = [
+                    executor.submit(self.process_footpath_chunk, (chunk, pbar, lock))
+                    for chunk in chunks
+                ]
+                for future in concurrent.futures.as_completed(futures):
+                    edges.extend(future.result())
+        edges.extend(transfers)
+
+        adjacency = defaultdict(list)
+        for from_stop_id, to_stop_id, walking_time in edges:
+            if from_stop_id not in stop_idx or to_stop_id not in stop_idx:
+                continue
+            adjacency[stop_idx[from_stop_id]].append((stop_idx[to_stop_id], walking_time))
+        # The closure is written as it is computed, batch by batch
+        with self.phase("footpaths_closure"):
+            conn, cur = self.db.get_connection()
+            cur.execute("DROP TABLE IF EXISTS footpaths")
+            cur.execute(
+                """
+                CREATE TABLE footpaths (
+                    from_stop_idx INTEGER NOT NULL,
+                    to_stop_idx INTEGER NOT NULL,
+                    duration INTEGER NOT NULL,
+                    PRIMARY KEY (from_stop_idx, to_stop_idx)
+                ) WITHOUT ROWID
+                """
+            )
+            total = 0
+            for footpaths in self.close_footpaths(adjacency):
+                cur.executemany(
+                    "INSERT INTO footpaths (from_stop_idx, to_stop_idx, duration) VALUES (?, ?, ?)",
+                    footpaths,
+                )
+                total += len(footpaths)
+            conn.commit()
+            conn.close()
+        print(f"Wrote {total} footpaths to database.")
+
+    def update_footpaths(self, stop_prefixes: list[str]):
+        """
+        Update the footpaths table after the sources of stop_prefixes have been imported again,
+        and sources have been removed (see Database.delete_feed), instead of rebuilding it.
+        The footpaths are computed again for the stops of these sources, for the stops left without footpaths,
+        and then for the stops they reach, which may now walk to a new stop. Walking edges are symmetric,
+        so the stops walking to the changed ones are the ones reached from them.
+        The direct walking edges are only searched for the stops the closure goes through.
+        """
+        with self.phase("footpaths_spatial_index"):
+            self.ensure_spatial_index()
+        conn, cur = self.db.get_connection()
+        stops = cur.execute(
+            "SELECT stop_idx, stop_id, stop_lat, stop_lon FROM stops"
+        ).fetchall()
+        positions = {idx: (stop_id, lat, lon) for idx, stop_id, lat, lon in stops}
+        stop_idx = {stop_id: idx for idx, stop_id, _, _ in stops}
+        region_stops = {
+            stop[0] for stop in self.filter_region([(idx, lat, lon) for idx, _, lat, lon in stops])
+        }
+        transfers = defaultdict(list)
+        for from_stop_id, to_stop_id, walking_time in cur.execute(
+            """
+            SELECT from_stop_id, to_stop_id, min_transfer_time
+            FROM transfers
+            WHERE min_transfer_time IS NOT NULL AND transfer_type != 3
+            """
+        ).fetchall():
+            if from_stop_id in stop_idx and to_stop_id in stop_idx:
+                transfers[stop_idx[from_stop_id]].append(
+                    (stop_idx[to_stop_id], walking_time)
+                )
+        closed = {
+            row[0]
+            for row in cur.execute("SELECT DISTINCT from_stop_idx FROM footpaths")
+        }
+
+        def find_edges(stop: int) -> list:
+            edges = list(transfers.get(stop, ()))
+            if stop in region_stops:
+                stop_id, lat, lon = positions[stop]
+                for other_id, other_lat, other_lon in self.get_candidates(
+                    cur, stop_id, lat, lon, self.max_distance_m, exclude_same_network=False
+                ):
+                    dist = geodistance_meters(lat, lon, other_lat, other_lon)
+                    if dist <= self.max_distance_m:
+                        edges.append((stop_idx[other_id], self.walking_time(dist)))
+            return edges
+
+        adjacency = LazyAdjacency(find_edges)
+        stop_prefixes = tuple(stop_prefixes)
+        # Like in generate_footpaths, the stops with walking edges are the ones of the region and the ones with transfers
+        sources = {
+            idx
+            for idx, stop_id, _, _ in stops
+            if (idx in region_stops or idx in transfers)
+            and (stop_id.startswith(stop_prefixes) or idx not in closed)
+        }
+        with self.phase("footpaths_closure"):
+            reached, total = self.replace_footpaths(cur, adjacency, sources)
+            reached_sources = reached - sources
+            total += self.replace_footpaths(cur, adjacency, reached_sources)[1]
+            conn.commit()
+        conn.close()
+        print(
+            f"Updated the footpaths of {len(sources) + len(reached_sources)} stops, {total} footpaths written."
+        )
+
+    def replace_footpaths(self, cur: sqlite3.Cursor, adjacency: dict, sources: set) -> tuple[set, int]:
+        """
+        Replace the footpaths of the given stops in the footpaths table by their closure in adjacency.
+        Returns the stop_idx of the stops reached and the number of footpaths written.
+        """
         cur.executemany(
-            "INSERT OR IGNORE INTO transfers (from_stop_id, to_stop_id, transfer_type, min_transfer_time) VALUES (?, ?, 2, ?)",
-            [(a, b, self.transfer_time_sec) for a, b in all_insertions]
-            + [(b, a, self.transfer_time_sec) for a, b in all_insertions],
+            "DELETE FROM footpaths WHERE from_stop_idx = ?",
+            [(source,) for source in sources],
         )
-        conn.commit()
-        conn.close()
-        print(f"Inserted {len(all_insertions) * 2} new transfers.")
+        reached = set()
+        total = 0
+        for footpaths in self.close_footpaths(adjacency, sources):
+            cur.executemany(
+                "INSERT INTO footpaths (from_stop_idx, to_stop_idx, duration) VALUES (?, ?, ?)",
+                footpaths,
+            )
+            reached.update(footpath[1] for footpath in footpaths)
+            total += len(footpaths)
+        return reached, total
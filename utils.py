@@ -34,3 +34,43 @@ def geodistance_meters(lat1, lon1, lat2, lon2):
     Calculate the distance between two geographical points in meters.
     """
     return geodistance(lat1, lon1, lat2, lon2) * 1000  # Convert km to meters
+
+
+def source_prefix(id: str) -> str:
+    """
+    Get the prefix of an ID prefixed with the index of its source, e.g. "00/" for "00/8768600".
+    parent_station is not prefixed like stop_id, the ID of the parent station of a stop is source_prefix(stop_id) + parent_station.
+    """
+    return id.split("/", 1)[0] + "/"
+
+
+def gtfs_time_to_seconds(time_str: str) -> int:
+    """
+    Convert a GTFS time string (HH:MM:SS, the hour can exceed 23) to a number of seconds since the start of the service day.
+    """
+    hour, minute, second = map(int, time_str.split(":"))
+    return hour * 3600 + minute * 60 + second
+
+
+def seconds_to_gtfs_time(seconds: int) -> str:
+    """
+    Convert a number of seconds since the start of the service day to a GTFS time string (HH:MM:SS).
+    """
+    seconds = max(0, int(seconds))
+    return f"{seconds // 3600:02}:{seconds % 3600 // 60:02}:{seconds % 60:02}"
+
+
+def point_in_polygon(lat: float, lon: float, polygon) -> bool:
+    """
+    Check if a point is inside a polygon given as a list of (lat, lon) vertices, with the ray casting algorithm.
+    """
+    inside = False
+    n = len(polygon)
+    for i in range(n):
+        lat1, lon1 = polygon[i]
+        lat2, lon2 = polygon[(i + 1) % n]
+        if (lat1 > lat) != (lat2 > lat):
+            crossing_lon = lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1)
+            if lon < crossing_lon:
+                inside = not inside
+    return inside